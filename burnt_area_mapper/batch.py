@@ -0,0 +1,200 @@
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import timedelta
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+import typer
+from burnt_area import MAX_WINDOW_DAYS
+from main import main
+from shapely import STRtree
+from utils.classification import DNBR_BREAKS
+from utils.io import GeospatialRead
+from utils.typer import (
+    OPTION_BATCH_WORKERS,
+    OPTION_DOWNLOAD_BY,
+    OPTION_DOWNLOAD_MODE,
+    OPTION_EVENTS,
+    OPTION_EXTRACT,
+    OPTION_LAZY,
+    OPTION_MEMORY_BUDGET,
+    OPTION_OUTPUT_DIR,
+    OPTION_STORE_DIR,
+    OPTION_STORE_SIZE,
+)
+
+
+def load_events(path):
+    """
+    This function reads the fire events of a batch run
+    Inputs:
+        path: GeoPackage or CSV with geometry, start and end columns
+    Returns:
+        events: GeoDataFrame in EPSG:4326 with an id column
+    """
+    events = GeospatialRead(Path(path))._read_file()
+    if events.crs is not None:
+        events = events.to_crs("EPSG:4326")
+    events["start"] = pd.to_datetime(events["start"])
+    events["end"] = pd.to_datetime(events["end"])
+    if "id" not in events.columns:
+        events["id"] = [f"event_{i}" for i in range(len(events))]
+    events["id"] = events["id"].astype(str)
+    return events.reset_index(drop=True)
+
+
+def group_events(events):
+    """
+    This function groups events whose footprints intersect and whose
+    acquisition windows overlap, so that they run one after the other in
+    the same worker and reuse each other's scenes from the store
+    Inputs:
+        events: GeoDataFrame of the events
+    Returns:
+        groups: list of lists of event positions
+    """
+    margin = timedelta(days=MAX_WINDOW_DAYS)
+    starts = (events["start"] - margin).to_numpy()
+    ends = (events["end"] + margin).to_numpy()
+    parent = np.arange(len(events))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    left, right = STRtree(events.geometry.values).query(
+        events.geometry.values, predicate="intersects"
+    )
+    for i, j in zip(left, right):
+        if i < j and starts[i] <= ends[j] and starts[j] <= ends[i]:
+            parent[find(i)] = find(j)
+    groups = {}
+    for i in range(len(events)):
+        groups.setdefault(find(i), []).append(i)
+    return list(groups.values())
+
+
+def run_group(records, output_dir, options):
+    """
+    This function runs a group of events sequentially in a worker process
+    Inputs:
+        records: list of event dictionaries
+        output_dir: folder of the per event outputs
+        options: keyword arguments of the single fire run
+    Returns:
+        results: list of per event results
+    """
+    results = []
+    for record in records:
+        event_dir = Path(output_dir) / record["id"]
+        (event_dir / "data").mkdir(parents=True, exist_ok=True)
+        # the pipeline writes relative to ./data of the working directory
+        os.chdir(event_dir)
+        geometry = record["geometry"]
+        if options["download_by"] == "SH":
+            coords = tuple(geometry.bounds)
+        else:
+            coords = {"geometry": [geometry]}
+        start = time.perf_counter()
+        result = {"id": record["id"], "output": str(event_dir / "data")}
+        try:
+            main(
+                start_date=record["start"],
+                end_date=record["end"],
+                coords=coords,
+                gdf_bounds=False,
+                gdf_path=None,
+                workers=None,
+                class_breaks=",".join(str(b) for b in DNBR_BREAKS),
+                composite=None,
+                download_workers=5,
+                local_pre=None,
+                local_post=None,
+                profile=False,
+                prometheus=None,
+                compress="DEFLATE",
+                tiles=None,
+                max_zoom=None,
+                zones=None,
+                zonal_output="./data/zonal_stats.csv",
+                vectors=None,
+                simplify=None,
+                sieve_size=None,
+                **options,
+            )
+            result["status"] = "done"
+        except Exception as e:
+            result["status"] = "failed"
+            result["error"] = repr(e)
+        result["seconds"] = round(time.perf_counter() - start, 2)
+        print(f"{record['id']}: {result['status']} in {result['seconds']} s")
+        results.append(result)
+    return results
+
+
+def batch(
+    events: Path = OPTION_EVENTS,
+    download_by: str = OPTION_DOWNLOAD_BY,
+    output_dir: Path = OPTION_OUTPUT_DIR,
+    batch_workers: Optional[int] = OPTION_BATCH_WORKERS,
+    store_dir: Optional[Path] = OPTION_STORE_DIR,
+    store_size: float = OPTION_STORE_SIZE,
+    memory_budget: Optional[int] = OPTION_MEMORY_BUDGET,
+    lazy: Optional[bool] = OPTION_LAZY,
+    extract: str = OPTION_EXTRACT,
+    download_mode: str = OPTION_DOWNLOAD_MODE,
+) -> None:
+    output_dir = Path(output_dir).resolve()
+    output_dir.mkdir(parents=True, exist_ok=True)
+    # events share downloaded scenes through one store
+    store_dir = Path(store_dir or output_dir / "store").resolve()
+    table = load_events(events)
+    options = {
+        "download_by": download_by,
+        "store_dir": store_dir,
+        "store_size": store_size,
+        "memory_budget": memory_budget,
+        "lazy": lazy,
+        "extract": extract,
+        "download_mode": download_mode,
+    }
+    groups = group_events(table)
+    records = table.to_dict("records")
+    start = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=batch_workers) as executor:
+        futures = [
+            executor.submit(
+                run_group, [records[i] for i in group], output_dir, options
+            )
+            for group in groups
+        ]
+        for future in as_completed(futures):
+            results.extend(future.result())
+    seconds = time.perf_counter() - start
+    done = sum(result["status"] == "done" for result in results)
+    report = {
+        "events": len(results),
+        "done": done,
+        "failed": len(results) - done,
+        "groups": len(groups),
+        "seconds": round(seconds, 2),
+        "events_per_hour": round(done / seconds * 3600, 2),
+        "results": sorted(results, key=lambda result: result["id"]),
+    }
+    with open(output_dir / "batch_report.json", "w") as outfile:
+        json.dump(report, outfile, indent=2)
+    print(
+        f"{done}/{len(results)} events in {seconds:.0f} s, "
+        f"{report['events_per_hour']} events/hour"
+    )
+
+
+if __name__ == "__main__":
+    typer.run(batch)
@@ -0,0 +1,212 @@
+"""
+Benchmark of the fused band-math kernel against the baseline calc_ba,
+_get_water_mask and apply_water_mask chain.
+
+The baseline is a frozen copy of the original band-first kernel, so the
+comparison does not move when burnt_area.py changes. The current chain
+of burnt_area.py is reported next to it.
+
+Run from the burnt_area_mapper folder:
+    python -m benchmarks.bench_band_math --size 4096 --repeat 3
+"""
+import argparse
+import copy
+import json
+import sys
+import time
+import tracemalloc
+from collections import Counter
+
+import numpy as np
+from benchmarks.synthetic import synthetic_stack
+from burnt_area import BurntArea
+
+
+def baseline_calc_ba(image):
+    """
+    This function is the original burnt area index of a band first stack
+    Inputs:
+        image: numpy ndarray image
+    Returns:
+        ba: burned area
+    """
+    NIR = image[1].astype(np.int8)
+    SWIR = image[2].astype(np.int8)
+    ba = (NIR - SWIR) / (NIR + SWIR)
+    return ba
+
+
+def baseline_water_mask(image):
+    """
+    This function is the original water mask of a band first stack
+    Inputs:
+        image: numpy ndarray image with several bands
+    Returns:
+        water_mask: numpy ndarray water mask
+    """
+    GREEN = image[0].astype(np.int8)
+    NIR = image[1].astype(np.int8)
+    BLUE = image[5].astype(np.int8)
+    SWIR = image[6].astype(np.int8)
+    swm = (BLUE + GREEN) / (NIR + SWIR)
+    swm_water_mask = copy.copy(swm)
+    swm_water_mask[(swm >= 1.1) & (swm <= 5.6)] = -15
+    return swm_water_mask
+
+
+def baseline_apply_water_mask(image, mask):
+    """
+    This function is the original application of the water mask
+    Inputs:
+        image: numpy ndarray final output
+        mask: water mask
+    Returns:
+        final_image: masked output
+    """
+    new_mask = np.ma.masked_where(mask == -15, mask)
+    final_image = np.ma.masked_where(np.ma.getmask(new_mask), image)
+    final_image = final_image.filled(fill_value=-15)
+    return final_image
+
+
+def count_allocations(func, plane):
+    """
+    This function counts the raster buffers a call allocates. The call is
+    traced line by line with a tracemalloc snapshot after every line:
+    numpy blocks alive after a line and not before it are counted one by
+    one, and the buffers a line allocates and frees again are counted
+    from the traced peak of the line in float32 rasters
+    Inputs:
+        func: callable to measure
+        plane: bytes of a full size float32 raster
+    Returns:
+        allocations: number of raster buffers allocated by the call
+    """
+    # boolean masks are the smallest rasters, one byte per pixel
+    min_bytes = plane // 4
+    numpy_only = [tracemalloc.DomainFilter(True, np.lib.tracemalloc_domain)]
+
+    def blocks():
+        snapshot = tracemalloc.take_snapshot().filter_traces(numpy_only)
+        return Counter(
+            (trace.size, trace.traceback)
+            for trace in snapshot.traces
+            if trace.size >= min_bytes
+        )
+
+    state = {"count": 0}
+
+    def reset():
+        state["blocks"] = blocks()
+        tracemalloc.reset_peak()
+        state["start"] = tracemalloc.get_traced_memory()[0]
+
+    def step():
+        _, peak = tracemalloc.get_traced_memory()
+        new = blocks() - state["blocks"]
+        new_bytes = sum(size * n for (size, _), n in new.items())
+        transient = max(peak - state["start"] - new_bytes, 0)
+        state["count"] += sum(new.values()) + round(transient / plane)
+        reset()
+
+    def trace(frame, event, arg):
+        step()
+        return trace
+
+    tracemalloc.start()
+    reset()
+    sys.settrace(trace)
+    try:
+        result = func()
+    finally:
+        sys.settrace(None)
+    step()
+    tracemalloc.stop()
+    del result
+    return state["count"]
+
+
+def measure(func, repeat, plane):
+    """
+    This function measures the best wall time, the traced peak memory and
+    the allocations of a call
+    Inputs:
+        func: callable to measure
+        repeat: number of timed runs
+        plane: bytes of a full size float32 raster
+    Returns:
+        seconds: best wall time of the runs
+        peak: peak of traced memory in bytes
+        allocations: number of raster buffers allocated by one run
+    """
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    allocations = count_allocations(func, plane)
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start)
+    return min(seconds), peak, allocations
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=2048)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    # only the band math is exercised, no SentinelHub configuration needed
+    burnt_area = BurntArea.__new__(BurntArea)
+    pre = synthetic_stack(args.size, seed=0)
+    post = synthetic_stack(args.size, seed=1)
+    download_type = "batch"
+
+    def baseline():
+        water_mask = baseline_water_mask(pre)
+        _ = baseline_water_mask(post)
+        dnbr = baseline_calc_ba(pre) - baseline_calc_ba(post)
+        return baseline_apply_water_mask(dnbr, water_mask)
+
+    def current():
+        water_mask = burnt_area._get_water_mask(pre, download_type)
+        _ = burnt_area._get_water_mask(post, download_type)
+        pre_index = burnt_area.calc_ba(pre, download_type)
+        post_index = burnt_area.calc_ba(post, download_type)
+        dnbr = burnt_area.calc_dnbr(pre_index, post_index)
+        return burnt_area.apply_water_mask(dnbr, water_mask)
+
+    def fused():
+        return burnt_area.fused_dnbr(pre, post, download_type)
+
+    # the peak expressed as full size float32 rasters approximates the
+    # number of live temporaries of each path
+    plane = args.size * args.size * 4
+    results = {"size": args.size}
+    paths = (("baseline", baseline), ("current", current), ("fused", fused))
+    for name, func in paths:
+        seconds, peak, allocations = measure(func, args.repeat, plane)
+        results[name] = {
+            "seconds": round(seconds, 4),
+            "peak_bytes": peak,
+            "peak_rasters": round(peak / plane, 2),
+            "allocations": allocations,
+        }
+    baseline_results, fused_results = results["baseline"], results["fused"]
+    results["speedup"] = round(
+        baseline_results["seconds"] / fused_results["seconds"], 2
+    )
+    results["memory_reduction"] = round(
+        baseline_results["peak_bytes"] / fused_results["peak_bytes"], 2
+    )
+    results["allocation_reduction"] = round(
+        baseline_results["allocations"] / max(fused_results["allocations"], 1),
+        2,
+    )
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
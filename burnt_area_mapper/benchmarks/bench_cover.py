@@ -0,0 +1,41 @@
+"""
+Benchmark of the STRtree greedy cover against min_cover_1 + min_cover_2
+on a synthetic footprint catalogue.
+
+Run from the burnt_area_mapper folder:
+    python -m benchmarks.bench_cover --footprints 2000
+"""
+import argparse
+import json
+import time
+
+from benchmarks.synthetic import synthetic_catalogue
+from utils.cover import min_cover
+from utils.util import min_cover_1, min_cover_2
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--footprints", type=int, default=2000)
+    args = parser.parse_args()
+    catalogue = synthetic_catalogue(args.footprints)
+
+    start = time.perf_counter()
+    legacy = min_cover_2(min_cover_1(catalogue))
+    legacy_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cover = min_cover(catalogue)
+    cover_seconds = time.perf_counter() - start
+
+    results = {
+        "footprints": args.footprints,
+        "legacy": {"seconds": round(legacy_seconds, 4), "tiles": len(legacy)},
+        "strtree": {"seconds": round(cover_seconds, 4), "tiles": len(cover)},
+        "speedup": round(legacy_seconds / cover_seconds, 2),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
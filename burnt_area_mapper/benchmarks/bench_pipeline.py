@@ -0,0 +1,349 @@
+"""
+Offline benchmark suite of the whole pipeline. Every stage of BurntArea,
+of Sentinel_Sat.ss_process and of the footprint cover is timed on
+deterministic synthetic data, with SentinelAPI, SentinelHubRequest and
+SentinelHubCatalog replaced by the local stand-ins of benchmarks.fakes
+and the band-subset downloads served by its local HTTP server.
+
+Peak memory is the tracemalloc peak above the memory held before the
+stage, it covers numpy but not the buffers allocated inside GDAL.
+
+Run from the burnt_area_mapper folder:
+    python -m benchmarks.bench_pipeline --sizes 1024 4096 \
+        --tile_sizes 1024 --catalogues 10 2000 --output results.json
+
+--full adds regional scenes of FULL_SIZE x FULL_SIZE pixels to the
+SentinelHub suite. Both 7 band uint16 stacks of such a scene alone take
+close to 12 GB, so run it on a machine with 32 GB or more, e.g.
+    python -m benchmarks.bench_pipeline --suites SH --full
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from unittest import mock
+
+import numpy as np
+import sentinel
+import sentinel_sat
+from benchmarks.fakes import (
+    FakeProductServer,
+    FakeSentinelAPI,
+    FakeSentinelHubCatalog,
+    FakeSentinelHubRequest,
+)
+from benchmarks.synthetic import area_of_interest, synthetic_catalogue
+from burnt_area import WATER_VALUE, BurntArea
+from sentinel_sat import Sentinel_Sat
+from utils.cover import min_cover
+from utils.util import min_cover_1, min_cover_2
+
+FIRE_START = datetime(2023, 3, 5)
+FIRE_END = datetime(2023, 3, 15)
+# side in pixels of the regional scenes benchmarked with --full
+FULL_SIZE = 20480
+# centre of the SentinelHub area of interest
+CENTRE = (149.4, -32.9)
+# suite, lazy and download mode of the Copernicus runs
+CA_RUNS = (
+    ("CA", False, "product"),
+    ("CA-lazy", True, "product"),
+    ("CA-bands", False, "bands"),
+)
+
+
+class Recorder:
+    """
+    Collects the wall time, CPU time and traced peak memory of stages.
+    """
+
+    def __init__(self):
+        self.results = []
+
+    def run(self, suite, size, stage, func, *args, **kwargs):
+        """
+        This function runs and measures a single stage
+        Inputs:
+            suite: name of the suite
+            size: size parameter of the run
+            stage: name of the stage
+            func: callable of the stage
+        Returns:
+            result: return value of the stage
+        """
+        tracemalloc.reset_peak()
+        baseline, _ = tracemalloc.get_traced_memory()
+        wall, cpu = time.perf_counter(), time.process_time()
+        result = func(*args, **kwargs)
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        _, peak = tracemalloc.get_traced_memory()
+        self.results.append(
+            {
+                "suite": suite,
+                "size": size,
+                "stage": stage,
+                "seconds": round(wall, 4),
+                "cpu_seconds": round(cpu, 4),
+                "peak_bytes": peak - baseline,
+            }
+        )
+        print(f"{suite:>6} {size:>6} {stage:<28} {wall:8.3f} s")
+        return result
+
+
+@contextmanager
+def offline_run():
+    """
+    This function runs the pipeline in a scratch working directory with the
+    network clients replaced by the fakes
+    """
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as scratch, mock.patch.object(
+        sentinel, "SentinelHubRequest", FakeSentinelHubRequest
+    ), mock.patch.object(
+        sentinel, "SentinelHubCatalog", FakeSentinelHubCatalog
+    ), mock.patch.object(
+        sentinel_sat, "SentinelAPI", FakeSentinelAPI
+    ):
+        os.chdir(scratch)
+        os.makedirs("data", exist_ok=True)
+        try:
+            yield scratch
+        finally:
+            os.chdir(cwd)
+
+
+def sh_coords(size):
+    """
+    This function returns a bbox of about size x size pixels at 10 m
+    Inputs:
+        size: width and height of the area in pixels
+    Returns:
+        coords: (minx, miny, maxx, maxy) in degrees
+    """
+    dy = size * 10 / 111320 / 2
+    dx = dy / math.cos(math.radians(CENTRE[1]))
+    return (CENTRE[0] - dx, CENTRE[1] - dy, CENTRE[0] + dx, CENTRE[1] + dy)
+
+
+def bench_cover(recorder, catalogues):
+    for n in catalogues:
+        catalogue = synthetic_catalogue(n)
+        recorder.run(
+            "cover",
+            n,
+            "min_cover_1+min_cover_2",
+            lambda: min_cover_2(min_cover_1(catalogue)),
+        )
+        recorder.run("cover", n, "min_cover", min_cover, catalogue)
+
+
+def bench_sentinelhub(recorder, sizes):
+    for size in sizes:
+        with offline_run():
+            burnt_area = BurntArea(
+                fire_start=FIRE_START,
+                fire_end=FIRE_END,
+                imagery="Sentinel",
+                coords=sh_coords(size),
+                provider="SH",
+            )
+            start_date, end_date, _ = burnt_area.recalibrate_time(
+                FIRE_START, "-"
+            )
+            recorder.run(
+                "SH",
+                size,
+                "_probe_clouds",
+                burnt_area._probe_clouds,
+                start_date,
+                end_date,
+            )
+            pre, download_type = recorder.run(
+                "SH", size, "_download pre", burnt_area._download, "-"
+            )
+            post, _ = recorder.run(
+                "SH", size, "_download post", burnt_area._download, "+"
+            )
+            if download_type == "regular":
+                recorder.run(
+                    "SH", size, "_check_clm", burnt_area._check_clm, pre
+                )
+            dnbr, water = recorder.run(
+                "SH",
+                size,
+                "date_stage pre",
+                burnt_area.date_stage,
+                pre,
+                download_type,
+                water_mask=True,
+            )
+            post_nbr, _ = recorder.run(
+                "SH",
+                size,
+                "date_stage post",
+                burnt_area.date_stage,
+                post,
+                download_type,
+            )
+            del pre, post
+
+            def dnbr_stage(dnbr, post_nbr, water):
+                np.subtract(dnbr, post_nbr, out=dnbr)
+                np.copyto(dnbr, WATER_VALUE, where=water)
+                return dnbr
+
+            recorder.run("SH", size, "dnbr", dnbr_stage, dnbr, post_nbr, water)
+            recorder.run(
+                "SH",
+                size,
+                "apply_final_classification",
+                burnt_area.apply_final_classification,
+                dnbr,
+            )
+            del dnbr, post_nbr, water
+            recorder.run("SH", size, "nbr_process", burnt_area.nbr_process)
+            recorder.run(
+                "SH",
+                size,
+                "nbr_process_windowed",
+                burnt_area.nbr_process_windowed,
+                memory_budget=256 * 1024**2,
+            )
+            if download_type == "regular":
+                burnt_area.composite = "least_cloudy"
+                recorder.run(
+                    "SH",
+                    size,
+                    "download_composite",
+                    burnt_area.download_composite,
+                    FIRE_START,
+                    "-",
+                )
+
+
+def bench_copernicus(recorder, tile_sizes, products):
+    for size in tile_sizes:
+        FakeSentinelAPI.configure(products=products, size=size)
+        coords = area_of_interest(size)
+        for suite, lazy, download in CA_RUNS:
+            with offline_run() as scratch, FakeProductServer(
+                f"{scratch}/server/"
+            ) as server:
+                apis = Sentinel_Sat(
+                    start_date=FIRE_START.date(),
+                    end_date=FIRE_END.date(),
+                    input_file=coords,
+                    lazy=lazy,
+                    dl_dir=f"{scratch}/data/pre/",
+                    download=download,
+                )
+                # the phases in the order of ss_process
+                for phase in (
+                    "phase_1",
+                    "phase_2",
+                    "phase_3",
+                    "phase_4",
+                    "phase_5",
+                    "phase_6",
+                ):
+                    recorder.run(suite, size, phase, getattr(apis, phase))
+                if download == "bands":
+                    print(
+                        f"{suite:>6} {size:>6} {len(server.served)} nodes, "
+                        f"{sum(server.served.values()) / 1e6:.1f} MB"
+                    )
+                if lazy:
+                    recorder.run(suite, size, "phase_lazy", apis.phase_lazy)
+                    continue
+                dirs = recorder.run(suite, size, "phase_7", apis.phase_7)
+                recorder.run(suite, size, "phase8b", apis.phase8b)
+                recorder.run(suite, size, "phase8ab", apis.phase8ab, dirs)
+                recorder.run(suite, size, "phase_warp", apis.phase_warp)
+        with offline_run():
+            burnt_area = BurntArea(
+                fire_start=FIRE_START,
+                fire_end=FIRE_END,
+                imagery="Sentinel",
+                coords=coords,
+                provider="CA",
+            )
+            recorder.run("CA", size, "nbr_process", burnt_area.nbr_process)
+
+
+def commit():
+    """
+    This function returns the commit of the benchmarked tree
+    Returns:
+        commit: git hash or None outside of a git checkout
+    """
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[1024, 2048, 4096]
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help=f"Add scenes of {FULL_SIZE} x {FULL_SIZE} pixels to --sizes",
+    )
+    parser.add_argument("--tile_sizes", type=int, nargs="+", default=[1024])
+    parser.add_argument("--products", type=int, default=10)
+    parser.add_argument(
+        "--catalogues", type=int, nargs="+", default=[10, 100, 1000, 2000]
+    )
+    parser.add_argument(
+        "--suites",
+        nargs="+",
+        choices=("cover", "SH", "CA"),
+        default=["cover", "SH", "CA"],
+    )
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+    if args.full and FULL_SIZE not in args.sizes:
+        args.sizes.append(FULL_SIZE)
+
+    recorder = Recorder()
+    tracemalloc.start()
+    if "cover" in args.suites:
+        bench_cover(recorder, args.catalogues)
+    if "SH" in args.suites:
+        bench_sentinelhub(recorder, args.sizes)
+    if "CA" in args.suites:
+        bench_copernicus(recorder, args.tile_sizes, args.products)
+    tracemalloc.stop()
+
+    report = {
+        "commit": commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "cpus": os.cpu_count(),
+        "results": recorder.results,
+    }
+    if args.output:
+        with open(args.output, "w") as outfile:
+            json.dump(report, outfile, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
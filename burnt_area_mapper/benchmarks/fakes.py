@@ -0,0 +1,263 @@
+"""
+Offline stand-ins of SentinelAPI, SentinelHubRequest and SentinelHubCatalog
+serving synthetic data, and a local HTTP server standing in for the OData
+product nodes, so that the benchmarks run the real pipeline without the
+network.
+"""
+import os
+import re
+import threading
+import zipfile
+import zlib
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+import numpy as np
+import pandas as pd
+import rasterio
+import requests
+from benchmarks.synthetic import product_catalogue, write_product
+from rasterio.transform import from_bounds
+
+# days between two acquisitions of the fake catalogue
+REVISIT_DAYS = 5
+
+
+class FakeSentinelAPI:
+    """
+    Copernicus API answering queries from a synthetic product catalogue and
+    writing SAFE-like archives on download.
+    """
+
+    products = 10
+    size = 1024
+    seed = 0
+    # root of the OData API, set while a FakeProductServer runs
+    api_url = None
+    # product UUID mapped to its title, shared with FakeProductServer
+    titles = {}
+
+    def __init__(self, user=None, password=None):
+        self.catalogue = {}
+        self.downloads = []
+        self.session = requests.Session()
+
+    @classmethod
+    def configure(cls, products, size, seed=0):
+        """
+        This function sets the catalogue served by every instance
+        Inputs:
+            products: number of products returned by a query
+            size: width and height of the band images in pixels
+            seed: seed of the random generator
+        """
+        cls.products = products
+        cls.size = size
+        cls.seed = seed
+
+    def query(self, area, date, **kwargs):
+        products = product_catalogue(
+            self.products, self.size, date[0], date[1], seed=self.seed
+        )
+        self.catalogue.update(products)
+        FakeSentinelAPI.titles.update(
+            {uuid: product["title"] for uuid, product in products.items()}
+        )
+        return products
+
+    def to_dataframe(self, products):
+        return pd.DataFrame.from_dict(products, orient="index")
+
+    def download_all(self, products, directory_path="."):
+        for offset, uuid in enumerate(products):
+            write_product(
+                directory_path,
+                self.catalogue[uuid]["title"],
+                self.size,
+                seed=self.seed + 10 * offset,
+            )
+            self.downloads.append(uuid)
+        return {uuid: self.catalogue[uuid] for uuid in products}, {}, {}
+
+
+class FakeSentinelHubRequest:
+    """
+    Process API request returning a synthetic response of the requested
+    size, band count and sample type. Cloud bands are clear, so the
+    composite windows are never widened.
+    """
+
+    def __init__(
+        self,
+        evalscript,
+        input_data,
+        responses,
+        bbox,
+        size,
+        config=None,
+        data_folder=None,
+    ):
+        self.evalscript = evalscript
+        self.input = input_data[0]
+        self.bbox = bbox
+        self.size = size
+        self.data_folder = data_folder
+        request = repr((evalscript, self.input, list(bbox), size))
+        self.key = f"{zlib.crc32(request.encode()):08x}"
+
+    @staticmethod
+    def input_data(**kwargs):
+        return kwargs
+
+    @staticmethod
+    def output_response(identifier, mime_type):
+        return identifier, mime_type
+
+    def _response(self):
+        """
+        This function creates the response of the evalscript
+        Returns:
+            image: numpy ndarray of shape (height, width, bands)
+        """
+        bands = re.search(r"bands:\s*\[([^\]]*)\]", self.evalscript).group(1)
+        bands = re.findall(r"\w+", bands)
+        sample_type = re.search(r"sampleType:\s*\"(\w+)\"", self.evalscript)
+        sample_type = sample_type.group(1) if sample_type else "FLOAT32"
+        width, height = self.size
+        rng = np.random.default_rng(int(self.key, 16))
+        if sample_type == "FLOAT32":
+            image = rng.uniform(0.01, 1.0, (height, width, len(bands)))
+            image = image.astype(np.float32)
+        else:
+            image = rng.integers(1, 10000, (height, width, len(bands)))
+            image = image.astype(sample_type.lower())
+        for i, band in enumerate(bands):
+            if band in ("CLM", "CLP"):
+                image[:, :, i] = 0
+        return image
+
+    def get_data(self, save_data=False, max_threads=None):
+        image = self._response()
+        if save_data and self.data_folder is not None:
+            path = os.path.join(self.data_folder, self.get_filename_list()[0])
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with rasterio.open(
+                path,
+                "w",
+                driver="GTiff",
+                width=image.shape[1],
+                height=image.shape[0],
+                count=image.shape[2],
+                dtype=image.dtype,
+                crs="EPSG:4326",
+                transform=from_bounds(
+                    *self.bbox, image.shape[1], image.shape[0]
+                ),
+            ) as dst:
+                dst.write(np.moveaxis(image, -1, 0))
+        return [image]
+
+    def get_filename_list(self):
+        return [f"{self.key}/response.tiff"]
+
+
+class FakeSentinelHubCatalog:
+    """
+    Catalog API listing an acquisition every REVISIT_DAYS days.
+    """
+
+    def __init__(self, config=None):
+        self.config = config
+
+    def search(self, collection, bbox, time, fields=None):
+        start, end = (date.fromisoformat(str(t)[:10]) for t in time)
+        day = start
+        while day <= end:
+            yield {"properties": {"datetime": f"{day.isoformat()}T00:00:00Z"}}
+            day += timedelta(days=REVISIT_DAYS)
+
+
+class FakeProductServer:
+    """
+    Local HTTP stand-in of the OData nodes of the Copernicus API, serving
+    the manifest and files of the FakeSentinelAPI products at
+    /odata/v1/Products('<uuid>')/Nodes('<title>.SAFE')/.../$value. Every
+    product is written once as a SAFE-like archive on its first request.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.url = None
+        # bytes served per node path
+        self.served = {}
+        self._archives = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def archive(self, uuid):
+        """
+        This function returns the archive of a product, writing it once
+        Inputs:
+            uuid: product UUID
+        Returns:
+            path: path of the .zip archive
+        """
+        with self._lock:
+            if uuid not in self._archives:
+                index = int(uuid.rsplit("-", 1)[-1])
+                self._archives[uuid] = write_product(
+                    self.directory,
+                    FakeSentinelAPI.titles[uuid],
+                    FakeSentinelAPI.size,
+                    seed=FakeSentinelAPI.seed + 10 * index,
+                )
+            return self._archives[uuid]
+
+    def _serve(self, handler):
+        match = re.fullmatch(
+            r"/odata/v1/Products\('([^']+)'\)/(.+)/\$value",
+            unquote(handler.path),
+        )
+        if match is None or match.group(1) not in FakeSentinelAPI.titles:
+            handler.send_error(404)
+            return
+        uuid, nodes = match.groups()
+        name = "/".join(re.findall(r"Nodes\('([^']+)'\)", nodes))
+        try:
+            with zipfile.ZipFile(self.archive(uuid)) as archive:
+                data = archive.read(name)
+        except KeyError:
+            handler.send_error(404)
+            return
+        handler.send_response(200)
+        handler.send_header("Content-Type", "application/octet-stream")
+        handler.send_header("Content-Length", str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+        with self._lock:
+            self.served[name] = len(data)
+
+    def __enter__(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server._serve(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(
+            target=self.httpd.serve_forever, daemon=True
+        )
+        self.thread.start()
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}/"
+        FakeSentinelAPI.api_url = self.url
+        return self
+
+    def __exit__(self, *exc):
+        FakeSentinelAPI.api_url = None
+        self.httpd.shutdown()
+        self.httpd.server_close()
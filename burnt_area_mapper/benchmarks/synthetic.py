@@ -0,0 +1,226 @@
+"""
+Deterministic synthetic inputs of the benchmarks: band stacks, footprint
+catalogues and SAFE-like product archives.
+"""
+import hashlib
+import os
+import zipfile
+from datetime import datetime, timedelta
+
+import numpy as np
+from affine import Affine
+from rasterio.io import MemoryFile
+from rasterio.warp import transform_bounds
+from sentinel_sat import NBR_BANDS
+from shapely import box
+
+# product name load_raster_config reads the cop band positions of
+REFERENCE_TITLE = (
+    "S2B_MSIL2A_20230303T001109_N0509_R073_T55HGD_20230303T154543"
+)
+# UTM zone of the T55HGD tile and the upper left corner of the fake tile
+TILE_CRS = "EPSG:32755"
+TILE_ORIGIN = (600000.0, 6400000.0)
+# resolution of the R20m band images
+TILE_RES = 20.0
+
+
+def synthetic_stack(size, seed, bands=7, layout="batch"):
+    """
+    This function creates a band stack in the SentinelHub band order
+    Inputs:
+        size: width and height of the stack in pixels
+        seed: seed of the random generator
+        bands: number of bands
+        layout: "batch" for band first or "regular" for band last
+    Returns:
+        stack: uint16 numpy ndarray of DN values
+    """
+    rng = np.random.default_rng(seed)
+    shape = (bands, size, size) if layout == "batch" else (size, size, bands)
+    return rng.integers(1, 10000, size=shape, dtype=np.uint16)
+
+
+def synthetic_catalogue(n, grid=6, seed=0):
+    """
+    This function creates a catalogue of tile footprints where every tile
+    is acquired many times and some acquisitions are partial swaths
+    Inputs:
+        n: number of footprints
+        grid: tiles per side of the covered area
+        seed: seed of the random generator
+    Returns:
+        catalogue: list of dictionaries with "footprint" and "index"
+    """
+    rng = np.random.default_rng(seed)
+    catalogue = []
+    for index in range(n):
+        row, col = rng.integers(0, grid, size=2)
+        # 1 degree tiles overlapping their neighbours by 0.1 degree
+        minx, miny = col * 0.9, row * 0.9
+        maxx, maxy = minx + 1.0, miny + 1.0
+        if rng.random() < 0.3:
+            # partial swath cut at a random longitude
+            maxx = minx + rng.uniform(0.2, 0.9)
+        footprint = box(minx, miny, maxx, maxy).wkt
+        catalogue.append({"footprint": footprint, "index": str(index)})
+    return catalogue
+
+
+def tile_transform():
+    """
+    This function returns the geotransform of the fake 20 m tile
+    Returns:
+        transform: affine geotransform in TILE_CRS
+    """
+    left, top = TILE_ORIGIN
+    return Affine(TILE_RES, 0.0, left, 0.0, -TILE_RES, top)
+
+
+def tile_bounds(size):
+    """
+    This function returns the bounds of the fake tile in EPSG:4326
+    Inputs:
+        size: width and height of the tile in pixels
+    Returns:
+        bounds: (minx, miny, maxx, maxy) in degrees
+    """
+    left, top = TILE_ORIGIN
+    right, bottom = left + size * TILE_RES, top - size * TILE_RES
+    return transform_bounds(TILE_CRS, "EPSG:4326", left, bottom, right, top)
+
+
+def area_of_interest(size, margin=0.1):
+    """
+    This function returns an area of interest well inside the fake tile
+    Inputs:
+        size: width and height of the tile in pixels
+        margin: share of the tile cut off on every side
+    Returns:
+        coords: (minx, miny, maxx, maxy) in degrees
+    """
+    minx, miny, maxx, maxy = tile_bounds(size)
+    dx, dy = (maxx - minx) * margin, (maxy - miny) * margin
+    return (minx + dx, miny + dy, maxx - dx, maxy - dy)
+
+
+def product_catalogue(n, size, start_date, end_date, seed=0):
+    """
+    This function creates the query result of n products of the fake tile,
+    the first one covering the whole tile and the rest partial swaths
+    Inputs:
+        n: number of products
+        size: width and height of the tile in pixels
+        start_date: start of the sensing window
+        end_date: end of the sensing window
+        seed: seed of the random generator
+    Returns:
+        products: product UUID mapped to its SentinelAPI properties
+    """
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = tile_bounds(size)
+    start = datetime.combine(start_date, datetime.min.time())
+    days = max((end_date - start_date).days, 1)
+    products = {}
+    for index in range(n):
+        sensing = start + timedelta(days=int(rng.integers(0, days)))
+        if index == 0:
+            title = REFERENCE_TITLE
+            footprint = box(minx, miny, maxx, maxy)
+            cloud = 0.0
+        else:
+            title = (
+                f"S2A_MSIL2A_{sensing:%Y%m%dT%H%M%S}_N0509_R073_T55HGD_"
+                f"{index:015d}"
+            )
+            cut = minx + (maxx - minx) * rng.uniform(0.2, 0.9)
+            footprint = box(minx, miny, cut, maxy)
+            cloud = float(rng.uniform(0.1, 10))
+        products[f"{seed:04d}-{index:08d}"] = {
+            "title": title,
+            "size": "1.00 GB",
+            "processinglevel": "Level-2A",
+            "footprint": footprint.wkt,
+            "cloudcoverpercentage": cloud,
+            "ingestiondate": sensing + timedelta(hours=12),
+            "beginposition": sensing,
+            "endposition": sensing + timedelta(seconds=5),
+        }
+    return products
+
+
+def band_image(size, seed):
+    """
+    This function encodes a single synthetic band as an in-memory GeoTIFF
+    Inputs:
+        size: width and height of the band in pixels
+        seed: seed of the random generator
+    Returns:
+        data: bytes of the GeoTIFF
+    """
+    band = synthetic_stack(size, seed, bands=1)
+    with MemoryFile() as memfile:
+        with memfile.open(
+            driver="GTiff",
+            width=size,
+            height=size,
+            count=1,
+            dtype=band.dtype,
+            crs=TILE_CRS,
+            transform=tile_transform(),
+        ) as dst:
+            dst.write(band)
+        return memfile.read()
+
+
+def write_product(directory, title, size, seed=0, bands=NBR_BANDS):
+    """
+    This function writes a SAFE-like product archive of R20m band images.
+    The bands are GeoTIFFs named .jp2, GDAL opens them by content so the
+    pipeline reads them like the JPEG2000 originals without the encoder.
+    Inputs:
+        directory: folder the archive is written to
+        title: product name
+        size: width and height of the bands in pixels
+        seed: seed of the random generator
+        bands: band names to write
+    Returns:
+        path: path of the .zip archive
+    """
+    sensing = title.split("_")[2]
+    img_data = f"GRANULE/L2A_T55HGD_A000000_{sensing}/IMG_DATA/R20m"
+    files = {
+        f"{img_data}/T55HGD_{sensing}_{band}_20m.jp2": band_image(
+            size, seed + offset
+        )
+        for offset, band in enumerate(bands)
+    }
+    path = f"{directory}{title}.zip"
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_STORED) as archive:
+        archive.writestr(f"{title}.SAFE/manifest.safe", manifest(files))
+        for name, data in files.items():
+            archive.writestr(f"{title}.SAFE/{name}", data)
+    return path
+
+
+def manifest(files):
+    """
+    This function writes the data objects of a manifest.safe
+    Inputs:
+        files: path relative to the .SAFE mapped to the file content
+    Returns:
+        manifest: XML of the manifest
+    """
+    objects = "".join(
+        f'<dataObject ID="{os.path.basename(name)}">'
+        f'<byteStream mimeType="application/octet-stream" size="{len(data)}">'
+        f'<fileLocation locatorType="URL" href="./{name}"/>'
+        f'<checksum checksumName="MD5">{hashlib.md5(data).hexdigest()}'
+        "</checksum></byteStream></dataObject>"
+        for name, data in files.items()
+    )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<xfdu:XFDU xmlns:xfdu="urn:ccsds:schema:xfdu:1">'
+        f"<dataObjectSection>{objects}</dataObjectSection></xfdu:XFDU>"
+    )
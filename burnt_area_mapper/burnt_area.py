@@ -1,10 +1,99 @@
 import copy
 import json
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 import numpy as np
-from sentinel import Sentinel
-from sentinel_sat import Sentinel_Sat
+import rasterio
+from rasterio.transform import from_bounds
+from sentinel import (
+    CLOUD_THRESHOLD,
+    MAX_THREADS,
+    MAX_WINDOW_DAYS,
+    SH_BANDS,
+    SH_CALIBRATION,
+    Sentinel,
+)
+from sentinel_sat import GRID_RESOLUTION, Sentinel_Sat, aoi_footprint
+from utils.classification import DNBR_BREAKS, RASTER_CLASSES, classify_dnbr
+from utils.composite import Compositor
+from utils.cover import min_cover
+from utils.reflectance import dn_offsets, raster_calibration, write_calibration
+from utils.telemetry import Telemetry, staged
+from utils.util import block_windows, raster_bands, write_cog
+
+# value the water mask burns into the dNBR
+WATER_VALUE = -15
+# bounds of the SWM ratio flagged as water
+SWM_WATER_RANGE = (1.1, 5.6)
+# working bytes per pixel of a block: three float32 buffers and two boolean
+# masks of the fused kernel, the uint8 classes and the classifier bin index
+BLOCK_WORKING_BYTES = 24
+# download folder of each date, kept apart so both can run concurrently
+DATE_DIRS = {"-": "pre", "+": "post"}
+# extensions of the mosaics the LOCAL provider reads directly
+RASTER_SUFFIXES = (".tif", ".tiff")
+
+
+def _normalized_difference(a, b, out, den, valid, offsets=(0, 0)):
+    """
+    This function computes (a - b) / (a + b) into preallocated buffers,
+    the integer DN are only converted to float32 within them
+    Inputs:
+        a: first band
+        b: second band
+        out: float32 output buffer
+        den: float32 scratch buffer
+        valid: boolean scratch buffer
+        offsets: DN offsets of a and b
+    Returns:
+        out: normalized difference, NaN where a + b is zero
+    """
+    np.subtract(a, b, out=out, dtype=np.float32)
+    np.add(a, b, out=den, dtype=np.float32)
+    # pixels of no data in both bands stay invalid once offset
+    np.not_equal(den, 0, out=valid)
+    if any(offsets):
+        out += offsets[0] - offsets[1]
+        den += offsets[0] + offsets[1]
+        np.logical_and(valid, den, out=valid)
+    np.divide(out, den, out=out, where=valid)
+    np.logical_not(valid, out=valid)
+    np.copyto(out, np.nan, where=valid)
+    return out
+
+
+def _swm_water(
+    blue, green, nir, swir, num, den, valid, out, offsets=(0, 0, 0, 0)
+):
+    """
+    This function flags water with SWM = (blue + green) / (nir + swir)
+    Inputs:
+        blue, green, nir, swir: bands of a single date
+        num: float32 scratch buffer
+        den: float32 scratch buffer
+        valid: boolean scratch buffer
+        out: boolean output buffer
+        offsets: DN offsets of blue, green, nir and swir
+    Returns:
+        out: True where the SWM falls within SWM_WATER_RANGE
+    """
+    np.add(blue, green, out=num, dtype=np.float32)
+    np.add(nir, swir, out=den, dtype=np.float32)
+    np.not_equal(den, 0, out=valid)
+    if any(offsets):
+        num += offsets[0] + offsets[1]
+        den += offsets[2] + offsets[3]
+        np.logical_and(valid, den, out=valid)
+    np.divide(num, den, out=num, where=valid)
+    np.greater_equal(num, SWM_WATER_RANGE[0], out=out)
+    np.logical_and(out, valid, out=out)
+    np.less_equal(num, SWM_WATER_RANGE[1], out=valid)
+    np.logical_and(out, valid, out=out)
+    return out
 
 
 class BurntArea(Sentinel, Sentinel_Sat):
@@ -17,6 +106,15 @@ class BurntArea(Sentinel, Sentinel_Sat):
         provider,
         bands=["B12", "B8A"],
         resolution=60,
+        class_breaks=DNBR_BREAKS,
+        lazy=False,
+        extract="all",
+        store=None,
+        composite=None,
+        download_workers=MAX_THREADS,
+        local_paths=None,
+        telemetry=None,
+        download_mode="product",
     ) -> None:
         self.sentinel = Sentinel()
         self.config = self.sentinel._auth()
@@ -27,6 +125,20 @@ class BurntArea(Sentinel, Sentinel_Sat):
         self.provider = provider
         self.bands = bands
         self.resolution = resolution
+        self.image_paths = {}
+        self.class_breaks = class_breaks
+        self.lazy = lazy
+        self.extract = extract
+        self.store = store
+        self.composite = composite
+        self.max_threads = download_workers
+        self.local_paths = local_paths or {}
+        self.download_mode = download_mode
+        # band names of each date's imagery in band order
+        self.band_orders = {}
+        # scale and offset of each date's bands
+        self.band_calibrations = {}
+        self.telemetry = telemetry or Telemetry()
 
     def recalibrate_time(self, time, action, days_to_subtract=7):
         """
@@ -50,72 +162,274 @@ class BurntArea(Sentinel, Sentinel_Sat):
             "No es buone de nada!"
         return start_date, end_date, days_to_subtract
 
-    def download_fire(self, time, action, days_sub=7):
+    def download_fire(self, time, action, days_sub=7, read=True):
         """
         This is a process function for download of imagery
         Inputs:
             time: initial time
             action: whether it is pre or post time
             days_sub: number of days for composite creation
+            read: whether to return the imagery or only its image_paths
         Returns:
-            image: final imagery
+            image: final imagery or None without read
             download_type: regular or batch download
         """
-        start_date, end_date, days_sub = self.recalibrate_time(
-            time, action, days_sub
-        )
+        self.band_orders[action] = SH_BANDS
+        self.band_calibrations[action] = SH_CALIBRATION
+        # stored windows were cloud checked already, no probe is needed
+        for days in range(days_sub, MAX_WINDOW_DAYS + 1, 7):
+            start_date, end_date, _ = self.recalibrate_time(time, action, days)
+            stored = self._stored_window(start_date, end_date, action, read)
+            if stored is not None:
+                return stored
+        start_date, end_date = self.clear_window(time, action, days_sub)
         image, download_type = self._get_imagery(
             start_date=start_date,
             end_date=end_date,
             coords=self.coords,
             action=action,
+            read=read,
         )
-        if image == "recalibrate":
-            days_sub += 7
-            self.download_fire(time, action, days_sub)
         return image, download_type
 
-    def download_sentinelsat_fire(self, time, action, days_sub=7):
+    def clear_window(self, time, action, days_sub=7, max_days=MAX_WINDOW_DAYS):
+        """
+        This function widens the composite window by 7 days at a time
+        until a coarse cloud probe is below the cloud threshold
+        Inputs:
+            time: initial time
+            action: whether it is pre or post time
+            days_sub: number of days for composite creation
+            max_days: widest window to probe
+        Returns:
+            start_date: start date of composite
+            end_date: end date of composite
+        """
+        while True:
+            start_date, end_date, days_sub = self.recalibrate_time(
+                time, action, days_sub
+            )
+            percentage_cloud = self._probe_clouds(start_date, end_date)
+            if percentage_cloud <= CLOUD_THRESHOLD:
+                return start_date, end_date
+            if days_sub + 7 > max_days:
+                print(
+                    f"Still {percentage_cloud:.1f}% cloud after {days_sub} "
+                    "days, using the widest window"
+                )
+                return start_date, end_date
+            days_sub += 7
+
+    @staged()
+    def download_composite(
+        self, time, action, days_sub=7, max_days=MAX_WINDOW_DAYS, read=True
+    ):
+        """
+        This is a process function for a per pixel cloud-free composite of
+        all acquisitions of the window; when the window is widened only the
+        new acquisitions are fetched and merged
+        Inputs:
+            time: initial time
+            action: whether it is pre or post time
+            days_sub: number of days for composite creation
+            max_days: widest window to composite
+            read: whether to return the imagery or only its image_paths
+        Returns:
+            image: composite imagery or None without read
+            download_type: regular download
+        """
+        bbox = self._get_bbox()
+        width, height = self._get_size(bbox)
+        if height > 2500:
+            print("Area too large for compositing, downloading a mosaic")
+            return self.download_fire(time, action, days_sub, read=read)
+        compositor = Compositor(method=self.composite)
+        while True:
+            start_date, end_date, days_sub = self.recalibrate_time(
+                time, action, days_sub
+            )
+            for date in self._acquisition_dates(start_date, end_date):
+                if date not in compositor.dates:
+                    compositor.add(self._get_acquisition(date), date)
+            percentage_cloud = compositor.cloud_percentage()
+            if percentage_cloud <= CLOUD_THRESHOLD or days_sub + 7 > max_days:
+                break
+            days_sub += 7
+        print(
+            f"Composite of {len(compositor.dates)} acquisitions, "
+            f"{percentage_cloud:.1f}% without a clear observation"
+        )
+        image = compositor.result()
+        # kept on disk as well for the block-wise engine
+        path = f"./data/composite_{DATE_DIRS[action]}_{start_date}.tiff"
+        with rasterio.open(
+            path,
+            "w",
+            driver="GTiff",
+            width=width,
+            height=height,
+            count=image.shape[2],
+            dtype=image.dtype,
+            crs="EPSG:4326",
+            transform=from_bounds(*bbox, width, height),
+            tiled=True,
+            compress="deflate",
+        ) as dst:
+            dst.write(np.moveaxis(image, -1, 0))
+            dst.descriptions = SH_BANDS
+            write_calibration(dst, SH_CALIBRATION)
+        self.image_paths[action] = path
+        self.band_orders[action] = SH_BANDS
+        self.band_calibrations[action] = SH_CALIBRATION
+        if not read:
+            return None, "regular"
+        return image, "regular"
+
+    def download_sentinelsat_fire(self, time, action, days_sub=7, read=True):
         """
         This is a process function for download of imagery
         Inputs:
             time: initial time
             action: whether it is pre or post time
             days_sub: number of days for composite creation
+            read: whether to return the imagery or only its image_paths
         Returns:
-            image: final imagery
+            image: final imagery or None without read
             download_type: regular or batch download
         """
         start_date, end_date, days_sub = self.recalibrate_time(
             time, action, days_sub
         )
-        self.apis = Sentinel_Sat(
-            start_date=start_date, end_date=end_date, input_file=self.coords
+        apis = Sentinel_Sat(
+            start_date=start_date,
+            end_date=end_date,
+            input_file=self.coords,
+            lazy=self.lazy,
+            extract=self.extract,
+            dl_dir=f"{os.getcwd()}/data/{DATE_DIRS[action]}/",
+            store=self.store,
+            telemetry=self.telemetry.scoped(DATE_DIRS[action]),
+            download=self.download_mode,
+            read=read,
         )
-        image, download_type = self.apis.ss_process()
+        image, download_type = apis.ss_process()
+        self.image_paths[action] = apis.MERGED_REGION
+        self.band_orders[action] = apis.band_order
+        self.band_calibrations[action] = apis.band_calibration
         if image == "recalibrate":
             days_sub += 7
-            self.download_sentinelsat_fire(time, action, days_sub)
+            self.download_sentinelsat_fire(time, action, days_sub, read)
         return image, download_type
 
-    def calc_ba(self, image, download_type):
+    @staged()
+    def download_local(
+        self, time, action, days_sub=MAX_WINDOW_DAYS, read=True
+    ):
+        """
+        This is a process function reading already downloaded imagery,
+        either the paths given for the date or the scene store
+        Inputs:
+            time: initial time
+            action: whether it is pre or post time
+            days_sub: number of days searched in the scene store
+            read: whether to return the imagery or only its image_paths
+        Returns:
+            image: final imagery or None without read
+            download_type: batch for SentinelHub mosaics, cop otherwise
+        """
+        start_date, end_date, days_sub = self.recalibrate_time(
+            time, action, days_sub
+        )
+        sources = self.local_paths.get(action)
+        if sources is None:
+            sources = self._stored_sources(start_date, end_date, action)
+        elif isinstance(sources, (str, os.PathLike)):
+            sources = [sources]
+        sources = [str(source) for source in sources]
+        bands, calibration = None, None
+        if len(sources) == 1 and sources[0].endswith(RASTER_SUFFIXES):
+            bands = raster_bands(sources[0])
+            calibration = raster_calibration(sources[0])
+            with rasterio.open(sources[0]) as src:
+                count = src.count
+            if bands is None and count == len(SH_BANDS):
+                # responses saved by SentinelHub carry no band names
+                bands = SH_BANDS
+            if calibration is None and bands == SH_BANDS:
+                calibration = SH_CALIBRATION
+        mosaic = bands is not None and "CLM" in bands
+        apis = Sentinel_Sat(
+            start_date=start_date,
+            end_date=end_date,
+            input_file=self.coords,
+            dl_dir=f"{os.getcwd()}/data/{DATE_DIRS[action]}/",
+            telemetry=self.telemetry.scoped(DATE_DIRS[action]),
+            # SentinelHub mosaics keep their 10 m pixels
+            resolution=10 if mosaic else GRID_RESOLUTION,
+            read=read,
+        )
+        if len(sources) == 1 and sources[0].endswith(RASTER_SUFFIXES):
+            # warped onto the grid of the area so both dates line up
+            image = apis.phase_raster(sources[0], bands, calibration)
+        else:
+            image = apis.phase_local(sources)
+        self.image_paths[action] = apis.MERGED_REGION
+        self.band_orders[action] = apis.band_order
+        self.band_calibrations[action] = apis.band_calibration
+        if mosaic:
+            return image, "batch"
+        return image, "cop"
+
+    def _stored_sources(self, start_date, end_date, action):
+        """
+        This function picks the stored scenes of a date closest to the fire:
+        a cover of the stored products, or else a single stored mosaic
+        Inputs:
+            start_date: start date of the window
+            end_date: end date of the window
+            action: whether it is pre or post time
+        Returns:
+            sources: paths of the stored scenes
+        """
+        if self.store is None:
+            raise ValueError(
+                "The LOCAL provider needs the paths of each date or a store"
+            )
+        scenes, _ = self.store.covered(
+            aoi_footprint(self.coords), start_date, end_date
+        )
+        if action == "-":
+            # the latest acquisitions before the fire come first
+            scenes = scenes[::-1]
+        products = [x for x in scenes if x["path"].endswith(".zip")]
+        if len(products) > 0:
+            return [x["path"] for x in min_cover(products)]
+        if len(scenes) > 0:
+            return [scenes[0]["path"]]
+        raise FileNotFoundError(
+            f"No stored scenes between {start_date} and {end_date}"
+        )
+
+    def calc_ba(self, image, download_type, calibration=None):
         """
         This function calculates the burnt area
         Inputs:
             image: numpy ndarray image
             download_type: whether batch or single download
+            calibration: scale and offset of the bands in band order
         Returns:
             ba: burned area
         """
-        if download_type == "cop":
-            band_load = self.load_raster_config()
-            nir_band_ind = band_load["B8A"]
-            swir_band_ind = band_load["B11"]
-            NIR = self.get_band(image, nir_band_ind, download_type)
-            SWIR = self.get_band(image, swir_band_ind, download_type)
-        else:
-            NIR = self.get_band(image, 1, download_type).astype(np.int8)
-            SWIR = self.get_band(image, 2, download_type).astype(np.int8)
+        indices = self._band_indices(download_type)
+        offsets = self._band_offsets(indices, calibration)
+        NIR = self.get_band(image, indices["nir"], download_type).astype(
+            np.float32
+        )
+        SWIR = self.get_band(image, indices["nbr_swir"], download_type).astype(
+            np.float32
+        )
+        NIR += offsets["nir"]
+        SWIR += offsets["nbr_swir"]
         ba = (NIR - SWIR) / (NIR + SWIR)
         return ba
 
@@ -150,34 +464,28 @@ class BurntArea(Sentinel, Sentinel_Sat):
         dnbr = pre - post
         return dnbr
 
-    def _get_water_mask(self, image, download_type):
+    def _get_water_mask(self, image, download_type, calibration=None):
         """
         This function calculates the water mask as NDWI
         Inputs:
             image: numpy ndarray image with several bands
             download_type: whether download was regular or batch
+            calibration: scale and offset of the bands in band order
         Returns:
             water_mask: numpy ndarray water mask
         """
-        # print(np.unique(image, return_counts=True))
-        if download_type == "cop":
-            band_load = self.load_raster_config()
-            green_band_ind = band_load["B03"]
-            print(green_band_ind)
-            blue_band_ind = band_load["B02"]
-            nir_band_ind = band_load["B8A"]
-            swir_band_ind = band_load["B11"]
-            GREEN = self.get_band(image, green_band_ind, download_type)
-            NIR = self.get_band(image, nir_band_ind, download_type)
-            # ndwi = (GREEN - NIR) / (GREEN + NIR)
-            BLUE = self.get_band(image, blue_band_ind, download_type)
-            SWIR = self.get_band(image, swir_band_ind, download_type)
-        else:
-            GREEN = self.get_band(image, 0, download_type).astype(np.int8)
-            NIR = self.get_band(image, 1, download_type).astype(np.int8)
-            # ndwi = (GREEN - NIR) / (GREEN + NIR)
-            BLUE = self.get_band(image, 5, download_type).astype(np.int8)
-            SWIR = self.get_band(image, 6, download_type).astype(np.int8)
+        indices = self._band_indices(download_type)
+        offsets = self._band_offsets(indices, calibration)
+
+        def band(name):
+            value = self.get_band(image, indices[name], download_type)
+            return value.astype(np.float32) + offsets[name]
+
+        GREEN = band("green")
+        NIR = band("nir")
+        # ndwi = (GREEN - NIR) / (GREEN + NIR)
+        BLUE = band("blue")
+        SWIR = band("swir")
         swm = (BLUE + GREEN) / (NIR + SWIR)
         swm_water_mask = copy.copy(swm)
         swm_water_mask[(swm >= 1.1) & (swm <= 5.6)] = -15
@@ -217,40 +525,33 @@ class BurntArea(Sentinel, Sentinel_Sat):
         final_image = final_image.filled(fill_value=-15)
         return final_image
 
-    def apply_final_classification(self, image):
+    @staged()
+    def apply_final_classification(self, image, write_config=True):
         """
         This function applies the final classification of burned areas.
         Inputs:
             image: image to classify
+            write_config: whether to write the classification json
         Returns:
             image_reclass: reclassified image
         """
-        image_reclass = copy.copy(image)
-        # image_reclass[np.where(image == -15)] = 100
-        image_reclass[np.where((image > -300) & (image <= -13))] = 50
-        image_reclass[np.where((image >= -14.00) & (image <= -0.251))] = 2
-        image_reclass[np.where((image > -0.250) & (image <= -0.101))] = 3
-        image_reclass[np.where((image > -0.100) & (image <= 0.09))] = 4
-        image_reclass[np.where((image > 0.100) & (image <= 0.269))] = 5
-        image_reclass[np.where((image > 0.270) & (image <= 0.439))] = 6
-        image_reclass[np.where((image > 0.440) & (image <= 0.659))] = 7
-        image_reclass[np.where((image > 0.660) & (image <= 40.300))] = 8
-        image_reclass[np.where(image > 40)] = 60
-        image_reclass[np.where(image_reclass == 50)] = 1
-        raster_dict = {
-            "1": "Water",
-            "2": "Enhanced regrowth, high (post-fire)",
-            "3": "Enhanced regrowth, low (post-fire)",
-            "4": "Unburned",
-            "5": "Low Severity",
-            "6": "Moderate-low Severity",
-            "7": "Moderate-high Severity",
-            "8": "High Severity",
-            "60": "Unclassified",
-        }
-        self.write_raster_config("raster_classification", raster_dict)
+        self.telemetry.count("pixels", image.size)
+        image_reclass = self._classify(image)
+        if write_config:
+            self.write_raster_config("raster_classification", RASTER_CLASSES)
         return image_reclass
 
+    def _classify(self, image):
+        """
+        This function applies the final classification to a block, without
+        a stage of its own so blocks add no record each
+        Inputs:
+            image: image to classify
+        Returns:
+            image_reclass: reclassified image
+        """
+        return classify_dnbr(image, breaks=self.class_breaks)
+
     def write_raster_config(self, name, config_dict):
         """
         This function writes the raster configuration.
@@ -261,37 +562,399 @@ class BurntArea(Sentinel, Sentinel_Sat):
         with open(f"./data/{name}.json", "w") as outfile:
             json.dump(config_dict, outfile)
 
+    def _band_indices(self, download_type, bands=None):
+        """
+        This function resolves the band positions used by the fused kernel
+        Inputs:
+            download_type: whether download was regular, batch or cop
+            bands: band names of the imagery in band order, if known
+        Returns:
+            indices: band position of green, blue, nir and both swir bands
+        """
+        if bands is not None:
+            position = {band: i for i, band in enumerate(bands)}
+            # the cop NBR uses B11, as in the load_raster_config branch below
+            nbr_swir = "B11" if download_type == "cop" else "B12"
+            return {
+                "green": position["B03"],
+                "blue": position["B02"],
+                "nir": position["B8A"],
+                "swir": position["B11"],
+                "nbr_swir": position[nbr_swir],
+            }
+        if download_type == "cop":
+            band_load = self.load_raster_config()
+            return {
+                "green": band_load["B03"],
+                "blue": band_load["B02"],
+                "nir": band_load["B8A"],
+                "swir": band_load["B11"],
+                "nbr_swir": band_load["B11"],
+            }
+        return {"green": 0, "nir": 1, "nbr_swir": 2, "blue": 5, "swir": 6}
+
+    def _band_offsets(self, indices, calibration=None):
+        """
+        This function resolves the DN offsets of the bands used by the
+        kernels, e.g. -1000 for products of baseline 04.00 and later
+        Inputs:
+            indices: band positions of _band_indices
+            calibration: scale and offset of the bands in band order
+        Returns:
+            offsets: band of indices mapped to its DN offset
+        """
+        offsets = dn_offsets(calibration)
+        if offsets is None:
+            return {name: 0 for name in indices}
+        return {name: offsets[i] for name, i in indices.items()}
+
+    def fused_dnbr(
+        self, pre, post, download_type, bands=None, calibrations=(None, None)
+    ):
+        """
+        This function computes the water masked dNBR of the pre and post
+        fire stacks in one pass over preallocated float32 buffers, it
+        replaces the calc_ba, calc_dnbr, _get_water_mask and
+        apply_water_mask chain
+        Inputs:
+            pre: pre fire numpy ndarray image with several bands
+            post: post fire numpy ndarray image with several bands
+            download_type: whether download was regular, batch or cop
+            bands: band names of both stacks in band order, if known
+            calibrations: scale and offset of the pre and post bands
+        Returns:
+            dnbr: float32 dNBR with water set to WATER_VALUE
+        """
+        indices = self._band_indices(download_type, bands)
+        pre_offsets = self._band_offsets(indices, calibrations[0])
+        post_offsets = self._band_offsets(indices, calibrations[1])
+
+        def band(image, name):
+            return self.get_band(image, indices[name], download_type)
+
+        shape = band(pre, "nir").shape
+        dnbr = np.empty(shape, dtype=np.float32)
+        num = np.empty(shape, dtype=np.float32)
+        den = np.empty(shape, dtype=np.float32)
+        valid = np.empty(shape, dtype=bool)
+        water = np.empty(shape, dtype=bool)
+
+        # pre fire NBR straight into the output, post fire NBR subtracted
+        _normalized_difference(
+            band(pre, "nir"),
+            band(pre, "nbr_swir"),
+            dnbr,
+            den,
+            valid,
+            (pre_offsets["nir"], pre_offsets["nbr_swir"]),
+        )
+        _normalized_difference(
+            band(post, "nir"),
+            band(post, "nbr_swir"),
+            num,
+            den,
+            valid,
+            (post_offsets["nir"], post_offsets["nbr_swir"]),
+        )
+        np.subtract(dnbr, num, out=dnbr)
+        _swm_water(
+            band(pre, "blue"),
+            band(pre, "green"),
+            band(pre, "nir"),
+            band(pre, "swir"),
+            num,
+            den,
+            valid,
+            water,
+            tuple(pre_offsets[x] for x in ("blue", "green", "nir", "swir")),
+        )
+        np.copyto(dnbr, WATER_VALUE, where=water)
+        return dnbr
+
+    @staged()
+    def date_stage(
+        self,
+        image,
+        download_type,
+        water_mask=False,
+        bands=None,
+        calibration=None,
+    ):
+        """
+        This function computes the per date part of the dNBR so that it can
+        run as soon as the imagery of that date is downloaded
+        Inputs:
+            image: numpy ndarray image with several bands
+            download_type: whether download was regular, batch or cop
+            water_mask: whether to compute the SWM water mask as well
+            bands: band names of the image in band order, if known
+            calibration: scale and offset of the bands in band order
+        Returns:
+            nbr: float32 normalized burn ratio
+            water: boolean water mask or None
+        """
+        indices = self._band_indices(download_type, bands)
+        offsets = self._band_offsets(indices, calibration)
+
+        def band(name):
+            return self.get_band(image, indices[name], download_type)
+
+        shape = band("nir").shape
+        nbr = np.empty(shape, dtype=np.float32)
+        den = np.empty(shape, dtype=np.float32)
+        valid = np.empty(shape, dtype=bool)
+        self.telemetry.count("pixels", nbr.size)
+        _normalized_difference(
+            band("nir"),
+            band("nbr_swir"),
+            nbr,
+            den,
+            valid,
+            (offsets["nir"], offsets["nbr_swir"]),
+        )
+        water = None
+        if water_mask:
+            water = np.empty(shape, dtype=bool)
+            num = np.empty(shape, dtype=np.float32)
+            _swm_water(
+                band("blue"),
+                band("green"),
+                band("nir"),
+                band("swir"),
+                num,
+                den,
+                valid,
+                water,
+                tuple(offsets[x] for x in ("blue", "green", "nir", "swir")),
+            )
+        return nbr, water
+
+    @staged()
     def nbr_process(self):
         """
         This is a process function to follow the normalized burn ratio algorithm
+
+        Both dates are downloaded concurrently and each date's NBR (and the
+        pre fire water mask) is computed as soon as its imagery lands, so
+        only the dNBR and the classification wait for the slower download.
         Returns:
             final_image: normalized burn ratio ndarray
         """
-        pre_fire, post_fire, download_type = self.download_imagery()
-        pre_water_mask = self._get_water_mask(pre_fire, download_type)
-        _ = self._get_water_mask(post_fire, download_type)
-        pre_fire_index = self.calc_ba(pre_fire, download_type)
-        post_fire_index = self.calc_ba(post_fire, download_type)
-        final_image = self.calc_dnbr(pre_fire_index, post_fire_index)
-        image_masked = self.apply_water_mask(final_image, pre_water_mask)
-        classified = self.apply_final_classification(image_masked)
+        ready = queue.Queue()
+
+        def produce(action):
+            try:
+                ready.put((action, self._download(action)))
+            except Exception as e:
+                ready.put((action, e))
+
+        stages = {}
+        with ThreadPoolExecutor(max_workers=len(DATE_DIRS)) as executor:
+            for action in DATE_DIRS:
+                executor.submit(produce, action)
+            for _ in DATE_DIRS:
+                action, result = ready.get()
+                if isinstance(result, Exception):
+                    raise result
+                image, download_type = result
+                stages[action] = self.date_stage(
+                    image,
+                    download_type,
+                    water_mask=action == "-",
+                    bands=self.band_orders.get(action),
+                    calibration=self.band_calibrations.get(action),
+                )
+                del image, result
+        (dnbr, water), (post_nbr, _) = stages["-"], stages["+"]
+        np.subtract(dnbr, post_nbr, out=dnbr)
+        np.copyto(dnbr, WATER_VALUE, where=water)
+        del stages, post_nbr, water
+        classified = self.apply_final_classification(dnbr)
         return classified
 
-    def download_imagery(self):
-        if self.provider == "CA":
-            pre_fire, download_type = self.download_sentinelsat_fire(
-                time=self.fire_start, action="-"
-            )
-            post_fire, download_type = self.download_sentinelsat_fire(
-                time=self.fire_end, action="+"
-            )
-        elif self.provider == "SH":
-            pre_fire, download_type = self.download_fire(
-                time=self.fire_start, action="-"
-            )
-            post_fire, download_type = self.download_fire(
-                time=self.fire_end, action="+"
+    def _process_block(
+        self, pre, post, download_type, bands=None, calibrations=(None, None)
+    ):
+        """
+        This function runs the normalized burn ratio chain on a single block
+        Inputs:
+            pre: pre fire band stack of the block
+            post: post fire band stack of the block
+            download_type: band layout of the stacks
+            bands: band names of the stacks in band order, if known
+            calibrations: scale and offset of the pre and post bands
+        Returns:
+            classified: classified block
+        """
+        image_masked = self.fused_dnbr(
+            pre, post, download_type, bands, calibrations
+        )
+        classified = self._classify(image_masked)
+        return classified
+
+    @staged()
+    def nbr_process_windowed(
+        self,
+        memory_budget,
+        workers=None,
+        filename="./data/output.tiff",
+        compress="DEFLATE",
+    ):
+        """
+        This is a process function to follow the normalized burn ratio
+        algorithm block by block instead of on the full stacks
+        Inputs:
+            memory_budget: working memory in bytes shared by all workers
+            workers: number of threads, defaults to the cpu count
+            filename: path of the output GeoTIFF
+            compress: compression of the output, DEFLATE or ZSTD
+        Returns:
+            filename: path of the classified GeoTIFF
+        """
+        # only the paths, the blocks are read from the files
+        _, _, download_type = self.download_imagery(read=False)
+        if download_type == "regular":
+            # the saved SentinelHub response is read band first from disk
+            download_type = "batch"
+        return self.process_rasters(
+            pre_path=self.image_paths["-"],
+            post_path=self.image_paths["+"],
+            download_type=download_type,
+            memory_budget=memory_budget,
+            workers=workers,
+            filename=filename,
+            compress=compress,
+        )
+
+    @staged()
+    def process_rasters(
+        self,
+        pre_path,
+        post_path,
+        download_type,
+        memory_budget,
+        workers=None,
+        filename="./data/output.tiff",
+        compress="DEFLATE",
+    ):
+        """
+        This function reads matching windows of the pre and post fire
+        mosaics, classifies them across a thread pool and writes every
+        block straight into a scratch raster, converted to a Cloud-Optimized
+        GeoTIFF at the end
+        Inputs:
+            pre_path: path of the pre fire mosaic
+            post_path: path of the post fire mosaic
+            download_type: band layout of the mosaics
+            memory_budget: working memory in bytes shared by all workers
+            workers: number of threads, defaults to the cpu count
+            filename: path of the output GeoTIFF
+            compress: compression of the output, DEFLATE or ZSTD
+        Returns:
+            filename: path of the classified GeoTIFF
+        """
+        workers = workers or os.cpu_count() or 1
+        scratch = f"{filename}.tmp.tif"
+        bands = raster_bands(pre_path) or self.band_orders.get("-")
+        calibrations = tuple(
+            raster_calibration(path) or self.band_calibrations.get(action)
+            for path, action in ((pre_path, "-"), (post_path, "+"))
+        )
+        read_lock = threading.Lock()
+        write_lock = threading.Lock()
+        with rasterio.open(pre_path) as pre_src, rasterio.open(
+            post_path
+        ) as post_src:
+            if pre_src.shape != post_src.shape:
+                raise ValueError(
+                    f"Pre {pre_src.shape} and post {post_src.shape} fire "
+                    "mosaics are not on the same grid"
+                )
+            # counted once, the blocks are classified without a stage
+            self.telemetry.count("pixels", pre_src.width * pre_src.height)
+            itemsize = np.dtype(pre_src.dtypes[0]).itemsize
+            bytes_per_pixel = (
+                pre_src.count + post_src.count
+            ) * itemsize + BLOCK_WORKING_BYTES
+            windows = block_windows(
+                width=pre_src.width,
+                height=pre_src.height,
+                bytes_per_pixel=bytes_per_pixel,
+                memory_budget=memory_budget // workers,
+                align=256,
             )
-        else:
-            print("No specified provider!")
+            profile = {
+                "driver": "GTiff",
+                "width": pre_src.width,
+                "height": pre_src.height,
+                "count": 1,
+                "dtype": "uint8",
+                "crs": pre_src.crs,
+                "transform": pre_src.transform,
+                "tiled": True,
+                "blockxsize": 256,
+                "blockysize": 256,
+                "compress": "deflate",
+            }
+            with rasterio.open(scratch, "w", **profile) as dst:
+
+                def run(window):
+                    with read_lock:
+                        pre = pre_src.read(window=window)
+                        post = post_src.read(window=window)
+                    block = self._process_block(
+                        pre, post, download_type, bands, calibrations
+                    )
+                    with write_lock:
+                        dst.write(block, 1, window=window)
+
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    list(executor.map(run, windows))
+        write_cog(scratch, filename, compress=compress)
+        self.write_raster_config("raster_classification", RASTER_CLASSES)
+        return filename
+
+    def _download(self, action, read=True):
+        """
+        This function downloads the imagery of a single date
+        Inputs:
+            action: "-" for the pre fire and "+" for the post fire date
+            read: whether to return the imagery or only its image_paths
+        Returns:
+            image: final imagery or None without read
+            download_type: regular, batch or cop download
+        """
+        time = self.fire_start if action == "-" else self.fire_end
+        with self.telemetry.stage(f"download.{DATE_DIRS[action]}"):
+            if self.provider == "CA":
+                return self.download_sentinelsat_fire(
+                    time=time, action=action, read=read
+                )
+            elif self.provider == "SH" and self.composite:
+                return self.download_composite(
+                    time=time, action=action, read=read
+                )
+            elif self.provider == "SH":
+                return self.download_fire(time=time, action=action, read=read)
+            elif self.provider == "LOCAL":
+                return self.download_local(time=time, action=action, read=read)
+        raise ValueError(f"No specified provider! Got {self.provider}")
+
+    @staged()
+    def download_imagery(self, read=True):
+        """
+        This function downloads the pre and post fire imagery concurrently
+        Inputs:
+            read: whether to return the imagery or only record image_paths,
+            so that the imagery is never held in memory as a whole
+        Returns:
+            pre_fire: pre fire imagery or None without read
+            post_fire: post fire imagery or None without read
+            download_type: regular, batch or cop download
+        """
+        with ThreadPoolExecutor(max_workers=len(DATE_DIRS)) as executor:
+            pre = executor.submit(self._download, "-", read)
+            post = executor.submit(self._download, "+", read)
+            pre_fire, download_type = pre.result()
+            post_fire, download_type = post.result()
         return pre_fire, post_fire, download_type
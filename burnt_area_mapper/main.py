@@ -4,16 +4,44 @@ from typing import Optional, Tuple
 
 import typer
 from burnt_area import BurntArea
+from utils.classification import DNBR_BREAKS
 from utils.io import GeospatialRead
+from utils.scene_store import SceneStore
+from utils.telemetry import Telemetry
+from utils.tiles import export_tiles
 from utils.typer import (
+    OPTION_CLASS_BREAKS,
+    OPTION_COMPOSITE,
+    OPTION_COMPRESS,
     OPTION_COORDS,
     OPTION_DOWNLOAD_BY,
+    OPTION_DOWNLOAD_MODE,
+    OPTION_DOWNLOAD_WORKERS,
     OPTION_END_DATE,
+    OPTION_EXTRACT,
     OPTION_GDF_BOUNDS,
     OPTION_GDF_PATH,
+    OPTION_LAZY,
+    OPTION_LOCAL_POST,
+    OPTION_LOCAL_PRE,
+    OPTION_MAX_ZOOM,
+    OPTION_MEMORY_BUDGET,
+    OPTION_PROFILE,
+    OPTION_PROMETHEUS,
+    OPTION_SIEVE,
+    OPTION_SIMPLIFY,
     OPTION_START_DATE,
+    OPTION_STORE_DIR,
+    OPTION_STORE_SIZE,
+    OPTION_TILES,
+    OPTION_VECTORS,
+    OPTION_WORKERS,
+    OPTION_ZONAL_OUTPUT,
+    OPTION_ZONES,
 )
 from utils.util import array2raster, plot_burn_severity, read_band_image
+from utils.vectorize import vectorize
+from utils.zonal import ZONAL_BUDGET, write_zonal_stats
 
 
 def main(
@@ -23,43 +51,129 @@ def main(
     coords: Optional[Tuple[float, float, float, float]] = OPTION_COORDS,
     gdf_bounds: Optional[bool] = OPTION_GDF_BOUNDS,
     gdf_path: Optional[Path] = OPTION_GDF_PATH,
+    memory_budget: Optional[int] = OPTION_MEMORY_BUDGET,
+    workers: Optional[int] = OPTION_WORKERS,
+    class_breaks: Optional[str] = OPTION_CLASS_BREAKS,
+    lazy: Optional[bool] = OPTION_LAZY,
+    extract: str = OPTION_EXTRACT,
+    download_mode: str = OPTION_DOWNLOAD_MODE,
+    store_dir: Optional[Path] = OPTION_STORE_DIR,
+    store_size: float = OPTION_STORE_SIZE,
+    composite: Optional[str] = OPTION_COMPOSITE,
+    download_workers: int = OPTION_DOWNLOAD_WORKERS,
+    local_pre: Optional[Path] = OPTION_LOCAL_PRE,
+    local_post: Optional[Path] = OPTION_LOCAL_POST,
+    profile: bool = OPTION_PROFILE,
+    prometheus: Optional[Path] = OPTION_PROMETHEUS,
+    compress: str = OPTION_COMPRESS,
+    tiles: Optional[Path] = OPTION_TILES,
+    max_zoom: Optional[int] = OPTION_MAX_ZOOM,
+    zones: Optional[Path] = OPTION_ZONES,
+    zonal_output: Path = OPTION_ZONAL_OUTPUT,
+    vectors: Optional[Path] = OPTION_VECTORS,
+    simplify: Optional[float] = OPTION_SIMPLIFY,
+    sieve_size: Optional[int] = OPTION_SIEVE,
 ) -> None:
-    if gdf_bounds:
-        file = GeospatialRead(gdf_path)._read_file()
-        final_image = BurntArea(
-            fire_start=start_date,
-            fire_end=end_date,
-            imagery="Sentinel",
-            coords=file,
-            provider=download_by,
-        ).nbr_process()
-        if download_by == "CA":
-            (_, crs, geoTransform, _) = read_band_image(
-                path="./data/sentinel/"
-            )
-        else:
-            (_, crs, geoTransform, _) = read_band_image()
-    else:
-        final_image = BurntArea(
+    telemetry = Telemetry(profile=profile)
+    # entries of the run report besides the telemetry
+    report = {}
+    try:
+        if gdf_bounds:
+            coords = GeospatialRead(gdf_path)._read_file()
+        burnt_area = BurntArea(
             fire_start=start_date,
             fire_end=end_date,
             imagery="Sentinel",
             coords=coords,
             provider=download_by,
-        ).nbr_process()
-        if download_by == "CA":
-            (_, crs, geoTransform, _) = read_band_image(
-                path="./data/sentinel/"
+            class_breaks=(
+                tuple(float(x) for x in class_breaks.split(","))
+                if class_breaks
+                else DNBR_BREAKS
+            ),
+            lazy=lazy,
+            extract=extract,
+            download_mode=download_mode,
+            store=(
+                SceneStore(store_dir, max_bytes=int(store_size * 1024**3))
+                if store_dir
+                else None
+            ),
+            composite=composite,
+            download_workers=download_workers,
+            local_paths={
+                action: path
+                for action, path in (("-", local_pre), ("+", local_post))
+                if path is not None
+            },
+            telemetry=telemetry,
+        )
+        if memory_budget:
+            # blocks go straight to disk, the full raster is never held
+            burnt_area.nbr_process_windowed(
+                memory_budget=memory_budget * 1024**2,
+                workers=workers,
+                filename="./data/output.tiff",
+                compress=compress,
             )
+            # the quicklook is read from the overviews of the COG output
+            final_image = "./data/output.tiff"
         else:
-            (_, crs, geoTransform, _) = read_band_image()
-    _ = array2raster(
-        array=final_image,
-        projection=crs,
-        filename="./data/output.tiff",
-        geoTransform=geoTransform,
-    )
-    plot_burn_severity(image=final_image, name=f"Fire_{start_date}_{end_date}")
+            final_image = burnt_area.nbr_process()
+            with telemetry.stage("array2raster"):
+                (_, crs, geoTransform, _) = read_band_image(
+                    filename=burnt_area.image_paths["-"]
+                )
+                _ = array2raster(
+                    array=final_image,
+                    projection=crs,
+                    filename="./data/output.tiff",
+                    geoTransform=geoTransform,
+                    compress=compress,
+                )
+        with telemetry.stage("plot_burn_severity"):
+            plot_burn_severity(
+                image=final_image, name=f"Fire_{start_date}_{end_date}"
+            )
+        if tiles:
+            with telemetry.stage("export_tiles"):
+                summary = export_tiles(
+                    "./data/output.tiff",
+                    tiles,
+                    max_zoom=max_zoom,
+                    workers=workers,
+                )
+            print(
+                f"{summary['rendered']} tiles rendered, "
+                f"{summary['skipped']} skipped, "
+                f"{summary['unchanged']} unchanged"
+            )
+        if zones:
+            with telemetry.stage("zonal_stats"):
+                report["zonal_stats"] = write_zonal_stats(
+                    "./data/output.tiff",
+                    zones,
+                    output=zonal_output,
+                    memory_budget=(
+                        memory_budget * 1024**2
+                        if memory_budget
+                        else ZONAL_BUDGET
+                    ),
+                )
+        if vectors:
+            with telemetry.stage("vectorize"):
+                report["vectorize"] = vectorize(
+                    "./data/output.tiff",
+                    vectors,
+                    workers=workers,
+                    simplify=simplify,
+                    sieve_size=sieve_size,
+                )
+    finally:
+        # failed runs are reported as well, up to the failing stage
+        telemetry.write_json("./data/run_report.json", extra=report)
+        if prometheus:
+            telemetry.write_prometheus(prometheus)
 
 
 if __name__ == "__main__":
@@ -1,27 +1,50 @@
-import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
 from math import ceil
 from pathlib import Path
 
 import numpy as np
 import rasterio
-from rasterio.merge import merge
+import rasterio.windows
+from rasterio.transform import from_bounds
+from rasterio.windows import Window
 from sentinelhub import (
     CRS,
     BBox,
-    BBoxSplitter,
     DataCollection,
     MimeType,
     MosaickingOrder,
-    SentinelHubDownloadClient,
+    SentinelHubCatalog,
     SentinelHubRequest,
     SHConfig,
     bbox_to_dimensions,
 )
 from shapely.geometry import box
+from utils.reflectance import band_calibration, write_calibration
+from utils.scene_store import SceneStore
+from utils.telemetry import Telemetry, staged
+
+# percentage of cloudy pixels above which the composite window is widened
+CLOUD_THRESHOLD = 10
+# widest composite window probed for clouds
+MAX_WINDOW_DAYS = 63
+# concurrent tile downloads of a batch download
+MAX_THREADS = 5
+# longest side of the coarse cloud probe in pixels
+PROBE_PIXELS = 512
+# band names of the regular evalscript in band order
+SH_BANDS = ("B03", "B8A", "B12", "CLM", "CLP", "B02", "B11")
+# scale and offset of the regular evalscript bands; SentinelHub harmonizes
+# the DN of baseline 04.00 and later, so none of them carries an offset
+SH_CALIBRATION = band_calibration(SH_BANDS)
 
 
 class Sentinel:
     def __init__(self) -> None:
+        self.image_paths = {}
+        self.store = None
+        self.max_threads = MAX_THREADS
+        self.telemetry = Telemetry()
         self._auth()
 
     def _auth(self):
@@ -38,7 +61,8 @@ class Sentinel:
         """
         This function creates a script used to run SentinelHub services
         Inputs:
-            model: type of run, regular is normalized burn ratio
+            model: type of run, regular is normalized burn ratio with
+                the bands as UINT16 DN, scaled by SH_CALIBRATION
         Returns:
             evalscript: script used for SentinelHub fetch
         """
@@ -49,10 +73,12 @@ class Sentinel:
                 function setup() {
                     return {
                         input: [{
-                            bands: ["B03", "B8A", "B12", "CLM", "CLP", "B02", "B11"]
+                            bands: ["B03", "B8A", "B12", "CLM", "CLP", "B02", "B11"],
+                            units: "DN"
                         }],
                         output: {
-                            bands: 7
+                            bands: 7,
+                            sampleType: "UINT16"
                         }
                     };
                 }
@@ -93,6 +119,26 @@ class Sentinel:
                             sample.B12];
                 }
             """
+        elif model == "clouds":
+            evalscript = """
+                //VERSION=3
+
+                function setup() {
+                    return {
+                        input: [{
+                            bands: ["CLM", "CLP"]
+                        }],
+                        output: {
+                            bands: 2,
+                            sampleType: "UINT8"
+                        }
+                    };
+                }
+
+                function evaluatePixel(sample) {
+                    return [sample.CLM, sample.CLP];
+                }
+            """
         else:
             evalscript = """
                 //VERSION=3
@@ -135,20 +181,18 @@ class Sentinel:
         size = bbox_to_dimensions(bbox, resolution=10)
         return size
 
-    def _get_sub_area(self, bbox, evalscript, start_date, end_date):
+    def _get_tile(self, bbox, evalscript, start_date, end_date, size=None):
         """
-        This
+        This function downloads a single tile of a batch download
         Inputs:
-            bbox: bbox of the investigative area
+            bbox: bbox of the tile
             evalscript: the script used to fetch imagery
             start_date: start date of the composite
             end_date: end date of the composite
+            size: width and height of the tile, 10 m pixels by default
         Returns:
-            request: SentinelHub imagery request
-            OR
-            cloud_check: if time needs to be recalibrated
+            tile: imagery of the tile
         """
-        size = bbox_to_dimensions(bbox, resolution=10)
         request = SentinelHubRequest(
             evalscript=evalscript,
             input_data=[
@@ -162,35 +206,15 @@ class Sentinel:
                 SentinelHubRequest.output_response("default", MimeType.TIFF)
             ],
             bbox=bbox,
-            size=size,
-            data_folder=tempfile.gettempdir(),
+            size=size or bbox_to_dimensions(bbox, resolution=10),
             config=self.config,
         )
-        data = request.get_data(save_data=True)
-        sentinel_image = data[0]
-        cloud_check = self._check_clm(sentinel_image)
-        if cloud_check == "recalibrate":
-            return cloud_check
-        return request
+        tile = request.get_data(max_threads=1)[0]
+        self.telemetry.count("bytes_downloaded", tile.nbytes)
+        return tile
 
-    def _split(self, x, y):
-        """
-        This function splits a bbox into a grid
-        Inputs:
-            x: num of x splits
-            y: num of y splits
-        Returns:
-            bbox_list: list of bounding boxes
-        """
-        # (minx, miny, maxx, maxy)
-        shp_box = box(*self.coords)
-        bbox_splitter = BBoxSplitter(
-            [shp_box], CRS.WGS84, (x, y)
-        )  # bounding box will be split into grid of 5x3 bounding boxes
-        bbox_list = bbox_splitter.get_bbox_list()
-        return bbox_list
-
-    def _get_imagery(self, start_date, end_date, coords, action):
+    @staged()
+    def _get_imagery(self, start_date, end_date, coords, action, read=True):
         """
         This functin fetches the imagery from SentinelHub
         Inputs:
@@ -198,19 +222,24 @@ class Sentinel:
             end_date: end date of the composite
             coords: coordinates of the bbox
             action: whether it is pre or post time
+            read: whether to return the imagery or only its image_paths
         Returns:
-            sentinel_image: imagery of the investigative area
+            sentinel_image: imagery of the investigative area or None
+            without read
             download_type: whether it is batch or single download
         """
         self.coords = coords
         self.action = action
-        evalscript = self._evalscript()
-        bbox = self._get_bbox()
-        size = self._get_size(bbox)
+        evalscript, bbox, size, key = self._request_key(start_date, end_date)
+        stored = self._stored_image(key, action, size, read)
+        if stored is not None:
+            return stored
         if int(size[1]) > 2500:
             image, download_type = self._batch_download(
-                evalscript, start_date, end_date, size
+                evalscript, start_date, end_date, size, action, read
             )
+            self.image_paths[action] = f"./data/output_{start_date}.tiff"
+            self._store_image(key, action, bbox, start_date, end_date)
             return image, download_type
         request = SentinelHubRequest(
             data_folder="test_dir",
@@ -229,14 +258,127 @@ class Sentinel:
             size=size,
             config=self.config,
         )
+        # the window has been cloud checked by _probe_clouds already
         data = request.get_data(save_data=True)
         sentinel_image = data[0]
-        cloud_check = self._check_clm(sentinel_image)
-        if cloud_check == "recalibrate":
-            return cloud_check, cloud_check
+        self.telemetry.count("bytes_downloaded", sentinel_image.nbytes)
+        self.image_paths[action] = str(
+            Path(request.data_folder) / request.get_filename_list()[0]
+        )
+        self._store_image(key, action, bbox, start_date, end_date)
         download_type = "regular"
+        if not read:
+            return None, download_type
         return sentinel_image, download_type
 
+    def _request_key(self, start_date, end_date):
+        """
+        This function builds the request of a composite window and its hash
+        Inputs:
+            start_date: start date of the composite
+            end_date: end date of the composite
+        Returns:
+            evalscript, bbox, size and key: request hash in the scene store
+        """
+        evalscript = self._evalscript()
+        bbox = self._get_bbox()
+        size = self._get_size(bbox)
+        key = SceneStore.request_key(
+            "SH", evalscript, start_date, end_date, list(bbox), size
+        )
+        return evalscript, bbox, size, key
+
+    def _stored_window(self, start_date, end_date, action, read=True):
+        """
+        This function looks a composite window up in the scene store,
+        without any request to SentinelHub
+        Inputs:
+            start_date: start date of the composite
+            end_date: end date of the composite
+            action: whether it is pre or post time
+            read: whether to read the image or only record its path
+        Returns:
+            sentinel_image, download_type or None if the image is not stored
+        """
+        if self.store is None:
+            return None
+        _, _, size, key = self._request_key(start_date, end_date)
+        return self._stored_image(key, action, size, read)
+
+    def _stored_image(self, key, action, size, read=True):
+        """
+        This function reuses a cloud checked image of the scene store
+        Inputs:
+            key: request hash
+            action: whether it is pre or post time
+            size: size of the request
+            read: whether to read the image or only record its path
+        Returns:
+            sentinel_image, download_type or None if the image is not stored
+        """
+        if self.store is None:
+            return None
+        path = self.store.get(key)
+        if path is None:
+            return None
+        self.image_paths[action] = path
+        if not read:
+            return None, "batch" if int(size[1]) > 2500 else "regular"
+        with rasterio.open(path) as src:
+            image = src.read()
+        if int(size[1]) > 2500:
+            return image, "batch"
+        return np.moveaxis(image, 0, -1), "regular"
+
+    def _store_image(self, key, action, bbox, start_date, end_date):
+        """
+        This function adds a downloaded image to the scene store
+        Inputs:
+            key: request hash
+            action: whether it is pre or post time
+            bbox: bbox of the request
+            start_date: start date of the composite
+            end_date: end date of the composite
+        """
+        if self.store is None:
+            return
+        self.image_paths[action] = self.store.put(
+            key,
+            self.image_paths[action],
+            footprint=box(*bbox),
+            sensing_start=start_date,
+            sensing_end=end_date,
+        )
+
+    def _cloud_counts(self, cloud_band):
+        """
+        This function counts the values of a cloud mask
+        Inputs:
+            cloud_band: CLM band, 0 clear, 1 (or 255 once scaled) cloudy
+        Returns:
+            counts: occurrences of every uint8 value
+        """
+        return np.bincount(
+            cloud_band.astype(np.uint8, copy=False).ravel(), minlength=256
+        )
+
+    def _cloud_percentage(self, cloud_band=None, counts=None):
+        """
+        This function computes the share of cloudy pixels of a cloud mask
+        Inputs:
+            cloud_band: CLM band, 0 clear, 1 (or 255 once scaled) cloudy
+            counts: value counts of the CLM band instead of the band
+        Returns:
+            percentage_cloud: percentage of cloudy pixels
+        """
+        if counts is None:
+            counts = self._cloud_counts(cloud_band)
+        cloudy = counts[1] + counts[255]
+        total = counts[0] + cloudy
+        if total == 0:
+            return 0.0
+        return cloudy / total * 100
+
     def _check_clm(self, image):
         """
         This function checks the cloud mask of the imagery
@@ -245,81 +387,236 @@ class Sentinel:
         Returns:
             "recalibrate" if composite time needs to be extended else True
         """
-        cloud_band = image[:, :, 3]
-        _ = image[:, :, 4]
-        # count occurrences of each unique value
-        unique, counts = np.unique(cloud_band, return_counts=True)
-        dict_counts = dict(zip(unique, counts))
-        if dict_counts.get(1):
-            value_1 = dict_counts[1]
-            value_0 = dict_counts[0]
-            value_255 = dict_counts[255]
-            percentage_cloud = (
-                (value_1 + value_255) / (value_0 + value_1 + value_255)
-            ) * 100
-            if percentage_cloud > 10:
-                return "recalibrate"
-        elif dict_counts.get(255) in dict_counts:
-            value_0 = dict_counts[0]
-            value_255 = dict_counts[255]
-            percentage_cloud = ((value_255) / (value_0 + value_255)) * 100
-            if percentage_cloud > 10:
-                return "recalibrate"
+        if self._cloud_percentage(image[:, :, 3]) > CLOUD_THRESHOLD:
+            return "recalibrate"
         return
 
-    def _batch_download(self, evalscript, start_date, end_date, size):
+    @staged()
+    def _probe_clouds(self, start_date, end_date):
         """
-        This function splits bbox, downloads and mosaics
+        This function requests only the cloud bands at a coarse resolution
+        to check a composite window before the full resolution download
         Inputs:
-            evalscript:
             start_date: start date of the composite
             end_date: end date of the composite
         Returns:
-            mosaic: final mosaic of the area
-            download_type: whether it is batch or single download
+            percentage_cloud: percentage of cloudy pixels of the composite
         """
-        x, y = size[0], size[1]
-        # max size is 2500 * 2500 pixel
-        x = ceil(x / 2500)
-        y = ceil(y / 2500)
-        bbox_list = self._split(x, y)
+        bbox = self._get_bbox()
+        width, height = self._get_size(bbox)
+        scale = max(1, ceil(max(width, height) / PROBE_PIXELS))
+        request = SentinelHubRequest(
+            evalscript=self._evalscript(model="clouds"),
+            input_data=[
+                SentinelHubRequest.input_data(
+                    data_collection=DataCollection.SENTINEL2_L1C,
+                    time_interval=(start_date, end_date),
+                    mosaicking_order=MosaickingOrder.LEAST_CC,
+                )
+            ],
+            responses=[
+                SentinelHubRequest.output_response("default", MimeType.TIFF)
+            ],
+            bbox=bbox,
+            size=(max(1, width // scale), max(1, height // scale)),
+            config=self.config,
+        )
+        clouds = request.get_data()[0]
+        self.telemetry.count("bytes_downloaded", clouds.nbytes)
+        return self._cloud_percentage(clouds[:, :, 0])
 
-        sh_requests = [
-            self._get_sub_area(bbox, evalscript, start_date, end_date)
-            for bbox in bbox_list
-        ]
-        if sh_requests == "recalibrate":
-            return sh_requests, sh_requests
-        dl_requests = [request.download_list[0] for request in sh_requests]
+    def _acquisition_dates(self, start_date, end_date):
+        """
+        This function lists the acquisition dates of a composite window
+        Inputs:
+            start_date: start date of the composite
+            end_date: end date of the composite
+        Returns:
+            dates: sorted list of acquisition dates as YYYY-MM-DD
+        """
+        search = SentinelHubCatalog(config=self.config).search(
+            DataCollection.SENTINEL2_L1C,
+            bbox=self._get_bbox(),
+            time=(start_date, end_date),
+            fields={"include": ["properties.datetime"], "exclude": []},
+        )
+        return sorted({item["properties"]["datetime"][:10] for item in search})
+
+    def _get_acquisition(self, date):
+        """
+        This function fetches a single acquisition of the investigative area
+        Inputs:
+            date: acquisition date as YYYY-MM-DD
+        Returns:
+            sentinel_image: imagery of the acquisition
+        """
+        bbox = self._get_bbox()
+        request = SentinelHubRequest(
+            evalscript=self._evalscript(),
+            input_data=[
+                SentinelHubRequest.input_data(
+                    data_collection=DataCollection.SENTINEL2_L1C,
+                    time_interval=(date, date),
+                )
+            ],
+            responses=[
+                SentinelHubRequest.output_response("default", MimeType.TIFF)
+            ],
+            bbox=bbox,
+            size=self._get_size(bbox),
+            config=self.config,
+        )
+        acquisition = request.get_data()[0]
+        self.telemetry.count("bytes_downloaded", acquisition.nbytes)
+        return acquisition
+
+    def _clear_tile(
+        self, bbox, size, evalscript, start_date, end_date, action, tile, cloud
+    ):
+        """
+        This function refetches a cloudy tile of a batch download, widening
+        its composite window by 7 days at a time until the tile is below the
+        cloud threshold, and keeps the least cloudy of the fetched tiles
+        Inputs:
+            bbox: bbox of the tile
+            size: width and height of the tile
+            evalscript: the script used to fetch imagery
+            start_date: start date of the composite
+            end_date: end date of the composite
+            action: whether it is pre or post time
+            tile: imagery of the tile over the composite window
+            cloud: percentage of cloudy pixels of the tile
+        Returns:
+            tile: least cloudy imagery of the tile
+            cloud: percentage of cloudy pixels of that tile
+        """
+        days = (end_date - start_date).days
+        while cloud > CLOUD_THRESHOLD and days + 7 <= MAX_WINDOW_DAYS:
+            days += 7
+            # the pre fire window grows back in time, the post fire forward
+            if action == "-":
+                start_date = end_date - timedelta(days=days)
+            else:
+                end_date = start_date + timedelta(days=days)
+            wider = self._get_tile(
+                bbox, evalscript, start_date, end_date, size
+            )
+            wider_cloud = self._cloud_percentage(wider[:, :, 3])
+            if wider_cloud < cloud:
+                tile, cloud = wider, wider_cloud
+        if cloud > CLOUD_THRESHOLD:
+            print(
+                f"Tile {bbox} is still {cloud:.1f}% cloudy after {days} days"
+            )
+        return tile, cloud
 
-        # download data with multiple threads
-        _ = SentinelHubDownloadClient(config=self.config).download(
-            dl_requests, max_threads=5
+    def _window_bbox(self, window, transform):
+        """
+        This function returns the bbox of a window of the mosaic grid
+        Inputs:
+            window: rasterio Window
+            transform: affine transform of the mosaic
+        Returns:
+            bbox: SentinelHub BBox of the window
+        """
+        return BBox(
+            bbox=rasterio.windows.bounds(window, transform), crs=CRS.WGS84
         )
 
-        # get paths to tiffs
-        data_folder = sh_requests[0].data_folder
-        tiffs = [
-            Path(data_folder) / req.get_filename_list()[0]
-            for req in sh_requests
+    @staged()
+    def _batch_download(
+        self, evalscript, start_date, end_date, size, action, read=True
+    ):
+        """
+        This function splits the grid of the area into windows, downloads
+        every window exactly once on a worker pool and streams the tiles into
+        the mosaic as they land; a tile above the cloud threshold is
+        refetched over a wider window. Every tile is requested with the
+        bounds and size of its window, so it lands pixel for pixel.
+        Inputs:
+            evalscript: the script used to fetch imagery
+            start_date: start date of the composite
+            end_date: end date of the composite
+            size: size of the whole area at 10 m
+            action: whether it is pre or post time
+            read: whether to read the mosaic back or only write it
+        Returns:
+            mosaic: final mosaic of the area or None without read
+            download_type: whether it is batch or single download
+        """
+        width, height = size[0], size[1]
+        # max size is 2500 * 2500 pixel
+        cols = ceil(width / ceil(width / 2500))
+        rows = ceil(height / ceil(height / 2500))
+        transform = from_bounds(*self._get_bbox(), width, height)
+        windows = [
+            Window(col, row, min(cols, width - col), min(rows, height - row))
+            for row in range(0, height, rows)
+            for col in range(0, width, cols)
         ]
-        elements = []
-        for fp in tiffs:
-            src = rasterio.open(fp)
-            elements.append(src)
-        mosaic, out_trans = merge(elements)
-        out_meta = src.meta.copy()
-        out_meta.update(
-            {
-                "driver": "GTiff",
-                "height": mosaic.shape[1],
-                "width": mosaic.shape[2],
-                "transform": out_trans,
-            }
-        )
-        with rasterio.open(
-            f"./data/output_{start_date}.tiff", "w", **out_meta
-        ) as dest:
-            dest.write(mosaic)
+        filename = f"./data/output_{start_date}.tiff"
+        counts = np.zeros(256, dtype=np.int64)
+        dest = None
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_threads) as executor:
+                futures = {
+                    executor.submit(
+                        self._get_tile,
+                        self._window_bbox(window, transform),
+                        evalscript,
+                        start_date,
+                        end_date,
+                        (window.width, window.height),
+                    ): window
+                    for window in windows
+                }
+                for future in as_completed(futures):
+                    tile = future.result()
+                    window = futures[future]
+                    tile_counts = self._cloud_counts(tile[:, :, 3])
+                    percentage_cloud = self._cloud_percentage(
+                        counts=tile_counts
+                    )
+                    if percentage_cloud > CLOUD_THRESHOLD:
+                        tile, _ = self._clear_tile(
+                            self._window_bbox(window, transform),
+                            (window.width, window.height),
+                            evalscript,
+                            start_date,
+                            end_date,
+                            action,
+                            tile,
+                            percentage_cloud,
+                        )
+                        tile_counts = self._cloud_counts(tile[:, :, 3])
+                    counts += tile_counts
+                    if dest is None:
+                        dest = rasterio.open(
+                            filename,
+                            "w",
+                            driver="GTiff",
+                            width=width,
+                            height=height,
+                            count=tile.shape[2],
+                            dtype=tile.dtype,
+                            crs="EPSG:4326",
+                            transform=transform,
+                            tiled=True,
+                            compress="deflate",
+                        )
+                        dest.descriptions = SH_BANDS
+                        write_calibration(dest, SH_CALIBRATION)
+                    dest.write(np.moveaxis(tile, -1, 0), window=window)
+                    del tile
+        finally:
+            if dest is not None:
+                dest.close()
+        percentage_cloud = self._cloud_percentage(counts=counts)
+        if percentage_cloud > CLOUD_THRESHOLD:
+            print(f"Mosaic is {percentage_cloud:.1f}% cloudy")
         download_type = "batch"
+        if not read:
+            return None, download_type
+        with rasterio.open(filename) as src:
+            mosaic = src.read()
         return mosaic, download_type
@@ -1,46 +1,216 @@
 import json
+import multiprocessing
 import os
 import pathlib
 import pprint
 import re
 import shutil
 import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from glob import glob
+from math import ceil, floor
 
+import numpy as np
 import rasterio
-import rasterio.mask
-import rasterio.warp
+import shapely
 from dotenv import load_dotenv
-from rasterio.merge import merge
-from rasterio.warp import Resampling, calculate_default_transform, reproject
+from osgeo import gdal
 from sentinelsat import SentinelAPI
 from shapely import box
-from utils.util import min_cover_1, min_cover_2
+from utils.cover import min_cover
+from utils.mosaic import stream_mosaic
+from utils.nodes import download_nodes, pack_safe
+from utils.reflectance import band_calibration, dn_offset, write_calibration
+from utils.scene_store import link
+from utils.telemetry import Telemetry, staged
+from utils.util import block_windows
 
 load_dotenv(os.getenv("COPERNICUS_CREDENTIALS"))
 
+# bands read by the NBR and the SWM water mask
+NBR_BANDS = ("B02", "B03", "B8A", "B11", "B12")
+RES_TYPES = ("R10m", "R20m", "R60m")
+# bytes of a single strip copied from .jp2 to .tiff
+STRIP_BYTES = 64 * 1024**2
+# pixel size of the EPSG:4326 grid in metres, that of the R20m bands
+GRID_RESOLUTION = 20
+# metres of a degree of latitude
+METRES_PER_DEGREE = 111320
+
+
+def band_name(path):
+    """
+    This function extracts the band name from a Sentinel-2 image file name
+    Inputs:
+        path: path of the image, e.g. T55HGD_20230303T001109_B8A_20m.jp2
+    Returns:
+        band: band name such as B8A or None if it is not a band image
+    """
+    match = re.search(r"_(B\d[\dA])(_\d+m)?\.\w+$", os.path.basename(path))
+    if match is None:
+        return None
+    return match.group(1)
+
+
+def aoi_footprint(input_file):
+    """
+    This function returns the area of interest as a shapely geometry
+    Inputs:
+        input_file: (minx, miny, maxx, maxy) tuple or GeoDataFrame
+    Returns:
+        footprint: shapely geometry in EPSG:4326
+    """
+    if type(input_file) is tuple:
+        return box(*input_file)
+    return input_file["geometry"][0]
+
+
+def aoi_grid(footprint, resolution=GRID_RESOLUTION):
+    """
+    This function computes the EPSG:4326 grid of an area of interest, with
+    square pixels snapped to multiples of the pixel size so that any date
+    warped for the same area and resolution lands on the very same grid
+    Inputs:
+        footprint: shapely geometry of the area in EPSG:4326
+        resolution: pixel size in metres
+    Returns:
+        bounds: (minx, miny, maxx, maxy) of the grid in degrees
+        width: number of columns
+        height: number of rows
+    """
+    size = resolution / METRES_PER_DEGREE
+    minx, miny, maxx, maxy = footprint.bounds
+    left, bottom = floor(minx / size), floor(miny / size)
+    right, top = ceil(maxx / size), ceil(maxy / size)
+    width, height = max(1, right - left), max(1, top - bottom)
+    return (
+        (left * size, bottom * size, (left + width) * size, top * size),
+        width,
+        height,
+    )
+
+
+def convert_to_tiff(path):
+    """
+    This function converts a .jp2 band to a tiled, compressed GeoTIFF,
+    copying it strip by strip so that the band is never fully in memory
+    Inputs:
+        path: path of the .jp2 band
+    Returns:
+        outfile: path of the GeoTIFF
+    """
+    print("Converting " + path)
+    outfile = re.sub(".jp2", ".tiff", path)
+    with rasterio.open(path, mode="r") as src:
+        profile = src.meta.copy()
+        profile.update(
+            driver="GTiff",
+            tiled=True,
+            blockxsize=512,
+            blockysize=512,
+            compress="deflate",
+            predictor=2,
+        )
+        windows = block_windows(
+            width=src.width,
+            height=src.height,
+            bytes_per_pixel=src.count * np.dtype(src.dtypes[0]).itemsize,
+            memory_budget=STRIP_BYTES,
+            align=512,
+        )
+        with rasterio.open(outfile, "w", **profile) as dst:
+            for window in windows:
+                dst.write(src.read(window=window), window=window)
+    return outfile
+
+
+def stack_vrt(path, paths, shift=0):
+    """
+    This function stacks the band images of a product in a VRT, adding
+    shift to the DN of the valid pixels so that products of processing
+    baselines with and without the DN offset share one
+    Inputs:
+        path: path of the VRT, on disk or in /vsimem/
+        paths: paths of the band images in band order
+        shift: DN added to the bands, 0 leaves them as they are
+    Returns:
+        vrt: GDAL dataset of the VRT
+    """
+    # zero is nodata, so the empty swath of a product never covers another
+    # one in the warp, and the complex sources skip it when shifting
+    vrt = gdal.BuildVRT(path, paths, separate=True, srcNodata=0, VRTNodata=0)
+    if shift == 0:
+        return vrt
+    xml = vrt.GetMetadata("xml:VRT")[0].replace(
+        "</NODATA>", f"</NODATA><ScaleOffset>{shift}</ScaleOffset>"
+    )
+    vrt = None
+    f = gdal.VSIFOpenL(path, "wb")
+    gdal.VSIFWriteL(xml, 1, len(xml), f)
+    gdal.VSIFCloseL(f)
+    return gdal.Open(path)
+
 
 class Sentinel_Sat:
-    def __init__(self, start_date, end_date, input_file, debug=False):
+    def __init__(
+        self,
+        start_date,
+        end_date,
+        input_file,
+        debug=False,
+        bands=NBR_BANDS,
+        res_types=("R20m",),
+        workers=None,
+        lazy=False,
+        extract="all",
+        dl_dir=None,
+        store=None,
+        telemetry=None,
+        download="product",
+        resolution=GRID_RESOLUTION,
+        read=True,
+    ):
         self.SENTINEL_USER = os.getenv("USERNAME")
         self.SENTINEL_PASS = os.getenv("PASSWORD")
         this_directory = os.getcwd()
-        self.DL_DIR = this_directory + "/data/"
+        self.DL_DIR = dl_dir or this_directory + "/data/"
         self.INPUT_FILE = input_file
         self.START_DATE = start_date
         self.END_DATE = end_date
         self.DEBUG = debug
-
-        if not os.path.exists(self.DL_DIR):
-            os.mkdir(self.DL_DIR)
-
+        self.BANDS = bands
+        self.RES_TYPES = res_types
+        self.WORKERS = workers
+        self.LAZY = lazy
+        self.EXTRACT = extract
+        self.DOWNLOAD = download
+        self.RESOLUTION = resolution
+        # whether the final mosaic is read back or only written to disk
+        self.READ = read
+        # in-memory GDAL files of this download folder and window, kept
+        # apart from those of the other date downloading concurrently
+        self.VSIMEM = (
+            f"/vsimem/{self.DL_DIR.strip('/')}/{start_date}_{end_date}"
+        )
+        self.vsizip_products = {}
+        self.vsizip_archives = []
+        self.STORE = store
+        # band names of the final mosaic in band order
+        self.band_order = None
+        # scale and offset of the final mosaic bands
+        self.band_calibration = None
+        # DN offset the products of the mosaic are shifted to
+        self.mosaic_offset = 0
+        self.telemetry = telemetry or Telemetry()
+
+        os.makedirs(f"{self.DL_DIR}sentinel", exist_ok=True)
+
+    @staged()
     def phase_1(self):
         self.api = SentinelAPI(self.SENTINEL_USER, self.SENTINEL_PASS)
-        if type(self.INPUT_FILE) is tuple:
-            self.aoi_footprint = box(*self.INPUT_FILE)
-        else:
-            self.aoi_footprint = self.INPUT_FILE["geometry"][0]
+        self.aoi_footprint = aoi_footprint(self.INPUT_FILE)
 
+    @staged()
     def phase_2(self):
         self.api_products = self.api.query(
             area=self.aoi_footprint,
@@ -50,6 +220,7 @@ class Sentinel_Sat:
             cloudcoverpercentage=(0, 10),
         )
 
+    @staged()
     def phase_3(self):
         """
         We're doing the conversion from a GeoDataFrame to a list of dictionaries.
@@ -70,7 +241,16 @@ class Sentinel_Sat:
         )
         self.tile_footprints = []
         for x in (
-            self.product_df[["size", "processinglevel", "footprint"]]
+            self.product_df[
+                [
+                    "size",
+                    "processinglevel",
+                    "footprint",
+                    "title",
+                    "beginposition",
+                    "endposition",
+                ]
+            ]
             .T.to_dict()
             .items()
         ):
@@ -79,37 +259,199 @@ class Sentinel_Sat:
         if self.DEBUG:
             pprint(self.tile_footprints[:3])
 
+    @staged()
     def phase_4(self):
-        L1 = min_cover_1(self.tile_footprints)
+        self.reduced_footprints = min_cover(self.tile_footprints)
         if self.DEBUG:
-            print("{} tiles after the 1st reduction".format(len(L1)))
-        L2 = min_cover_2(L1)
-        if self.DEBUG:
-            print("{} tiles after the 2nd reduction".format(len(L2)))
-        self.reduced_footprints = L2
+            print(
+                "{} tiles after the reduction".format(
+                    len(self.reduced_footprints)
+                )
+            )
 
+    @staged()
     def phase_5(self):
-        dl_indexes = [x["index"] for x in self.reduced_footprints]
-        self.api.download_all(dl_indexes, directory_path=self.DL_DIR)
+        dl_indexes = [
+            x["index"]
+            for x in self.reduced_footprints
+            if not self._from_store(x["index"])
+        ]
+        if len(dl_indexes) > 0 and self.DOWNLOAD == "bands":
+            self._download_bands(dl_indexes)
+        elif len(dl_indexes) > 0:
+            self.api.download_all(dl_indexes, directory_path=self.DL_DIR)
+            for x in self.reduced_footprints:
+                path = f"{self.DL_DIR}{x['title']}.zip"
+                if x["index"] in dl_indexes and os.path.exists(path):
+                    self.telemetry.count(
+                        "bytes_downloaded", os.path.getsize(path)
+                    )
 
         if self.DEBUG:
             pprint(dl_indexes)
 
+        if self.STORE is not None:
+            for x in self.reduced_footprints:
+                if x["index"] in dl_indexes:
+                    archive = f"{self.DL_DIR}{x['title']}.zip"
+                    if self.DOWNLOAD == "bands":
+                        pack_safe(f"{self.DL_DIR}{x['title']}.SAFE", archive)
+                    self.STORE.put(
+                        x["index"],
+                        archive,
+                        footprint=x["footprint"],
+                        sensing_start=x["beginposition"],
+                        sensing_end=x["endposition"],
+                    )
+                    if self.DOWNLOAD == "bands":
+                        # the store holds a link, the .SAFE is read below
+                        os.remove(archive)
+
         # self.api.download_all(self.api_products, directory_path=self.DL_DIR)
 
+    def _download_bands(self, indexes):
+        """
+        This function downloads only the band images the index needs from
+        the products, through the OData nodes of their manifest, into
+        minimal .SAFE folders that phase_6 leaves as they are
+        Inputs:
+            indexes: UUIDs of the products to download
+        """
+        products = [
+            (x["index"], x["title"])
+            for x in self.reduced_footprints
+            if x["index"] in indexes
+        ]
+        downloaded = download_nodes(
+            self.api.session,
+            self.api.api_url,
+            products,
+            self.DL_DIR,
+            self._needed,
+            self.WORKERS,
+        )
+        self.telemetry.count("bytes_downloaded", downloaded)
+
+    @staged()
+    def phase_cached(self):
+        """
+        Reusing the products of the scene store when they already cover the
+        area of interest within the time window, without touching the network
+        """
+        if self.STORE is None:
+            return False
+        scenes, _ = self.STORE.covered(
+            self.aoi_footprint, self.START_DATE, self.END_DATE
+        )
+        # a shared store holds SentinelHub images as well
+        scenes = [x for x in scenes if x["path"].endswith(".zip")]
+        if len(scenes) == 0:
+            return False
+        union = shapely.union_all(
+            shapely.from_wkt([x["footprint"] for x in scenes])
+        )
+        if self.aoi_footprint.difference(union).area >= 1e-9:
+            return False
+        self.reduced_footprints = [
+            {**scene, "index": scene["key"]} for scene in min_cover(scenes)
+        ]
+        for x in self.reduced_footprints:
+            self._from_store(x["index"])
+        print(f"Reusing {len(self.reduced_footprints)} stored products")
+        return True
+
+    def _from_store(self, key):
+        """
+        This function links a stored product archive into the download folder
+        Inputs:
+            key: product UUID
+        Returns:
+            True if the product was found in the store
+        """
+        if self.STORE is None:
+            return False
+        path = self.STORE.get(key)
+        if path is None:
+            return False
+        # the archive name does not matter, the .SAFE folder is inside
+        dst = f"{self.DL_DIR}{key}.zip"
+        if not os.path.exists(dst):
+            link(path, dst)
+        return True
+
+    @staged()
     def phase_6(self):
         """
         We're decompressing the archives unless they're already decompressed.
+
+        With EXTRACT set to "all" the whole archive is unpacked, with "bands"
+        only the band images needed by the index and resolution, and with
+        "vsizip" nothing at all as the bands are read in place through
+        GDAL's /vsizip/. Several archives are handled concurrently.
         """
-        for p in pathlib.Path(self.DL_DIR).iterdir():
-            p_dir = re.sub(".zip$", ".SAFE", str(p))
-            if os.path.isfile(p) and not os.path.exists(p_dir):
-                extract_path = os.path.dirname(p)
-                print("Dezarhivare " + str(p))
-                with zipfile.ZipFile(p, "r") as zip_ref:
-                    zip_ref.extractall(extract_path)
-                    os.remove(p)
+        archives = [
+            p
+            for p in pathlib.Path(self.DL_DIR).iterdir()
+            if p.suffix == ".zip"
+            and os.path.isfile(p)
+            and not os.path.exists(re.sub(".zip$", ".SAFE", str(p)))
+        ]
+        with ThreadPoolExecutor(max_workers=self.WORKERS) as executor:
+            sizes = list(executor.map(self._extract, archives))
+        for paths in self.vsizip_products.values():
+            paths.sort()
+        extracted = sum(size[0] for size in sizes)
+        total = sum(size[1] for size in sizes)
+        self.extract_report = {
+            "archives": len(archives),
+            "total_bytes": total,
+            "extracted_bytes": extracted,
+            "saved_bytes": total - extracted,
+        }
+        if len(archives) > 0:
+            print(
+                f"Extracted {extracted / 1e6:.1f} MB of {total / 1e6:.1f} MB,"
+                f" saved {(total - extracted) / 1e6:.1f} MB of disk and I/O"
+            )
 
+    def _extract(self, p):
+        """
+        This function extracts a single product archive
+        Inputs:
+            p: path of the .zip archive
+        Returns:
+            extracted: bytes written to disk
+            total: uncompressed bytes of the archive
+        """
+        with zipfile.ZipFile(p, "r") as zip_ref:
+            members = zip_ref.infolist()
+            total = sum(m.file_size for m in members)
+            if self.EXTRACT == "all":
+                print("Dezarhivare " + str(p))
+                zip_ref.extractall(os.path.dirname(p))
+                selected = members
+            else:
+                selected = [
+                    m
+                    for m in members
+                    if not m.is_dir() and self._needed(m.filename)
+                ]
+            if self.EXTRACT == "bands":
+                print("Dezarhivare " + str(p))
+                for member in selected:
+                    zip_ref.extract(member, os.path.dirname(p))
+        if self.EXTRACT == "vsizip":
+            for member in selected:
+                product = pathlib.PurePosixPath(member.filename).parts[0]
+                self.vsizip_products.setdefault(product, []).append(
+                    f"/vsizip/{p}/{member.filename}"
+                )
+            self.vsizip_archives.append(str(p))
+            return 0, total
+        os.remove(p)
+        return sum(m.file_size for m in selected), total
+
+    @staged()
     def phase_7(self):
         """
         Converting the .jp2 images to .tiff
@@ -150,23 +492,25 @@ class Sentinel_Sat:
                                             pass
                 return L
 
-        def convert_to_tiff(paths):
-            tiff_paths = []
-            for p in paths:
-                print("Converting " + p)
-                with rasterio.open(p, mode="r") as src:
-                    profile = src.meta.copy()
-                    profile.update(driver="GTiff")
-
-                    outfile = re.sub(".jp2", ".tiff", p)
-                    with rasterio.open(outfile, "w", **profile) as dst:
-                        dst.write(src.read())
-                        tiff_paths.append(outfile)
-            return tiff_paths
-
-        self.jp2_paths = select_files(self.DL_DIR, ".jp2")
-        self.tiffs = convert_to_tiff(self.jp2_paths)
+        self.jp2_paths = [
+            p for p in select_files(self.DL_DIR, ".jp2") if self._needed(p)
+        ]
+        # spawned, forking while the other date downloads on a thread can
+        # copy GDAL locks held by that thread and deadlock
+        with ProcessPoolExecutor(
+            max_workers=self.WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as executor:
+            self.tiffs = list(executor.map(convert_to_tiff, self.jp2_paths))
         list_of_dirs = glob(f"{self.DL_DIR}/*/", recursive=True)
+        self.mosaic_offset = min(
+            (
+                dn_offset(dir.split("/")[-2])
+                for dir in list_of_dirs
+                if "sentinel" not in dir
+            ),
+            default=0,
+        )
         list_of_subs = ["R10m", "R20m", "R60m"]
         final_dict = {}
         for dir in list_of_dirs:
@@ -183,7 +527,7 @@ class Sentinel_Sat:
                 dir_name = dir.split("/")[-2]
                 sub_dirs = [x[0] for x in os.walk(dir)]
                 if dir in final_dict:
-                    for res_type in list_of_subs:
+                    for res_type in self.RES_TYPES:
                         self.tiff_paths = select_files(dir, ".tiff", res_type)
 
                         self.phase8test(dir_name, res_type)
@@ -193,12 +537,23 @@ class Sentinel_Sat:
                     self.phase8test(dir_name)
         return list_of_dirs
 
+    def _needed(self, path):
+        """
+        This function checks whether an image is used by the selected index
+        Inputs:
+            path: path of the band image
+        Returns:
+            True if the band and its resolution are needed
+        """
+        if band_name(path) not in self.BANDS:
+            return False
+        parts = pathlib.Path(path).parts
+        if any(res_type in parts for res_type in RES_TYPES):
+            return any(res_type in parts for res_type in self.RES_TYPES)
+        return True
+
     def phase8test(self, dir_name, res_type="all"):
         self.tiff_paths.sort()
-        raster_list = []
-        for file in self.tiff_paths:
-            raster = rasterio.open(file)
-            raster_list.append(raster)
 
         config_dict = {}
         with open(rf"{self.DL_DIR}{dir_name}file-{res_type}.txt", "w") as fp:
@@ -209,12 +564,21 @@ class Sentinel_Sat:
                 else:
                     band = item.split("_")[-2].split("_")[-1]
                 config_dict[band] = idx
-        yo = f"gdalbuildvrt -input_file_list {self.DL_DIR}/{dir_name}file-{res_type}.txt -separate -overwrite {self.DL_DIR}/sentinel/{dir_name}-{res_type}merged1.tiff"
-        os.system(yo)
+        self.band_order = tuple(sorted(config_dict, key=config_dict.get))
+        self.band_calibration = band_calibration(
+            self.band_order, self.mosaic_offset
+        )
+        # products of other baselines are shifted to the mosaic offset
+        stack_vrt(
+            f"{self.DL_DIR}sentinel/{dir_name}-{res_type}merged1.tiff",
+            self.tiff_paths,
+            dn_offset(dir_name) - self.mosaic_offset,
+        )
 
         with open(f"./data/{dir_name}-{res_type}.json", "w") as outfile:
             json.dump(config_dict, outfile)
 
+    @staged()
     def phase8ab(self, dirs):
         final_dirs = list(set(dirs))
         for dir in final_dirs:
@@ -229,117 +593,220 @@ class Sentinel_Sat:
                 except Exception as e:
                     print(e)
 
+    @staged()
     def phase8b(self):
         # iterate over same res files in sentinel folder
-        # merge using rasterio
+        # mosaic window by window, the full mosaic is never held in memory
         raster_list = glob(f"{self.DL_DIR}/sentinel/*R20*.tiff")
-        elements = []
-        for fp in raster_list:
-            src = rasterio.open(fp)
-            elements.append(src)
-        mosaic, out_trans = merge(elements)
-        out_meta = src.meta.copy()
-        out_meta.update(
-            {
-                "driver": "GTiff",
-                "height": mosaic.shape[1],
-                "width": mosaic.shape[2],
-                "transform": out_trans,
-            }
-        )
-        with rasterio.open(
-            f"./data/sentinel/output_cop_{self.START_DATE}.tiff",
-            "w",
-            **out_meta,
-        ) as dest:
-            dest.write(mosaic)
+        filename = f"{self.DL_DIR}sentinel/output_cop_{self.START_DATE}.tiff"
+        stream_mosaic(raster_list, filename, workers=self.WORKERS)
+        # band names and calibration travel with the mosaic, e.g. when it
+        # is read back by the LOCAL provider
+        with rasterio.open(filename, "r+") as dst:
+            if self.band_order is not None:
+                dst.descriptions = self.band_order
+            write_calibration(dst, self.band_calibration)
         download_type = "cop"
-        return mosaic, download_type
+        return None, download_type
 
-    def phase_9(self):
+    @staged()
+    def phase_warp(self):
         """
-        Reprojecting the imagery to EPSG:4326
+        Warping only the window of the mosaic that intersects the area of
+        interest straight onto the shared EPSG:4326 grid, it replaces the
+        reprojection of the whole mosaic followed by the crop
+        Returns:
+            mosaic: area of interest of the mosaic in EPSG:4326
         """
+        return self._warp_to_grid(
+            [f"{self.DL_DIR}sentinel/output_cop_{self.START_DATE}.tiff"]
+        )
 
-        dst_crs = "EPSG:4326"
-        data = glob(f"{self.DL_DIR}sentinel/output_cop_*.tiff")
-
-        for file in data:
-            if "4326" in file or str(self.START_DATE) not in file:
-                pass
-            else:
-                file_name = file.split("/")[-1].split(".")[0]
-                with rasterio.open(file) as src:
-                    transform, width, height = calculate_default_transform(
-                        src.crs, dst_crs, src.width, src.height, *src.bounds
-                    )
-                    kwargs = src.meta.copy()
-                    kwargs.update(
-                        {
-                            "crs": dst_crs,
-                            "transform": transform,
-                            "width": width,
-                            "height": height,
-                        }
-                    )
-                    self.MERGED_4326 = (
-                        f"{self.DL_DIR}sentinel/{file_name}_4326.tiff"
-                    )
-                    with rasterio.open(
-                        self.MERGED_4326,
-                        mode="w",
-                        **kwargs,
-                    ) as dst:
-                        for i in range(1, src.count + 1):
-                            reproject(
-                                source=rasterio.band(src, i),
-                                destination=rasterio.band(dst, i),
-                                src_transform=src.transform,
-                                src_crs=src.crs,
-                                dst_transform=transform,
-                                dst_crs=dst_crs,
-                                resampling=Resampling.nearest,
-                            )
-
-    def phase_10(self):
+    def _warp_to_grid(self, sources):
         """
-        We're clipping to the area of interest.
+        This function warps the sources onto the grid of aoi_grid in a
+        single multithreaded gdal.Warp. The output bounds make GDAL read
+        only the source window over the area of interest, and as the grid
+        only depends on the area and the resolution the pre and post fire
+        mosaics land on identical grids.
+        Inputs:
+            sources: paths or GDAL datasets of the band stacks
+        Returns:
+            mosaic: numpy ndarray of the area of interest or None when the
+            mosaic is only written to MERGED_REGION
         """
-        # with fiona.open("tehran.shp", "r") as shapefile:
-        #     shapes = [feature["geometry"] for feature in shapefile]
-        with rasterio.open(self.MERGED_4326) as src:
-            out_image, out_transform = rasterio.mask.mask(
-                src, [self.aoi_footprint], crop=True
-            )
-            out_meta = src.meta
-            out_meta.update(
+        bounds, width, height = aoi_grid(self.aoi_footprint, self.RESOLUTION)
+        # the cutline masks everything outside of the footprint
+        cutline = f"{self.VSIMEM}/aoi.geojson"
+        gdal.FileFromMemBuffer(
+            cutline,
+            json.dumps(
                 {
-                    "driver": "GTiff",
-                    "height": out_image.shape[1],
-                    "width": out_image.shape[2],
-                    "transform": out_transform,
+                    "type": "FeatureCollection",
+                    "features": [
+                        {
+                            "type": "Feature",
+                            "properties": {},
+                            "geometry": self.aoi_footprint.__geo_interface__,
+                        }
+                    ],
                 }
+            ),
+        )
+        self.MERGED_REGION = (
+            f"{self.DL_DIR}sentinel/outputcop{self.START_DATE}"
+            "_clipped_4326.tiff"
+        )
+        try:
+            gdal.Warp(
+                self.MERGED_REGION,
+                sources,
+                dstSRS="EPSG:4326",
+                outputBounds=bounds,
+                width=width,
+                height=height,
+                cutlineDSName=cutline,
+                # later sources never overwrite earlier ones with zeros
+                srcNodata=0,
+                dstNodata=0,
+                resampleAlg="near",
+                multithread=True,
+                warpOptions=["NUM_THREADS=ALL_CPUS"],
+                creationOptions=["TILED=YES", "COMPRESS=DEFLATE"],
             )
-
-            file_name = self.MERGED_4326.split("/")[-1].split("_")
-            file_name = "".join(file_name[0:-1])
-            self.MERGED_REGION = (
-                f"{self.DL_DIR}sentinel/{file_name}_clipped_4326.tiff"
+        finally:
+            gdal.Unlink(cutline)
+        with rasterio.open(self.MERGED_REGION, "r+") as src:
+            if self.band_order is not None:
+                src.descriptions = self.band_order
+            write_calibration(src, self.band_calibration)
+            self.telemetry.count("pixels", src.width * src.height)
+            return src.read() if self.READ else None
+
+    def _band_files(self, pattern=".jp2"):
+        """
+        This function lists the needed band images of every product
+        Inputs:
+            pattern: extension of the band images
+        Returns:
+            products: product directory name mapped to sorted band paths
+        """
+        products = {}
+        for root, _, files in os.walk(self.DL_DIR):
+            for f in files:
+                path = os.path.join(root, f)
+                if f.endswith(pattern) and self._needed(path):
+                    product = os.path.relpath(path, self.DL_DIR)
+                    product = product.split(os.sep)[0]
+                    products.setdefault(product, []).append(path)
+        return {name: sorted(paths) for name, paths in products.items()}
+
+    @staged()
+    def phase_lazy(self, products=None):
+        """
+        Building in-process VRTs straight over the .jp2 bands and warping
+        the area of interest onto the shared EPSG:4326 grid in a single
+        step, so only the code-blocks intersecting the area are decoded.
+        Products without the DN offset of baseline 04.00 are shifted to it
+        in their VRT when mosaicked with products that have it.
+        """
+        if products is None:
+            products = {**self._band_files(), **self.vsizip_products}
+        if len(products) == 0:
+            raise Exception("No band images to mosaic")
+        vrts = []
+        offset = min(dn_offset(dir_name) for dir_name in products)
+        for dir_name, paths in products.items():
+            config_dict = {band_name(path): i for i, path in enumerate(paths)}
+            self.band_order = tuple(config_dict)
+            res_type = "-".join(self.RES_TYPES)
+            with open(f"./data/{dir_name}-{res_type}.json", "w") as outfile:
+                json.dump(config_dict, outfile)
+            vrts.append(
+                stack_vrt(
+                    f"{self.VSIMEM}/{dir_name}.vrt",
+                    paths,
+                    dn_offset(dir_name) - offset,
+                )
             )
-            with rasterio.open(self.MERGED_REGION, "w", **out_meta) as dest:
-                dest.write(out_image)
-            return out_image
+        self.band_calibration = band_calibration(self.band_order, offset)
+        try:
+            return self._warp_to_grid(vrts)
+        finally:
+            vrts = None
+            for dir_name in products:
+                gdal.Unlink(f"{self.VSIMEM}/{dir_name}.vrt")
+
+    @staged()
+    def phase_raster(self, source, bands=None, calibration=None):
+        """
+        Warping an already mosaicked raster, such as an output_cop or a
+        SentinelHub mosaic, onto the shared EPSG:4326 grid of the area of
+        interest, so that the mosaics of both dates line up
+        Inputs:
+            source: path of the mosaic
+            bands: band names of the mosaic in band order
+            calibration: scale and offset of the bands in band order
+        Returns:
+            mosaic: area of interest of the mosaic in EPSG:4326
+        """
+        self.aoi_footprint = aoi_footprint(self.INPUT_FILE)
+        self.band_order = bands
+        self.band_calibration = calibration
+        return self._warp_to_grid([source])
+
+    @staged()
+    def phase_local(self, sources):
+        """
+        Mosaicking already downloaded products without the network. The
+        sources are read in place, .SAFE folders (or folders holding them)
+        directly and .zip archives through GDAL's /vsizip/
+        Inputs:
+            sources: paths of .SAFE folders, folders or .zip archives
+        Returns:
+            mosaic: area of interest of the products in EPSG:4326
+        """
+        self.aoi_footprint = aoi_footprint(self.INPUT_FILE)
+        products = {}
+        for source in map(pathlib.Path, sources):
+            if source.suffix == ".zip":
+                with zipfile.ZipFile(source, "r") as zip_ref:
+                    names = zip_ref.namelist()
+                for name in names:
+                    if name.endswith(".jp2") and self._needed(name):
+                        product = pathlib.PurePosixPath(name).parts[0]
+                        products.setdefault(product, []).append(
+                            f"/vsizip/{source}/{name}"
+                        )
+                continue
+            for root, _, files in os.walk(source):
+                for f in files:
+                    path = pathlib.Path(root, f)
+                    if f.endswith(".jp2") and self._needed(str(path)):
+                        product = next(
+                            (p for p in path.parts if p.endswith(".SAFE")),
+                            source.name,
+                        )
+                        products.setdefault(product, []).append(str(path))
+        products = {name: sorted(paths) for name, paths in products.items()}
+        return self.phase_lazy(products)
 
     def ss_process(self):
         self.phase_1()
-        self.phase_2()
-        self.phase_3()
-        self.phase_4()
-        self.phase_5()
+        if not self.phase_cached():
+            self.phase_2()
+            self.phase_3()
+            self.phase_4()
+            self.phase_5()
         self.phase_6()
+        if self.LAZY or self.EXTRACT == "vsizip":
+            mosaic = self.phase_lazy()
+            self.phase8ab(glob(f"{self.DL_DIR}/*/", recursive=True))
+            for archive in self.vsizip_archives:
+                os.remove(archive)
+            return mosaic, "cop"
         dirs = self.phase_7()
         _, download_type = self.phase8b()
         self.phase8ab(dirs)
-        self.phase_9()
-        mosaic = self.phase_10()
+        mosaic = self.phase_warp()
         return mosaic, download_type
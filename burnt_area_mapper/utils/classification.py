@@ -0,0 +1,70 @@
+import numpy as np
+
+# inclusive upper bounds of the dNBR severity intervals; the intervals are
+# contiguous so every value lands in exactly one class
+DNBR_BREAKS = (-13.0, -0.25, -0.1, 0.1, 0.27, 0.44, 0.66, 40.0)
+# class code of every interval, the last one takes values above the last
+# break; NaN, e.g. outside of the area or without signal, is CLASS_NODATA
+DNBR_CLASSES = (1, 2, 3, 4, 5, 6, 7, 8, 60)
+
+RASTER_CLASSES = {
+    "1": "Water",
+    "2": "Enhanced regrowth, high (post-fire)",
+    "3": "Enhanced regrowth, low (post-fire)",
+    "4": "Unburned",
+    "5": "Low Severity",
+    "6": "Moderate-low Severity",
+    "7": "Moderate-high Severity",
+    "8": "High Severity",
+    "60": "Unclassified",
+}
+
+# RGBA colour of every class, as drawn by plot_burn_severity; values above
+# its colorbar (60) are drawn purple as well
+CLASS_COLORS = {
+    1: (0, 0, 255, 255),
+    2: (255, 0, 0, 255),
+    3: (255, 165, 0, 255),
+    4: (0, 128, 0, 255),
+    5: (255, 255, 0, 255),
+    6: (165, 42, 42, 255),
+    7: (238, 130, 238, 255),
+    8: (128, 0, 128, 255),
+    60: (128, 0, 128, 255),
+}
+# value of the class rasters where no class is set
+CLASS_NODATA = 0
+
+# elements classified per chunk, bounds the bin index temporary
+CHUNK_SIZE = 1 << 22
+
+
+def classify_dnbr(dnbr, breaks=DNBR_BREAKS, classes=DNBR_CLASSES):
+    """
+    This function maps dNBR values to severity classes in a single pass
+    over a binned lookup table, NaN values to CLASS_NODATA
+    Inputs:
+        dnbr: numpy ndarray of dNBR values
+        breaks: increasing, inclusive upper bounds of the class intervals
+        classes: class code of every interval, one more than breaks
+    Returns:
+        classified: uint8 numpy ndarray of class codes
+    """
+    if len(classes) != len(breaks) + 1:
+        raise ValueError("Expected one more class than breakpoints")
+    dtype = dnbr.dtype if np.issubdtype(dnbr.dtype, np.floating) else None
+    bins = np.asarray(breaks, dtype=dtype)
+    if np.any(np.diff(bins) <= 0):
+        raise ValueError("Breakpoints have to be strictly increasing")
+    lut = np.asarray(classes, dtype=np.uint8)
+    flat = dnbr.reshape(-1)
+    classified = np.empty(flat.shape, dtype=np.uint8)
+    for start in range(0, flat.size, CHUNK_SIZE):
+        chunk = slice(start, start + CHUNK_SIZE)
+        bin_index = np.digitize(flat[chunk], bins, right=True)
+        np.take(lut, bin_index, out=classified[chunk])
+        if dtype is not None:
+            np.copyto(
+                classified[chunk], CLASS_NODATA, where=np.isnan(flat[chunk])
+            )
+    return classified.reshape(dnbr.shape)
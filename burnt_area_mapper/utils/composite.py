@@ -0,0 +1,104 @@
+import warnings
+
+import numpy as np
+
+# score added to cloudy observations so any clear one takes precedence
+CLOUDY_PENALTY = 1000
+
+
+class Compositor:
+    def __init__(
+        self,
+        method="least_cloudy",
+        cloud_band=3,
+        probability_band=4,
+        max_observations=8,
+    ):
+        """
+        Per pixel cloud-free compositing of several acquisitions of a window
+        Inputs:
+            method: "least_cloudy" keeps the clear observation with the lowest
+                cloud probability, "median" the median of clear observations
+            cloud_band: position of the CLM band, 0 is clear
+            probability_band: position of the CLP band
+            max_observations: acquisitions kept for the median, the least
+                cloudy ones whatever the order they are added in
+        """
+        if method not in ("least_cloudy", "median"):
+            raise ValueError(f"Unknown compositing method {method}")
+        self.method = method
+        self.cloud_band = cloud_band
+        self.probability_band = probability_band
+        self.max_observations = max_observations
+        self.dates = set()
+        self.image = None
+        self.score = None
+        self.observations = []
+
+    def add(self, image, date):
+        """
+        This function merges a new acquisition into the composite
+        Inputs:
+            image: numpy ndarray of shape (height, width, bands)
+            date: acquisition date, acquisitions already merged are skipped
+        """
+        if date in self.dates:
+            return
+        self.dates.add(date)
+        cloudy = image[:, :, self.cloud_band] != 0
+        score = image[:, :, self.probability_band].astype(np.float32)
+        np.add(score, CLOUDY_PENALTY, out=score, where=cloudy)
+        if self.image is None:
+            self.image = image.copy()
+            self.score = score
+        else:
+            better = score < self.score
+            self.image[better] = image[better]
+            np.minimum(self.score, score, out=self.score)
+        if self.method == "median":
+            # kept in the image dtype with the cloud mask next to it; past
+            # max_observations the cloudiest is dropped, ties by date
+            self.observations.append(
+                (float(cloudy.mean()), str(date), image, cloudy)
+            )
+            self.observations.sort(key=lambda o: o[:2])
+            del self.observations[self.max_observations :]
+
+    def cloud_percentage(self):
+        """
+        This function computes the share of pixels without clear observation
+        Returns:
+            percentage_cloud: percentage of pixels still cloudy
+        """
+        if self.score is None:
+            return 100.0
+        return float(np.mean(self.score >= CLOUDY_PENALTY) * 100)
+
+    def result(self):
+        """
+        This function returns the composite
+        Returns:
+            image: numpy ndarray of shape (height, width, bands)
+        """
+        if self.image is None:
+            raise ValueError("No acquisitions were added to the composite")
+        if self.method == "least_cloudy" or len(self.observations) < 2:
+            return self.image
+        # pixels never clear and the cloud bands come from the best pick
+        median = self.image.astype(np.float32)
+        cloudy = np.stack([o[3] for o in self.observations])
+        for band in range(median.shape[2]):
+            if band in (self.cloud_band, self.probability_band):
+                continue
+            # one band at a time so the float32 stack stays small
+            stack = np.stack(
+                [o[2][:, :, band] for o in self.observations],
+                dtype=np.float32,
+            )
+            stack[cloudy] = np.nan
+            with warnings.catch_warnings():
+                # all NaN pixels keep the least cloudy pick
+                warnings.simplefilter("ignore", RuntimeWarning)
+                values = np.nanmedian(stack, axis=0)
+            np.copyto(median[:, :, band], values, where=~np.isnan(values))
+        return median.astype(self.image.dtype)
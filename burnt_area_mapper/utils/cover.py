@@ -0,0 +1,72 @@
+import heapq
+
+import numpy as np
+import shapely
+from shapely import STRtree
+
+
+def min_cover(U, min_gain=0.001):
+    """
+    This algorithm selects a small set of footprints covering the union of
+    all of them with a lazy greedy set cover.
+
+    Every footprint is parsed once into a shapely geometry array and indexed
+    in an STRtree. The candidate with the largest area not yet covered is
+    picked next; its gain is only re-evaluated against the already picked
+    footprints that intersect it, and stale gains are pushed back on the
+    heap (gains can only shrink as the cover grows). A final pass drops
+    picked footprints that the rest of the cover already contains.
+
+    The input order (e.g. least cloudy first) only breaks ties between
+    equal gains, so a large cloudy footprint is picked before a smaller
+    clear one that adds less; callers that need clear scenes filter by
+    cloud cover first.
+
+    performance:
+    input: list of n footprints
+    output: same or smaller cover than min_cover_1 followed by min_cover_2
+    time: O(n log n) heap operations, every gain evaluation only touches the
+    neighbours returned by the STRtree
+
+    Inputs:
+        U: list of dictionaries with a "footprint" WKT, sorted by preference
+        min_gain: area a footprint has to add to the cover to be kept
+    Returns:
+        cover: selected dictionaries in their original order
+    """
+    if len(U) == 0:
+        return []
+    geoms = shapely.from_wkt([x["footprint"] for x in U])
+    areas = shapely.area(geoms)
+    tree = STRtree(geoms)
+    picked = np.zeros(len(U), dtype=bool)
+
+    def uncovered_area(i):
+        neighbours = tree.query(geoms[i])
+        neighbours = neighbours[picked[neighbours] & (neighbours != i)]
+        if len(neighbours) == 0:
+            return areas[i]
+        covered = shapely.union_all(geoms[neighbours])
+        return areas[i] - shapely.area(shapely.intersection(geoms[i], covered))
+
+    # ties are broken by the input order, i.e. the caller's preference
+    heap = [(-area, i) for i, area in enumerate(areas)]
+    heapq.heapify(heap)
+    order = []
+    while heap:
+        _, i = heapq.heappop(heap)
+        gain = uncovered_area(i)
+        if gain < min_gain:
+            continue
+        if heap and gain < -heap[0][0]:
+            heapq.heappush(heap, (-gain, i))
+            continue
+        picked[i] = True
+        order.append(i)
+
+    # footprints picked early can end up covered by later ones
+    for i in reversed(order):
+        picked[i] = False
+        if uncovered_area(i) >= min_gain:
+            picked[i] = True
+    return [U[i] for i in np.flatnonzero(picked)]
@@ -1,4 +1,5 @@
 import geopandas as gpd
+import pandas as pd
 import rioxarray as rio
 import xarray as xr
 
@@ -39,6 +40,9 @@ class GeospatialRead:
         elif self.core_type == "vector":
             file = self._read_vector(driver=self.driver)
             return file
+        elif self.driver == "csv":
+            file = self._read_csv()
+            return file
         else:
             raise ValueError("File type not supported")
 
@@ -58,6 +62,15 @@ class GeospatialRead:
         raster = rio.open_rasterio(self.file)
         return raster
 
+    def _read_csv(self, geometry="geometry", crs="EPSG:4326"):
+        table = pd.read_csv(self.file)
+        vector = gpd.GeoDataFrame(
+            table.drop(columns=geometry),
+            geometry=gpd.GeoSeries.from_wkt(table[geometry]),
+            crs=crs,
+        )
+        return vector
+
     def _read_vector(self, driver="shp"):
         vector = gpd.read_file(filename=self.file)
         return vector
@@ -0,0 +1,139 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+import numpy as np
+import rasterio
+import rasterio.windows
+from affine import Affine
+from rasterio.windows import Window
+
+
+def mosaic_grid(paths):
+    """
+    This function computes the output grid of a mosaic from the bounds of
+    its sources, taking the resolution of the first one
+    Inputs:
+        paths: paths of the source rasters, all in the same CRS
+    Returns:
+        profile: rasterio profile of the mosaic
+        bounds: list of the bounds of every source
+    """
+    with ExitStack() as stack:
+        sources = [stack.enter_context(rasterio.open(p)) for p in paths]
+        first = sources[0]
+        bounds = [src.bounds for src in sources]
+    left = min(b.left for b in bounds)
+    bottom = min(b.bottom for b in bounds)
+    right = max(b.right for b in bounds)
+    top = max(b.top for b in bounds)
+    xres, yres = first.res
+    profile = {
+        "driver": "GTiff",
+        "width": int(round((right - left) / xres)),
+        "height": int(round((top - bottom) / yres)),
+        "count": first.count,
+        "dtype": first.dtypes[0],
+        "nodata": first.nodata,
+        "crs": first.crs,
+        "transform": Affine(xres, 0.0, left, 0.0, -yres, top),
+    }
+    return profile, bounds
+
+
+def stream_mosaic(paths, filename, window_size=1024, workers=None):
+    """
+    This function mosaics rasters window by window into a tiled, compressed
+    GeoTIFF; each window reads only the sources intersecting it and the
+    first source with valid data wins, as with rasterio.merge. Pixels
+    equal to the nodata value, or 0 without one, count as no data.
+    Inputs:
+        paths: paths of the source rasters, all in the same CRS
+        filename: path of the output GeoTIFF
+        window_size: side of a window in pixels, a multiple of 512
+        workers: number of threads, defaults to the cpu count
+    Returns:
+        filename: path of the mosaic
+    """
+    profile, bounds = mosaic_grid(paths)
+    profile.update(
+        tiled=True,
+        blockxsize=512,
+        blockysize=512,
+        compress="deflate",
+        bigtiff="IF_SAFER",
+    )
+    width, height = profile["width"], profile["height"]
+    count, transform = profile["count"], profile["transform"]
+    fill = profile["nodata"] or 0
+    windows = [
+        Window(
+            col,
+            row,
+            min(window_size, width - col),
+            min(window_size, height - row),
+        )
+        for row in range(0, height, window_size)
+        for col in range(0, width, window_size)
+    ]
+
+    # rasterio datasets are not thread safe, every thread opens its own
+    local = threading.local()
+    opened = []
+    lock = threading.Lock()
+
+    def source(i):
+        handles = getattr(local, "handles", None)
+        if handles is None:
+            handles = local.handles = {}
+        if i not in handles:
+            handles[i] = rasterio.open(paths[i])
+            with lock:
+                opened.append(handles[i])
+        return handles[i]
+
+    with rasterio.open(filename, "w", **profile) as dst:
+
+        def run(window):
+            left, bottom, right, top = rasterio.windows.bounds(
+                window, transform
+            )
+            shape = (count, int(window.height), int(window.width))
+            data = np.full(shape, fill, dtype=profile["dtype"])
+            empty = np.ones(shape, dtype=bool)
+            for i, b in enumerate(bounds):
+                if (
+                    b.left >= right
+                    or b.right <= left
+                    or b.bottom >= top
+                    or b.top <= bottom
+                ):
+                    continue
+                src = source(i)
+                block = src.read(
+                    window=rasterio.windows.from_bounds(
+                        left, bottom, right, top, transform=src.transform
+                    ),
+                    out_shape=shape,
+                    boundless=True,
+                    masked=True,
+                )
+                # pixels equal to the fill are empty as well, sources
+                # without nodata are zero outside of their swath
+                take = empty & ~np.ma.getmaskarray(block)
+                take &= block.data != fill
+                np.copyto(data, block.data, where=take)
+                empty &= ~take
+            with lock:
+                dst.write(data, window=window)
+
+        try:
+            with ThreadPoolExecutor(
+                max_workers=workers or os.cpu_count()
+            ) as executor:
+                list(executor.map(run, windows))
+        finally:
+            for src in opened:
+                src.close()
+    return filename
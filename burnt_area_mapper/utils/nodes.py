@@ -0,0 +1,149 @@
+import hashlib
+import os
+import xml.etree.ElementTree as ET
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+# bytes of a node streamed to disk at once
+CHUNK_BYTES = 1024**2
+# concurrent node downloads when no number of workers is given
+NODE_WORKERS = 8
+# seconds to wait for the server to answer
+TIMEOUT = 60
+
+
+def node_url(api_url, uuid, path):
+    """
+    This function builds the OData URL of a file inside a product
+    Inputs:
+        api_url: root of the API, e.g. https://apihub.copernicus.eu/apihub/
+        uuid: product UUID
+        path: path of the file inside the product, e.g. X.SAFE/manifest.safe
+    Returns:
+        url: URL of the value of the node
+    """
+    nodes = "/".join(f"Nodes('{quote(part)}')" for part in path.split("/"))
+    return f"{api_url.rstrip('/')}/odata/v1/Products('{uuid}')/{nodes}/$value"
+
+
+def manifest_files(manifest):
+    """
+    This function lists the files a manifest.safe describes
+    Inputs:
+        manifest: content of the manifest.safe
+    Returns:
+        files: list of (path relative to the .SAFE, size, MD5 or None)
+    """
+    files = []
+    for element in ET.fromstring(manifest).iter():
+        if element.tag.rsplit("}", 1)[-1] != "byteStream":
+            continue
+        href, md5 = None, None
+        for child in element:
+            tag = child.tag.rsplit("}", 1)[-1]
+            if tag == "fileLocation":
+                href = child.get("href")
+            elif tag == "checksum" and child.get("checksumName") == "MD5":
+                md5 = (child.text or "").strip() or None
+        if href is not None:
+            path = href[2:] if href.startswith("./") else href
+            files.append((path, int(element.get("size", 0)), md5))
+    return files
+
+
+def fetch_node(session, url, path, md5=None):
+    """
+    This function streams a node to disk, through a temporary file so that
+    an interrupted download never looks complete
+    Inputs:
+        session: requests session, authenticated for the API
+        url: URL of the node
+        path: path of the file written
+        md5: expected MD5 of the file, checked when given
+    Returns:
+        size: bytes downloaded
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    digest = hashlib.md5()
+    size = 0
+    tmp = f"{path}.part"
+    with session.get(url, stream=True, timeout=TIMEOUT) as response:
+        response.raise_for_status()
+        with open(tmp, "wb") as outfile:
+            for chunk in response.iter_content(CHUNK_BYTES):
+                outfile.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+    if md5 is not None and digest.hexdigest().lower() != md5.lower():
+        os.remove(tmp)
+        raise IOError(f"Checksum mismatch of {url}")
+    os.replace(tmp, path)
+    return size
+
+
+def download_nodes(session, api_url, products, directory, needed, workers):
+    """
+    This function downloads only the needed files of several products and
+    lays them out as minimal .SAFE folders, the manifest of every product is
+    fetched first and all the files then share one pool of workers
+    Inputs:
+        session: requests session, authenticated for the API
+        api_url: root of the API
+        products: list of (UUID, title) of the products
+        directory: folder the .SAFE folders are written to
+        needed: predicate of the paths within the product to download
+        workers: number of concurrent downloads
+    Returns:
+        size: bytes downloaded
+    """
+    workers = workers or NODE_WORKERS
+
+    def manifest(product):
+        uuid, title = product
+        path = f"{title}.SAFE/manifest.safe"
+        target = os.path.join(directory, path)
+        fetch_node(session, node_url(api_url, uuid, path), target)
+        with open(target, "rb") as f:
+            files = manifest_files(f.read())
+        selected = [
+            (uuid, f"{title}.SAFE/{name}", md5)
+            for name, _, md5 in files
+            if needed(f"{title}.SAFE/{name}")
+        ]
+        if len(selected) == 0:
+            raise FileNotFoundError(f"No needed band images in {title}")
+        return os.path.getsize(target), selected
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        manifests = list(executor.map(manifest, products))
+        nodes = [node for _, selected in manifests for node in selected]
+        sizes = executor.map(
+            lambda node: fetch_node(
+                session,
+                node_url(api_url, node[0], node[1]),
+                os.path.join(directory, node[1]),
+                node[2],
+            ),
+            nodes,
+        )
+        return sum(size for size, _ in manifests) + sum(sizes)
+
+
+def pack_safe(safe, filename):
+    """
+    This function stores a .SAFE folder in an uncompressed archive, laid out
+    like the archives of the API so it is read back the same way
+    Inputs:
+        safe: path of the .SAFE folder
+        filename: path of the .zip archive
+    Returns:
+        filename: path of the .zip archive
+    """
+    root = os.path.dirname(os.path.normpath(safe))
+    with zipfile.ZipFile(filename, "w", zipfile.ZIP_STORED) as archive:
+        for folder, _, files in os.walk(safe):
+            for f in files:
+                path = os.path.join(folder, f)
+                archive.write(path, os.path.relpath(path, root))
+    return filename
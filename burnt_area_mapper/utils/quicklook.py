@@ -0,0 +1,170 @@
+import hashlib
+import json
+import os
+from math import ceil
+
+import numpy as np
+import rasterio
+from osgeo import gdal
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+from utils.classification import CLASS_COLORS, CLASS_NODATA, RASTER_CLASSES
+
+# pixels of the class raster decimated at once
+DECIMATE_PIXELS = 1 << 24
+
+
+def palette_lut(colors=CLASS_COLORS):
+    """
+    This function builds the lookup table from class value to colour,
+    nodata and unused values are transparent
+    Inputs:
+        colors: class value mapped to RGBA
+    Returns:
+        lut: uint8 numpy ndarray of shape (256, 4)
+    """
+    lut = np.zeros((256, 4), dtype=np.uint8)
+    for value, color in colors.items():
+        lut[int(value)] = color
+    return lut
+
+
+def mode_decimate(classes, factor, values=tuple(CLASS_COLORS)):
+    """
+    This function shrinks a class raster by taking the most frequent class
+    of every factor x factor block, nodata only wins empty blocks
+    Inputs:
+        classes: uint8 numpy ndarray of class values
+        factor: decimation factor
+        values: class values counted, ties go to the first one
+    Returns:
+        decimated: uint8 numpy ndarray of shape ceil(shape / factor)
+    """
+    if factor <= 1:
+        return classes
+    height, width = classes.shape
+    rows, cols = ceil(height / factor), ceil(width / factor)
+    decimated = np.full((rows, cols), CLASS_NODATA, dtype=np.uint8)
+    chunk = max(1, DECIMATE_PIXELS // (cols * factor * factor))
+    for row in range(0, rows, chunk):
+        strip = classes[row * factor : (row + chunk) * factor]
+        n = ceil(strip.shape[0] / factor)
+        blocks = np.full(
+            (n * factor, cols * factor), CLASS_NODATA, dtype=np.uint8
+        )
+        blocks[: strip.shape[0], :width] = strip
+        blocks = blocks.reshape(n, factor, cols, factor)
+        best = np.zeros((n, cols), dtype=np.int32)
+        out = decimated[row : row + n]
+        for value in values:
+            count = np.count_nonzero(blocks == value, axis=(1, 3))
+            better = count > best
+            out[better] = value
+            best[better] = count[better]
+    return decimated
+
+
+def read_decimated(filename, max_size=1024):
+    """
+    This function reads a class raster at most max_size pixels wide and
+    high, from its overviews when it has some (e.g. the COG output) and by
+    mode decimation of row strips otherwise
+    Inputs:
+        filename: path of the class raster
+        max_size: longest side of the result in pixels
+    Returns:
+        classes: uint8 numpy ndarray
+    """
+    with rasterio.open(filename) as src:
+        factor = max(1, ceil(max(src.width, src.height) / max_size))
+        shape = (ceil(src.height / factor), ceil(src.width / factor))
+        if factor == 1:
+            return src.read(1)
+        if src.overviews(1):
+            return src.read(1, out_shape=shape, resampling=Resampling.mode)
+        rows = max(1, DECIMATE_PIXELS // src.width // factor) * factor
+        strips = []
+        for row in range(0, src.height, rows):
+            window = Window(0, row, src.width, min(rows, src.height - row))
+            strips.append(mode_decimate(src.read(1, window=window), factor))
+    return np.vstack(strips)
+
+
+def write_png(classes, filename, colors=CLASS_COLORS):
+    """
+    This function writes a class raster as a paletted PNG
+    Inputs:
+        classes: uint8 numpy ndarray of class values
+        filename: path of the PNG
+        colors: class value mapped to RGBA
+    Returns:
+        filename: path of the PNG
+    """
+    height, width = classes.shape
+    dataset = gdal.GetDriverByName("MEM").Create(
+        "", width, height, 1, gdal.GDT_Byte
+    )
+    band = dataset.GetRasterBand(1)
+    band.WriteArray(classes)
+    color_table = gdal.ColorTable()
+    for value, color in enumerate(palette_lut(colors)):
+        color_table.SetColorEntry(value, tuple(int(c) for c in color))
+    band.SetRasterColorTable(color_table)
+    gdal.GetDriverByName("PNG").CreateCopy(filename, dataset, strict=0)
+    dataset = band = None
+    return filename
+
+
+def quicklook(image, filename, max_size=1024):
+    """
+    This function renders a thumbnail of a class raster
+    Inputs:
+        image: uint8 numpy ndarray of classes or path of a class raster
+        filename: path of the PNG
+        max_size: longest side of the thumbnail in pixels
+    Returns:
+        filename: path of the PNG
+    """
+    if isinstance(image, (str, os.PathLike)):
+        classes = read_decimated(image, max_size)
+    else:
+        factor = max(1, ceil(max(image.shape) / max_size))
+        classes = mode_decimate(image.astype(np.uint8, copy=False), factor)
+    return write_png(classes, filename)
+
+
+def legend(directory="./data/", classes=RASTER_CLASSES, colors=CLASS_COLORS):
+    """
+    This function renders the legend of the classes once; it is cached by
+    the hash of the classes and colours so batch runs reuse it
+    Inputs:
+        directory: folder of the legend image
+        classes: class value mapped to name
+        colors: class value mapped to RGBA
+    Returns:
+        filename: path of the legend PNG
+    """
+    key = hashlib.sha1(
+        json.dumps([classes, colors], sort_keys=True, default=str).encode()
+    ).hexdigest()[:12]
+    filename = os.path.join(directory, f"legend_{key}.png")
+    if os.path.exists(filename):
+        return filename
+    # matplotlib is only needed for the text, once per set of classes
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.patches as mpatches
+    import matplotlib.pyplot as plt
+
+    handles = [
+        mpatches.Patch(color=np.asarray(colors[int(value)]) / 255, label=name)
+        for value, name in classes.items()
+    ]
+    fig = plt.figure(figsize=(3.5, 0.3 * len(handles)))
+    fig.legend(handles=handles, loc="center", frameon=False)
+    tmp = f"{filename}.{os.getpid()}.png"
+    fig.savefig(tmp, bbox_inches="tight", transparent=True)
+    plt.close(fig)
+    os.replace(tmp, filename)
+    return filename
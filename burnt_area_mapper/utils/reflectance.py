@@ -0,0 +1,105 @@
+import re
+
+import rasterio
+
+# reflectance of a single DN of the Sentinel-2 reflectance bands
+REFLECTANCE_SCALE = 1e-4
+# DN offset of products of processing baseline 04.00 and later
+# (BOA_ADD_OFFSET of L2A, RADIO_ADD_OFFSET of L1C)
+BASELINE_OFFSET = -1000
+# first processing baseline with the offset, as in the N0400 of the name
+OFFSET_BASELINE = 400
+
+
+def processing_baseline(name):
+    """
+    This function reads the processing baseline from a product name
+    Inputs:
+        name: product name or path, e.g. S2B_MSIL2A_..._N0509_R073_...
+    Returns:
+        baseline: baseline as an int such as 509 or None if not named
+    """
+    match = re.search(r"_N(\d{4})_", str(name))
+    if match is None:
+        return None
+    return int(match.group(1))
+
+
+def dn_offset(name):
+    """
+    This function returns the DN offset of the bands of a product
+    Inputs:
+        name: product name or path
+    Returns:
+        offset: BASELINE_OFFSET from baseline 04.00 on, 0 before
+    """
+    baseline = processing_baseline(name)
+    if baseline is not None and baseline >= OFFSET_BASELINE:
+        return BASELINE_OFFSET
+    return 0
+
+
+def band_calibration(bands, offset=0):
+    """
+    This function builds the GDAL scale and offset of every band, so that
+    reflectance = DN * scale + offset. Non reflectance bands such as the
+    CLM and CLP cloud bands are left as they are.
+    Inputs:
+        bands: band names in band order
+        offset: DN offset of the reflectance bands
+    Returns:
+        calibration: tuple of (scale, offset) per band
+    """
+    return tuple(
+        (
+            (REFLECTANCE_SCALE, offset * REFLECTANCE_SCALE)
+            if re.fullmatch(r"B\d[\dA]", band)
+            else (1.0, 0.0)
+        )
+        for band in bands
+    )
+
+
+def dn_offsets(calibration):
+    """
+    This function converts the band offsets back to DN; normalized
+    differences and band ratios of bands sharing a scale only depend on
+    the DN offsets, so the kernels add those and never scale
+    Inputs:
+        calibration: tuple of (scale, offset) per band or None
+    Returns:
+        offsets: tuple of DN offsets per band or None without calibration
+    """
+    if calibration is None:
+        return None
+    return tuple(offset / scale for scale, offset in calibration)
+
+
+def raster_calibration(filename):
+    """
+    This function reads the scale and offset a raster records per band
+    Inputs:
+        filename: path of the raster
+    Returns:
+        calibration: tuple of (scale, offset) per band or None if the
+        raster records none
+    """
+    with rasterio.open(filename) as src:
+        calibration = tuple(zip(src.scales, src.offsets))
+    if all(c == (1.0, 0.0) for c in calibration):
+        return None
+    return calibration
+
+
+def write_calibration(dataset, calibration):
+    """
+    This function records the scale and offset of every band of an open
+    rasterio dataset
+    Inputs:
+        dataset: rasterio dataset opened for writing
+        calibration: tuple of (scale, offset) per band or None
+    """
+    if calibration is None:
+        return
+    dataset.scales = [scale for scale, _ in calibration]
+    dataset.offsets = [offset for _, offset in calibration]
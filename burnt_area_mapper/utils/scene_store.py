@@ -0,0 +1,258 @@
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import sqlite3
+import threading
+import time
+
+import shapely
+
+
+class SceneStore:
+    """
+    Persistent, content-addressed store of downloaded scenes.
+
+    Scenes are keyed by product UUID (Copernicus) or by a request hash
+    (SentinelHub) and kept under root/<key[:2]>/<key><suffix>. An SQLite
+    database holds the scene records and an R-tree of their footprints so
+    that coverage of an area and time window can be answered without the
+    network. The store is bounded in size and evicts least recently used
+    scenes.
+    """
+
+    def __init__(self, root="./data/store/", max_bytes=50 * 1024**3):
+        self.root = pathlib.Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            self.root / "index.sqlite", timeout=60, check_same_thread=False
+        )
+        with self._lock, self._db:
+            self._db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS scenes (
+                    id INTEGER PRIMARY KEY,
+                    key TEXT UNIQUE NOT NULL,
+                    path TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    sensing_start TEXT,
+                    sensing_end TEXT,
+                    footprint TEXT,
+                    last_access REAL NOT NULL
+                )
+                """
+            )
+            self._db.execute(
+                """
+                CREATE VIRTUAL TABLE IF NOT EXISTS scene_index
+                USING rtree(id, minx, maxx, miny, maxy)
+                """
+            )
+
+    @staticmethod
+    def request_key(*parts):
+        """
+        This function hashes the parameters of a request into a store key
+        Inputs:
+            parts: anything identifying the request, e.g. evalscript and dates
+        Returns:
+            key: sha256 hex digest
+        """
+        payload = json.dumps(parts, default=str, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _path(self, key, suffix=""):
+        return self.root / key[:2] / f"{key}{suffix}"
+
+    def get(self, key):
+        """
+        This function looks a scene up and marks it as recently used
+        Inputs:
+            key: product UUID or request hash
+        Returns:
+            path: path of the stored scene or None
+        """
+        with self._lock, self._db:
+            row = self._db.execute(
+                "SELECT id, path FROM scenes WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if not os.path.exists(row[1]):
+                self._delete(row[0])
+                return None
+            self._db.execute(
+                "UPDATE scenes SET last_access = ? WHERE id = ?",
+                (time.time(), row[0]),
+            )
+        return row[1]
+
+    def put(
+        self, key, src, footprint=None, sensing_start=None, sensing_end=None
+    ):
+        """
+        This function adds a file or directory to the store; a hard link
+        is used where possible so that no extra space is taken
+        Inputs:
+            key: product UUID or request hash
+            src: path of the scene to store
+            footprint: shapely geometry or WKT of the scene in EPSG:4326
+            sensing_start: start of the sensing time window
+            sensing_end: end of the sensing time window
+        Returns:
+            path: path of the stored scene
+        """
+        src = pathlib.Path(src)
+        suffix = "".join(src.suffixes) if src.is_file() else src.suffix
+        dst = self._path(key, suffix)
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        if not dst.exists():
+            link(src, dst)
+        if dst.is_dir():
+            size = sum(p.stat().st_size for p in dst.rglob("*") if p.is_file())
+        else:
+            size = dst.stat().st_size
+        if isinstance(footprint, str):
+            footprint = shapely.from_wkt(footprint)
+        with self._lock, self._db:
+            old = self._db.execute(
+                "SELECT id FROM scenes WHERE key = ?", (key,)
+            ).fetchone()
+            if old is not None:
+                self._db.execute("DELETE FROM scenes WHERE id = ?", old)
+                self._db.execute("DELETE FROM scene_index WHERE id = ?", old)
+            cursor = self._db.execute(
+                """
+                INSERT INTO scenes (key, path, size, sensing_start,
+                                    sensing_end, footprint, last_access)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    key,
+                    str(dst),
+                    size,
+                    _iso(sensing_start),
+                    _iso(sensing_end),
+                    None if footprint is None else footprint.wkt,
+                    time.time(),
+                ),
+            )
+            if footprint is not None:
+                minx, miny, maxx, maxy = footprint.bounds
+                self._db.execute(
+                    "INSERT INTO scene_index VALUES (?, ?, ?, ?, ?)",
+                    (cursor.lastrowid, minx, maxx, miny, maxy),
+                )
+        self.evict(keep=key)
+        return str(dst)
+
+    def covered(self, aoi, start_date, end_date):
+        """
+        This function finds the stored scenes sensed within a time window
+        whose footprints intersect the area of interest
+        Inputs:
+            aoi: shapely geometry of the area of interest in EPSG:4326
+            start_date: first day of the window
+            end_date: last day of the window, inclusive
+        Returns:
+            scenes: list of dictionaries with key, path, footprint and dates
+            full: whether the scenes cover the whole area of interest
+        """
+        minx, miny, maxx, maxy = aoi.bounds
+        with self._lock:
+            rows = self._db.execute(
+                """
+                SELECT s.key, s.path, s.footprint, s.sensing_start,
+                       s.sensing_end
+                FROM scenes s JOIN scene_index i ON s.id = i.id
+                WHERE i.minx <= ? AND i.maxx >= ? AND i.miny <= ?
+                  AND i.maxy >= ? AND s.sensing_start >= ?
+                  AND s.sensing_end <= ?
+                ORDER BY s.sensing_start
+                """,
+                (
+                    maxx,
+                    minx,
+                    maxy,
+                    miny,
+                    _iso(start_date)[:10],
+                    _iso(end_date)[:10] + "T23:59:59.999999",
+                ),
+            ).fetchall()
+        footprints = shapely.from_wkt([row[2] for row in rows])
+        hits = shapely.intersects(footprints, aoi)
+        scenes = [
+            {
+                "key": row[0],
+                "path": row[1],
+                "footprint": row[2],
+                "sensing_start": row[3],
+                "sensing_end": row[4],
+            }
+            for row, hit in zip(rows, hits)
+            if hit and os.path.exists(row[1])
+        ]
+        if len(scenes) == 0:
+            return scenes, False
+        union = shapely.union_all(
+            shapely.from_wkt([scene["footprint"] for scene in scenes])
+        )
+        return scenes, aoi.difference(union).area < 1e-9
+
+    def evict(self, keep=None):
+        """
+        This function removes least recently used scenes until the store
+        fits into max_bytes
+        Inputs:
+            keep: key that must not be evicted, e.g. the scene just added
+        """
+        with self._lock, self._db:
+            total = self._db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM scenes"
+            ).fetchone()[0]
+            rows = self._db.execute(
+                "SELECT id, key, path, size FROM scenes ORDER BY last_access"
+            ).fetchall()
+            for scene_id, key, path, size in rows:
+                if total <= self.max_bytes:
+                    break
+                if key == keep:
+                    continue
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                elif os.path.exists(path):
+                    os.remove(path)
+                self._delete(scene_id)
+                total -= size
+
+    def _delete(self, scene_id):
+        self._db.execute("DELETE FROM scenes WHERE id = ?", (scene_id,))
+        self._db.execute("DELETE FROM scene_index WHERE id = ?", (scene_id,))
+
+
+def link(src, dst):
+    """
+    This function hard links a file or tree, copying across file systems
+    Inputs:
+        src: source file or directory
+        dst: destination path
+    """
+    src, dst = pathlib.Path(src), pathlib.Path(dst)
+    if src.is_dir():
+        shutil.copytree(src, dst, copy_function=link)
+        return
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def _iso(value):
+    if value is None:
+        return None
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return str(value)
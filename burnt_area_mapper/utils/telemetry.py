@@ -0,0 +1,278 @@
+import cProfile
+import functools
+import json
+import os
+import pstats
+import re
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# per process I/O counters of the kernel, missing outside of Linux
+PROC_IO = "/proc/self/io"
+
+
+def _io_bytes():
+    """
+    This function reads the bytes the process read from and wrote to storage
+    Returns:
+        read_bytes, write_bytes or (None, None) where unsupported
+    """
+    try:
+        with open(PROC_IO) as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+    except OSError:
+        return None, None
+    return int(fields["read_bytes"]), int(fields["write_bytes"])
+
+
+def _max_rss():
+    """
+    This function returns the peak resident set size of the process
+    Returns:
+        rss: bytes
+    """
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Telemetry:
+    """
+    Per stage wall time, CPU time, peak RSS growth, storage I/O and
+    counters such as downloaded bytes or processed pixels.
+
+    A stage costs two getrusage calls and two reads of /proc/self/io, so
+    it is cheap enough to stay enabled. CPU time, RSS and I/O are process
+    wide, stages running concurrently on several threads overlap in them.
+    With profile set, every stage also runs under a cProfile profiler of
+    its own, which pauses the one of the enclosing stage of the thread, and
+    the profiles of all the calls of a stage are merged into a single
+    <stage>.prof in profile_dir. From Python 3.12 on a single profiler runs
+    per process, a stage starting while another thread profiles is then
+    left out of the profiles.
+    """
+
+    def __init__(self, profile=False, profile_dir="./data/profile/"):
+        self.records = []
+        self.counters = {}
+        self.profile = profile
+        self.profile_dir = profile_dir
+        self.started = datetime.now(timezone.utc)
+        self._prefix = ""
+        self._lock = threading.Lock()
+        self._profiles = {}
+        self._profiling = threading.Lock()
+        self._local = threading.local()
+
+    def scoped(self, prefix):
+        """
+        This function returns a view of the telemetry that prefixes its
+        stage names, e.g. with the date a provider downloads
+        Inputs:
+            prefix: prefix of the stage names
+        Returns:
+            telemetry: Telemetry sharing the records of this one
+        """
+        view = object.__new__(Telemetry)
+        view.__dict__.update(self.__dict__)
+        view._prefix = f"{self._prefix}{prefix}."
+        return view
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def _profilers(self):
+        if not hasattr(self._local, "profilers"):
+            self._local.profilers = []
+        return self._local.profilers
+
+    @staticmethod
+    def _enable(profiler):
+        if profiler is None:
+            return None
+        try:
+            profiler.enable()
+        except ValueError:
+            # another thread holds the profiler of the process (3.12+)
+            return None
+        return profiler
+
+    @contextmanager
+    def stage(self, name):
+        """
+        This function measures the code run within the context
+        Inputs:
+            name: name of the stage
+        """
+        stack = self._stack()
+        record = {"stage": f"{self._prefix}{name}", "counters": {}}
+        profilers = self._profilers()
+        if self.profile and profilers and profilers[-1] is not None:
+            profilers[-1].disable()
+        stack.append(record)
+        read_bytes, write_bytes = _io_bytes()
+        rss = _max_rss()
+        cpu = time.process_time()
+        wall = time.perf_counter()
+        profiler = self._enable(cProfile.Profile()) if self.profile else None
+        if self.profile:
+            profilers.append(profiler)
+        try:
+            yield record
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            record["seconds"] = time.perf_counter() - wall
+            record["cpu_seconds"] = time.process_time() - cpu
+            record["rss_delta_bytes"] = _max_rss() - rss
+            if read_bytes is not None:
+                end_read, end_write = _io_bytes()
+                record["read_bytes"] = end_read - read_bytes
+                record["write_bytes"] = end_write - write_bytes
+            stack.pop()
+            if self.profile:
+                profilers.pop()
+                if profiler is not None:
+                    self._dump(profiler, record["stage"])
+                if profilers:
+                    profilers[-1] = self._enable(profilers[-1])
+            with self._lock:
+                self.records.append(record)
+
+    def _dump(self, profiler, name):
+        """
+        This function merges the profile of a stage call into the profile
+        of all the calls of that stage and writes it
+        Inputs:
+            profiler: disabled cProfile profiler of the call
+            name: name of the stage
+        """
+        try:
+            stats = pstats.Stats(profiler)
+        except TypeError:
+            # nothing was recorded
+            return
+        filename = re.sub(r"[^\w.-]", "_", name)
+        path = os.path.join(self.profile_dir, f"{filename}.prof")
+        with self._profiling:
+            if name in self._profiles:
+                self._profiles[name].add(stats)
+            else:
+                self._profiles[name] = stats
+            os.makedirs(self.profile_dir, exist_ok=True)
+            self._profiles[name].dump_stats(path)
+
+    def count(self, key, value):
+        """
+        This function adds to a counter of the innermost running stage of
+        the calling thread, or of the run when no stage is running
+        Inputs:
+            key: counter name, e.g. bytes_downloaded or pixels
+            value: amount to add
+        """
+        stack = self._stack()
+        with self._lock:
+            counters = stack[-1]["counters"] if stack else self.counters
+            counters[key] = counters.get(key, 0) + int(value)
+
+    def report(self):
+        """
+        This function summarizes the run
+        Returns:
+            report: dictionary of the stages, totals per stage name and
+            counter totals
+        """
+        with self._lock:
+            records = list(self.records)
+            totals = dict(self.counters)
+        stages = {}
+        for record in records:
+            stage = stages.setdefault(
+                record["stage"], {"calls": 0, "seconds": 0.0}
+            )
+            stage["calls"] += 1
+            stage["seconds"] += record["seconds"]
+            for key, value in record["counters"].items():
+                totals[key] = totals.get(key, 0) + value
+        return {
+            "started": self.started.isoformat(),
+            "seconds": round(
+                (datetime.now(timezone.utc) - self.started).total_seconds(), 3
+            ),
+            "totals": totals,
+            "stages": stages,
+            "records": records,
+        }
+
+    def write_json(self, filename, extra=None):
+        """
+        This function writes the run report, replacing any earlier one
+        Inputs:
+            filename: path of the JSON report
+            extra: additional entries of the report
+        Returns:
+            report: the written report
+        """
+        report = self.report()
+        report.update(extra or {})
+        with open(filename, "w") as outfile:
+            json.dump(report, outfile, indent=2, default=str)
+        return report
+
+    def write_prometheus(self, filename, prefix="burnt_area"):
+        """
+        This function writes the report in the Prometheus textfile format
+        of the node exporter, atomically through a temporary file
+        Inputs:
+            filename: path of the .prom file
+            prefix: prefix of the metric names
+        """
+        report = self.report()
+        lines = [
+            f"# HELP {prefix}_stage_seconds Wall time of a pipeline stage",
+            f"# TYPE {prefix}_stage_seconds gauge",
+        ]
+        for stage, values in report["stages"].items():
+            lines.append(
+                f'{prefix}_stage_seconds{{stage="{stage}"}} '
+                f"{values['seconds']:.6f}"
+            )
+        for key, value in report["totals"].items():
+            lines.append(f"# TYPE {prefix}_{key}_total counter")
+            lines.append(f"{prefix}_{key}_total {value}")
+        lines.append(f"# TYPE {prefix}_run_timestamp_seconds gauge")
+        lines.append(
+            f"{prefix}_run_timestamp_seconds {self.started.timestamp():.0f}"
+        )
+        tmp = f"{filename}.{os.getpid()}.tmp"
+        with open(tmp, "w") as outfile:
+            outfile.write("\n".join(lines) + "\n")
+        os.replace(tmp, filename)
+
+
+def staged(name=None):
+    """
+    This function decorates a method so that it runs as a stage of the
+    telemetry of its instance, when the instance has one
+    Inputs:
+        name: name of the stage, defaults to the method name
+    Returns:
+        decorator: method decorator
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            telemetry = getattr(self, "telemetry", None)
+            if telemetry is None:
+                return func(self, *args, **kwargs)
+            with telemetry.stage(name or func.__name__):
+                return func(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,348 @@
+import hashlib
+import json
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from math import asinh, ceil, floor, log2, pi, radians, tan
+
+import numpy as np
+import rasterio
+from osgeo import gdal
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window, from_bounds
+from utils.classification import CLASS_NODATA
+from utils.quicklook import write_png
+
+TILE_SIZE = 256
+# half of the Web Mercator world width in metres
+ORIGIN_SHIFT = 20037508.342789244
+# tiles holding nothing but these classes are not written
+SKIP_CLASSES = (CLASS_NODATA, 4)
+# side of the source blocks hashed to find changed tiles
+HASH_BLOCK = 512
+# tiles handed to a worker at once
+TILES_PER_TASK = 64
+
+
+def tile_index(lon, lat, zoom):
+    """
+    This function finds the XYZ tile holding a point
+    Inputs:
+        lon, lat: coordinates in degrees
+        zoom: zoom level
+    Returns:
+        x, y: tile column and row
+    """
+    n = 2**zoom
+    lat = max(min(lat, 85.0511287798), -85.0511287798)
+    x = floor((lon + 180.0) / 360.0 * n)
+    y = floor((1.0 - asinh(tan(radians(lat))) / pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tile_bounds(x, y, zoom):
+    """
+    This function returns the bounds of an XYZ tile in EPSG:3857
+    Inputs:
+        x, y: tile column and row
+        zoom: zoom level
+    Returns:
+        bounds: (minx, miny, maxx, maxy) in metres
+    """
+    size = 2 * ORIGIN_SHIFT / 2**zoom
+    minx = -ORIGIN_SHIFT + x * size
+    maxy = ORIGIN_SHIFT - y * size
+    return minx, maxy - size, minx + size, maxy
+
+
+def max_zoom_of(src):
+    """
+    This function picks the zoom whose pixels match the raster resolution
+    Inputs:
+        src: rasterio dataset
+    Returns:
+        zoom: zoom level
+    """
+    minx, _, maxx, _ = transform_bounds(src.crs, "EPSG:3857", *src.bounds)
+    resolution = (maxx - minx) / src.width
+    return max(0, ceil(log2(2 * ORIGIN_SHIFT / (TILE_SIZE * resolution))))
+
+
+def pyramid(bounds, min_zoom, max_zoom):
+    """
+    This function lists the tiles covering bounds at every zoom
+    Inputs:
+        bounds: (minx, miny, maxx, maxy) in degrees
+        min_zoom: lowest zoom level
+        max_zoom: highest zoom level
+    Returns:
+        tiles: list of (zoom, x, y)
+    """
+    tiles = []
+    for zoom in range(min_zoom, max_zoom + 1):
+        left, top = tile_index(bounds[0], bounds[3], zoom)
+        right, bottom = tile_index(bounds[2], bounds[1], zoom)
+        tiles.extend(
+            (zoom, x, y)
+            for x in range(left, right + 1)
+            for y in range(top, bottom + 1)
+        )
+    return tiles
+
+
+def block_hashes(filename, block=HASH_BLOCK):
+    """
+    This function hashes the source raster block by block
+    Inputs:
+        filename: path of the class raster
+        block: side of the blocks in pixels
+    Returns:
+        hashes: "row/col" of every block mapped to its sha1
+    """
+    hashes = {}
+    with rasterio.open(filename) as src:
+        for row in range(0, src.height, block):
+            height = min(block, src.height - row)
+            strip = src.read(1, window=Window(0, row, src.width, height))
+            for col in range(0, src.width, block):
+                data = np.ascontiguousarray(strip[:, col : col + block])
+                hashes[f"{row // block}/{col // block}"] = hashlib.sha1(
+                    data
+                ).hexdigest()
+    return hashes
+
+
+def tile_blocks(src, tile, block=HASH_BLOCK):
+    """
+    This function lists the source blocks a tile is rendered from
+    Inputs:
+        src: rasterio dataset of the class raster
+        tile: (zoom, x, y)
+        block: side of the blocks in pixels
+    Returns:
+        blocks: list of "row/col" block keys
+    """
+    zoom, x, y = tile
+    bounds = transform_bounds("EPSG:3857", src.crs, *tile_bounds(x, y, zoom))
+    window = from_bounds(*bounds, transform=src.transform)
+    rows = range(
+        max(0, floor(window.row_off / block)),
+        min(
+            ceil(src.height / block),
+            ceil((window.row_off + window.height) / block),
+        ),
+    )
+    cols = range(
+        max(0, floor(window.col_off / block)),
+        min(
+            ceil(src.width / block),
+            ceil((window.col_off + window.width) / block),
+        ),
+    )
+    return [f"{row}/{col}" for row in rows for col in cols]
+
+
+def _render(filename, tiles, skip_classes):
+    """
+    This function renders a batch of tiles in a worker process
+    Inputs:
+        filename: path of the class raster
+        tiles: list of (zoom, x, y)
+        skip_classes: classes of the tiles that are not written
+    Returns:
+        rendered: list of ((zoom, x, y), PNG bytes or None when skipped)
+    """
+    src = gdal.Open(filename)
+    rendered = []
+    for zoom, x, y in tiles:
+        # mode keeps the classes categorical and is read from the overviews
+        dataset = gdal.Warp(
+            "",
+            src,
+            format="MEM",
+            dstSRS="EPSG:3857",
+            outputBounds=tile_bounds(x, y, zoom),
+            width=TILE_SIZE,
+            height=TILE_SIZE,
+            resampleAlg="mode",
+            dstNodata=CLASS_NODATA,
+        )
+        classes = dataset.GetRasterBand(1).ReadAsArray()
+        dataset = None
+        if np.isin(classes, skip_classes).all():
+            rendered.append(((zoom, x, y), None))
+            continue
+        path = f"/vsimem/tile_{os.getpid()}_{zoom}_{x}_{y}.png"
+        write_png(classes, path)
+        handle = gdal.VSIFOpenL(path, "rb")
+        gdal.VSIFSeekL(handle, 0, 2)
+        size = gdal.VSIFTellL(handle)
+        gdal.VSIFSeekL(handle, 0, 0)
+        data = gdal.VSIFReadL(1, size, handle)
+        gdal.VSIFCloseL(handle)
+        gdal.Unlink(path)
+        rendered.append(((zoom, x, y), data))
+    return rendered
+
+
+class TileWriter:
+    """
+    Writes tiles either as an XYZ folder of PNGs or into an MBTiles file.
+    """
+
+    def __init__(self, output):
+        self.output = str(output)
+        self.mbtiles = self.output.endswith(".mbtiles")
+        self.db = None
+        if self.mbtiles:
+            self.db = sqlite3.connect(self.output)
+            self.db.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT);
+                CREATE TABLE IF NOT EXISTS tiles (
+                    zoom_level INTEGER,
+                    tile_column INTEGER,
+                    tile_row INTEGER,
+                    tile_data BLOB
+                );
+                CREATE UNIQUE INDEX IF NOT EXISTS tile_index
+                ON tiles (zoom_level, tile_column, tile_row);
+                """
+            )
+        else:
+            os.makedirs(self.output, exist_ok=True)
+
+    @property
+    def manifest(self):
+        if self.mbtiles:
+            return f"{self.output}.manifest.json"
+        return os.path.join(self.output, "manifest.json")
+
+    def write(self, tile, data):
+        zoom, x, y = tile
+        if self.mbtiles:
+            # MBTiles rows count from the bottom (TMS)
+            self.db.execute(
+                "INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)",
+                (zoom, x, 2**zoom - 1 - y, data),
+            )
+            return
+        path = os.path.join(self.output, str(zoom), str(x), f"{y}.png")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+
+    def remove(self, tile):
+        zoom, x, y = tile
+        if self.mbtiles:
+            self.db.execute(
+                "DELETE FROM tiles WHERE zoom_level = ? AND tile_column = ?"
+                " AND tile_row = ?",
+                (zoom, x, 2**zoom - 1 - y),
+            )
+            return
+        path = os.path.join(self.output, str(zoom), str(x), f"{y}.png")
+        if os.path.exists(path):
+            os.remove(path)
+
+    def close(self, metadata):
+        if self.mbtiles:
+            with self.db:
+                self.db.execute("DELETE FROM metadata")
+                self.db.executemany(
+                    "INSERT INTO metadata VALUES (?, ?)",
+                    [(k, str(v)) for k, v in metadata.items()],
+                )
+            self.db.close()
+
+
+def export_tiles(
+    filename,
+    output,
+    min_zoom=0,
+    max_zoom=None,
+    workers=None,
+    skip_classes=SKIP_CLASSES,
+):
+    """
+    This function renders a Web Mercator tile pyramid of a class raster
+    across a process pool, with the palette of the quicklook. Tiles that
+    hold only skip_classes are not written, and on a re-run only the tiles
+    whose source blocks changed since the last export are rendered again.
+    Inputs:
+        filename: path of the class raster, e.g. ./data/output.tiff
+        output: XYZ folder or path of an .mbtiles file
+        min_zoom: lowest zoom level
+        max_zoom: highest zoom level, defaults to the raster resolution
+        workers: number of processes, defaults to the cpu count
+        skip_classes: classes of the tiles that are not written
+    Returns:
+        summary: number of rendered, skipped and unchanged tiles
+    """
+    writer = TileWriter(output)
+    manifest = {"blocks": {}, "tiles": {}}
+    if os.path.exists(writer.manifest):
+        with open(writer.manifest) as f:
+            manifest = json.load(f)
+    hashes = block_hashes(filename)
+    with rasterio.open(filename) as src:
+        if max_zoom is None:
+            max_zoom = max_zoom_of(src)
+        grid = [str(src.crs), list(src.transform), src.width, src.height]
+        bounds = transform_bounds(src.crs, "EPSG:4326", *src.bounds)
+        tiles = pyramid(bounds, min_zoom, max_zoom)
+        if manifest.get("grid") != grid:
+            changed = set(hashes)
+            manifest["tiles"] = {}
+        else:
+            changed = {
+                key
+                for key in hashes
+                if manifest["blocks"].get(key) != hashes[key]
+            }
+        todo = [
+            tile
+            for tile in tiles
+            if "/".join(map(str, tile)) not in manifest["tiles"]
+            or not changed.isdisjoint(tile_blocks(src, tile))
+        ]
+    summary = {
+        "rendered": 0,
+        "skipped": 0,
+        "unchanged": len(tiles) - len(todo),
+    }
+    batches = [
+        todo[i : i + TILES_PER_TASK]
+        for i in range(0, len(todo), TILES_PER_TASK)
+    ]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(_render, filename, batch, skip_classes)
+            for batch in batches
+        ]
+        for future in futures:
+            for tile, data in future.result():
+                key = "/".join(map(str, tile))
+                if data is None:
+                    if manifest["tiles"].get(key) == "written":
+                        writer.remove(tile)
+                    manifest["tiles"][key] = "skipped"
+                    summary["skipped"] += 1
+                    continue
+                writer.write(tile, data)
+                manifest["tiles"][key] = "written"
+                summary["rendered"] += 1
+    writer.close(
+        {
+            "name": os.path.basename(filename),
+            "format": "png",
+            "type": "overlay",
+            "bounds": ",".join(f"{b:.6f}" for b in bounds),
+            "minzoom": min_zoom,
+            "maxzoom": max_zoom,
+        }
+    )
+    manifest.update({"grid": grid, "blocks": hashes})
+    with open(writer.manifest, "w") as outfile:
+        json.dump(manifest, outfile)
+    return summary
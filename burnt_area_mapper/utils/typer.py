@@ -20,5 +20,124 @@ OPTION_GDF_PATH = typer.Option(
 OPTION_DOWNLOAD_BY = typer.Option(
     "CA",
     "--download_by",
-    help="Downloading via SentinelHub (SH) or Copernicus API (CA)",
+    help=(
+        "Downloading via SentinelHub (SH) or Copernicus API (CA), or "
+        "reprocessing already downloaded scenes (LOCAL)"
+    ),
+)
+OPTION_MEMORY_BUDGET = typer.Option(
+    None,
+    "--memory_budget",
+    help="Process block-wise within this memory budget in MB",
+)
+OPTION_WORKERS = typer.Option(
+    None, "--workers", help="Number of workers for block-wise processing"
+)
+OPTION_CLASS_BREAKS = typer.Option(
+    None,
+    "--class_breaks",
+    help="Comma separated upper bounds of the eight dNBR class intervals",
+)
+OPTION_LAZY = typer.Option(
+    False,
+    "--lazy/--no_lazy",
+    help="Decode only the area of interest straight from the .jp2 bands (CA)",
+)
+OPTION_EXTRACT = typer.Option(
+    "all",
+    "--extract",
+    help="Extract all, only the needed bands or read them in place (vsizip)",
+)
+OPTION_DOWNLOAD_MODE = typer.Option(
+    "product",
+    "--download_mode",
+    help="Download whole CA products or only the needed bands (bands)",
+)
+OPTION_STORE_DIR = typer.Option(
+    None,
+    "--store_dir",
+    help="Folder of the persistent scene store, reused across runs",
+)
+OPTION_STORE_SIZE = typer.Option(
+    50.0, "--store_size", help="Size limit of the scene store in GB"
+)
+OPTION_COMPOSITE = typer.Option(
+    None,
+    "--composite",
+    help="Per pixel cloud-free composite (least_cloudy or median) for SH",
+)
+OPTION_DOWNLOAD_WORKERS = typer.Option(
+    5,
+    "--download_workers",
+    help="Concurrent tile downloads of large SentinelHub areas",
+)
+OPTION_EVENTS = typer.Option(
+    ...,
+    "--events",
+    help="GeoPackage or CSV (WKT geometry) of fire events with start and end",
+)
+OPTION_OUTPUT_DIR = typer.Option(
+    "./batch", "--output_dir", help="Folder of the per event outputs"
+)
+OPTION_BATCH_WORKERS = typer.Option(
+    None, "--batch_workers", help="Number of events processed in parallel"
+)
+OPTION_LOCAL_PRE = typer.Option(
+    None,
+    "--local_pre",
+    help="Pre fire .SAFE, .zip or mosaic for --download_by LOCAL",
+)
+OPTION_LOCAL_POST = typer.Option(
+    None,
+    "--local_post",
+    help="Post fire .SAFE, .zip or mosaic for --download_by LOCAL",
+)
+OPTION_PROFILE = typer.Option(
+    False,
+    "--profile/--no_profile",
+    help="Profile every stage with cProfile, one .prof per stage in "
+    "./data/profile/",
+)
+OPTION_PROMETHEUS = typer.Option(
+    None,
+    "--prometheus",
+    help="Path of a Prometheus textfile with the run metrics",
+)
+OPTION_COMPRESS = typer.Option(
+    "DEFLATE", "--compress", help="Compression of the output, DEFLATE or ZSTD"
+)
+OPTION_TILES = typer.Option(
+    None,
+    "--tiles",
+    help="XYZ folder or .mbtiles file of a Web Mercator tile pyramid",
+)
+OPTION_MAX_ZOOM = typer.Option(
+    None,
+    "--max_zoom",
+    help="Highest zoom of the tiles, defaults to the output resolution",
+)
+OPTION_ZONES = typer.Option(
+    None,
+    "--zones",
+    help="Vector file of zones to count burned hectares per class in",
+)
+OPTION_ZONAL_OUTPUT = typer.Option(
+    "./data/zonal_stats.csv",
+    "--zonal_output",
+    help="CSV or GeoPackage of the per zone statistics",
+)
+OPTION_VECTORS = typer.Option(
+    None,
+    "--vectors",
+    help="GeoPackage or GeoParquet of the severity polygons and perimeter",
+)
+OPTION_SIMPLIFY = typer.Option(
+    None,
+    "--simplify",
+    help="Simplification tolerance of the polygons in units of the output",
+)
+OPTION_SIEVE = typer.Option(
+    None,
+    "--sieve",
+    help="Merge regions of fewer pixels into a neighbour before polygonizing",
 )
@@ -1,67 +1,100 @@
 import glob
 
-import matplotlib
-import matplotlib.pyplot as plt
 import numpy as np
 import shapely
 from osgeo import gdal, osr
+from rasterio.windows import Window
 from shapely.ops import cascaded_union
+from utils.classification import CLASS_COLORS, CLASS_NODATA, RASTER_CLASSES
+from utils.quicklook import legend, quicklook
 
 
-def plot_burn_severity(image, name):
-    # set colors for plotting and classes
-    cmap = matplotlib.colors.ListedColormap(
-        [
-            "blue",
-            "red",
-            "orange",
-            "green",
-            "yellow",
-            "brown",
-            "violet",
-            "purple",
-        ]
-    )
-    cmap.set_over("purple")
-    cmap.set_under("white")
-    bounds = [0, 2, 3, 4, 5, 6, 7, 8, 9]
-    norm = matplotlib.colors.BoundaryNorm(bounds, cmap.N)
+def plot_burn_severity(image, name, max_size=1024, with_legend=True):
+    """
+    This function renders the burn severity map as a paletted PNG thumbnail,
+    mode decimated (or read from the overviews of a class raster) so that
+    its cost does not grow with the resolution of the output
+    input:  image           array or string   classes or path of a class raster
+            name            string            name of the PNG in ./data/
+            max_size        int               longest side of the PNG
+            with_legend     bool              whether to render the legend
+    output: filename        string            path of the PNG
+            legend_file     string            path of the cached legend or None
+    """
+    filename = quicklook(image, f"./data/{name}.png", max_size=max_size)
+    legend_file = legend("./data/") if with_legend else None
+    return filename, legend_file
 
-    fig, ax = plt.subplots(
-        figsize=(10, 10), subplot_kw={"xticks": [], "yticks": []}
-    )
-    cax = ax.imshow(image, cmap=cmap, norm=norm)
-    plt.title("Burn Severity Map")
-    cbar = fig.colorbar(
-        cax,
-        ax=ax,
-        fraction=0.035,
-        pad=0.04,
-        ticks=[1, 2, 3, 4, 5, 6, 7, 8],
+
+def describe_classes(dataset, classes=RASTER_CLASSES, colors=CLASS_COLORS):
+    """
+    This function embeds the nodata value, the color table and the class
+    names into a class raster, so it can be read without the separate
+    classification JSON or PNG
+    input:  dataset                     gdal dataset    opened for update
+            classes                     dict            class value to name
+            colors                      dict            class value to RGBA
+    """
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(CLASS_NODATA)
+    color_table = gdal.ColorTable()
+    for value, color in colors.items():
+        color_table.SetColorEntry(int(value), color)
+    band.SetRasterColorTable(color_table)
+    band.SetRasterColorInterpretation(gdal.GCI_PaletteIndex)
+    names = [""] * (max(int(value) for value in classes) + 1)
+    for value, name in classes.items():
+        names[int(value)] = name
+    band.SetCategoryNames(names)
+    # band metadata lands in the GDAL_METADATA tag inside the file itself
+    band.SetMetadata(
+        {f"CLASS_{value}": name for value, name in classes.items()}
     )
-    cbar.ax.set_yticklabels(
-        [
-            "Water",
-            "Enhanced regrowth, high (post-fire)",
-            "Enhanced regrowth, low (post-fire)",
-            "Unburned",
-            "Low Severity",
-            "Moderate-low Severity",
-            "Moderate-high Severity",
-            "High Severity",
-        ]
+    band.SetDescription("burn severity")
+
+
+def write_cog(src_filename, filename, compress="DEFLATE", blocksize=512):
+    """
+    This function turns a class raster into a Cloud-Optimized GeoTIFF with
+    internal tiling and overviews built with mode resampling, then removes
+    the source
+    input:  src_filename                string          tiled uint8 raster
+            filename                    string          output filename
+            compress                    string          DEFLATE or ZSTD
+            blocksize                   int             tile size in pixels
+    output: filename                    string          output filename
+    """
+    src = gdal.Open(src_filename, gdal.GA_Update)
+    describe_classes(src)
+    gdal.Translate(
+        filename,
+        src,
+        format="COG",
+        creationOptions=[
+            f"COMPRESS={compress}",
+            f"BLOCKSIZE={blocksize}",
+            "OVERVIEW_RESAMPLING=MODE",
+            "NUM_THREADS=ALL_CPUS",
+            "BIGTIFF=IF_SAFER",
+        ],
     )
-    # plt.show()
-    plt.savefig(f"./data/{name}.png", bbox_inches="tight")
+    src = None
+    gdal.GetDriverByName("GTiff").Delete(src_filename)
+    return filename
 
 
-def array2raster(array, geoTransform, projection, filename):
+def array2raster(
+    array, geoTransform, projection, filename, compress="DEFLATE"
+):
     """
-    This function tarnsforms a numpy array to a geotiff projected raster
+    This function tarnsforms a numpy array to a geotiff projected raster:
+    the classes are written block by block as uint8 into a tiled scratch
+    raster that is then converted to a Cloud-Optimized GeoTIFF
     input:  array                       array (n x m)   input array
             geoTransform                tuple           affine transformation coefficients
             projection                  string          projection
             filename                    string          output filename
+            compress                    string          DEFLATE or ZSTD
     output: dataset                                     gdal raster dataset
             dataset.GetRasterBand(1)                    band object of dataset
 
@@ -69,38 +102,52 @@ def array2raster(array, geoTransform, projection, filename):
     pixels_x = array.shape[1]
     pixels_y = array.shape[0]
 
+    scratch = f"{filename}.tmp.tif"
     driver = gdal.GetDriverByName("GTiff")
     dataset = driver.Create(
-        filename,
+        scratch,
         pixels_x,
         pixels_y,
         1,
-        gdal.GDT_Int16,
+        gdal.GDT_Byte,
+        options=[
+            "TILED=YES",
+            "BLOCKXSIZE=512",
+            "BLOCKYSIZE=512",
+            "COMPRESS=DEFLATE",
+            "BIGTIFF=IF_SAFER",
+        ],
     )
     dataset.SetGeoTransform(geoTransform)
     dataset.SetProjection(projection)
-    dataset.GetRasterBand(1).WriteArray(array)
-    dataset.FlushCache()  # Write to disk.
-    return dataset, dataset.GetRasterBand(
-        1
-    )  # If you need to return, remenber to return  also t
+    band = dataset.GetRasterBand(1)
+    for row in range(0, pixels_y, 512):
+        band.WriteArray(
+            array[row : row + 512].astype(np.uint8, copy=False), 0, row
+        )
+    dataset = band = None
+    write_cog(scratch, filename, compress=compress)
+    dataset = gdal.Open(filename)
+    return dataset, dataset.GetRasterBand(1)
 
 
-def read_band_image(band="response", path="./data/"):
+def read_band_image(band="response", path="./data/", filename=None):
     """
     This function takes as input the Sentinel-2 band name and the path of the
     folder that the images are stored, reads the image and returns the data as
     an array
     input:   band           string            Sentinel-2 band name
              path           string            path of the folder
+             filename       string            image to read instead of path
     output:  data           array (n x m)     array of the band image
              spatialRef     string            projection
              geoTransform   tuple             affine transformation coefficients
              targetprj                        spatial reference
     """
     # a = path+'*B'+band+'*.tiff'
-    a = f"{path}output*clipped*.tiff"
-    img = gdal.Open(glob.glob(a)[0])
+    if filename is None:
+        filename = glob.glob(f"{path}output*clipped*.tiff")[0]
+    img = gdal.Open(filename)
     data = np.array(img.GetRasterBand(1).ReadAsArray())
     spatialRef = img.GetProjection()
     geoTransform = img.GetGeoTransform()
@@ -108,6 +155,23 @@ def read_band_image(band="response", path="./data/"):
     return data, spatialRef, geoTransform, targetprj
 
 
+def raster_bands(filename):
+    """
+    This function reads the band names a raster records as band descriptions
+    input:   filename       string            path of the raster
+    output:  bands          tuple             band names in band order or
+                                              None if a band is not named
+    """
+    img = gdal.Open(filename)
+    bands = tuple(
+        img.GetRasterBand(i + 1).GetDescription()
+        for i in range(img.RasterCount)
+    )
+    if not all(bands):
+        return None
+    return bands
+
+
 def min_cover_1(U):
     """
     This algorithm goes through all polygons and adds them to union_poly only if they're
@@ -174,3 +238,27 @@ def min_cover_2(U):
 def get_gdf_bounds(gdf):
     bounds = gdf.total_bounds
     return bounds
+
+
+def block_windows(width, height, bytes_per_pixel, memory_budget, align=1):
+    """
+    This function splits a raster into full-width row strips that each fit
+    into a memory budget
+    Inputs:
+        width: raster width in pixels
+        height: raster height in pixels
+        bytes_per_pixel: working memory needed per pixel of a strip
+        memory_budget: bytes available for a single strip
+        align: row multiple the strips are snapped to (e.g. block height)
+    Returns:
+        windows: list of rasterio windows covering the raster
+    """
+    rows = max(1, int(memory_budget // (width * bytes_per_pixel)))
+    if rows >= align:
+        rows -= rows % align
+    rows = min(rows, height)
+    windows = [
+        Window(0, row, width, min(rows, height - row))
+        for row in range(0, height, rows)
+    ]
+    return windows
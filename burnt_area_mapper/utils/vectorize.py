@@ -0,0 +1,231 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import geopandas as gpd
+import numpy as np
+import rasterio
+import shapely
+from rasterio.features import shapes, sieve
+from rasterio.windows import Window
+from rasterio.windows import transform as window_transform
+from shapely import STRtree
+from shapely.geometry import shape
+from utils.classification import CLASS_NODATA, RASTER_CLASSES
+
+# side of the tiles polygonized by a worker
+VECTOR_TILE = 2048
+# severity classes whose union is the fire perimeter
+BURNED_CLASSES = (5, 6, 7, 8)
+
+
+def _polygonize(filename, window, sieve_size):
+    """
+    This function polygonizes a tile of a class raster in a worker process.
+    With sieve_size the tile is read with a halo of as many pixels, so small
+    regions cut by the tile edge are mostly seen whole; near the seams the
+    sieve may still differ from one over the full raster, e.g. for regions
+    that reach beyond the halo.
+    Inputs:
+        filename: path of the class raster
+        window: rasterio Window of the tile
+        sieve_size: regions of fewer pixels are merged into a neighbour
+    Returns:
+        interior: list of (class value, shapely Polygon) within the tile
+        seams: list of (class value, shapely Polygon) touching a tile seam
+    """
+    with rasterio.open(filename) as src:
+        halo = sieve_size if sieve_size else 0
+        top = max(0, window.row_off - halo)
+        left = max(0, window.col_off - halo)
+        read = Window(
+            left,
+            top,
+            min(src.width, window.col_off + window.width + halo) - left,
+            min(src.height, window.row_off + window.height + halo) - top,
+        )
+        classes = src.read(1, window=read)
+        transform = window_transform(window, src.transform)
+        # tile edges shared with a neighbouring tile
+        seam_left = window.col_off > 0
+        seam_right = window.col_off + window.width < src.width
+        seam_top = window.row_off > 0
+        seam_bottom = window.row_off + window.height < src.height
+    if sieve_size:
+        classes = sieve(classes, size=sieve_size)
+    row, col = window.row_off - top, window.col_off - left
+    classes = classes[row : row + window.height, col : col + window.width]
+    polygons = [
+        (int(value), shape(geometry))
+        for geometry, value in shapes(
+            classes, mask=classes != CLASS_NODATA, transform=transform
+        )
+    ]
+    # polygon bounds in pixels of the tile, edges fall on whole pixels
+    bounds = shapely.bounds(
+        np.array([polygon for _, polygon in polygons], dtype=object)
+    ).reshape(-1, 4)
+    cols, rows = ~transform * (bounds[:, [0, 2]].T, bounds[:, [1, 3]].T)
+    cols, rows = np.rint(cols), np.rint(rows)
+    on_seam = (
+        (seam_left & (cols.min(axis=0) <= 0))
+        | (seam_right & (cols.max(axis=0) >= window.width))
+        | (seam_top & (rows.min(axis=0) <= 0))
+        | (seam_bottom & (rows.max(axis=0) >= window.height))
+    )
+    interior = [p for p, seam in zip(polygons, on_seam) if not seam]
+    seams = [p for p, seam in zip(polygons, on_seam) if seam]
+    return interior, seams
+
+
+def stitch(polygons):
+    """
+    This function merges the polygons that touch one another, such as the
+    parts of a region cut by the tile seams. Only the polygons of a
+    connected group are unioned together, so the cost follows the size of
+    the groups rather than of the raster.
+    Inputs:
+        polygons: list of shapely Polygons
+    Returns:
+        stitched: list of shapely Polygons
+    """
+    if len(polygons) == 0:
+        return []
+    geoms = np.array(polygons, dtype=object)
+    parent = list(range(len(geoms)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    pairs = STRtree(geoms).query(geoms, predicate="intersects")
+    for i, j in zip(*pairs.tolist()):
+        parent[find(i)] = find(j)
+    groups = {}
+    for i in range(len(geoms)):
+        groups.setdefault(find(i), []).append(i)
+    stitched = []
+    for group in groups.values():
+        if len(group) == 1:
+            stitched.append(geoms[group[0]])
+        else:
+            # regions meeting at a corner only are split apart again
+            union = shapely.union_all(geoms[group])
+            stitched.extend(shapely.get_parts(union).tolist())
+    return stitched
+
+
+def polygonize(filename, workers=None, sieve_size=None, tile=VECTOR_TILE):
+    """
+    This function polygonizes a class raster tile by tile across a process
+    pool. Polygons within a tile are kept as they are, those touching a
+    tile seam share the pixel edges exactly with their other parts, so they
+    are stitched per class.
+    Inputs:
+        filename: path of the class raster, e.g. ./data/output.tiff
+        workers: number of processes, defaults to the cpu count
+        sieve_size: regions of fewer pixels are merged into a neighbour
+        tile: side of the tiles in pixels
+    Returns:
+        polygons: class value mapped to a list of shapely Polygons
+        crs: crs of the raster
+    """
+    with rasterio.open(filename) as src:
+        crs = src.crs
+        windows = [
+            Window(
+                col,
+                row,
+                min(tile, src.width - col),
+                min(tile, src.height - row),
+            )
+            for row in range(0, src.height, tile)
+            for col in range(0, src.width, tile)
+        ]
+    polygons, seams = {}, {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(_polygonize, filename, window, sieve_size)
+            for window in windows
+        ]
+        for future in futures:
+            interior, seam = future.result()
+            for value, polygon in interior:
+                polygons.setdefault(value, []).append(polygon)
+            for value, polygon in seam:
+                seams.setdefault(value, []).append(polygon)
+    for value, parts in seams.items():
+        polygons.setdefault(value, []).extend(stitch(parts))
+    return {value: polygons[value] for value in sorted(polygons)}, crs
+
+
+def vectorize(
+    filename,
+    output,
+    workers=None,
+    simplify=None,
+    sieve_size=None,
+    tile=VECTOR_TILE,
+):
+    """
+    This function writes the severity polygons of a class raster, one
+    feature per connected region with the class code and name of
+    apply_final_classification, and the fire perimeter as the union of
+    the burned classes. A GeoPackage gets the layers "severity" and
+    "perimeter", a GeoParquet file the severity polygons with the
+    perimeter next to it in <name>_perimeter.parquet.
+    Inputs:
+        filename: path of the class raster, e.g. ./data/output.tiff
+        output: path of the .gpkg or .parquet file
+        workers: number of processes, defaults to the cpu count
+        simplify: simplification tolerance in units of the raster crs,
+        applied per polygon so neighbouring polygons may no longer touch
+        sieve_size: regions of fewer pixels are merged into a neighbour
+        tile: side of the tiles in pixels
+    Returns:
+        summary: number of polygons per class name and of perimeters
+    """
+    polygons, crs = polygonize(filename, workers, sieve_size, tile)
+    perimeter = stitch(
+        [
+            polygon
+            for value in BURNED_CLASSES
+            for polygon in polygons.get(value, [])
+        ]
+    )
+    values = [value for value, parts in polygons.items() for _ in parts]
+    geometry = [polygon for parts in polygons.values() for polygon in parts]
+    if simplify:
+        geometry = shapely.simplify(
+            np.array(geometry, dtype=object), simplify
+        ).tolist()
+        perimeter = shapely.simplify(
+            np.array(perimeter, dtype=object), simplify
+        ).tolist()
+    severity = gpd.GeoDataFrame(
+        {
+            "class": values,
+            "name": [RASTER_CLASSES.get(str(v), "") for v in values],
+        },
+        geometry=geometry,
+        crs=crs,
+    )
+    perimeter = gpd.GeoDataFrame(
+        {"classes": [",".join(map(str, BURNED_CLASSES))] * len(perimeter)},
+        geometry=perimeter,
+        crs=crs,
+    )
+    perimeter = perimeter[~perimeter.geometry.is_empty]
+    output = str(output)
+    if output.endswith(".parquet"):
+        severity.to_parquet(output)
+        stem, _ = os.path.splitext(output)
+        perimeter.to_parquet(f"{stem}_perimeter.parquet")
+    else:
+        severity.to_file(output, layer="severity", driver="GPKG")
+        perimeter.to_file(output, layer="perimeter", driver="GPKG")
+    return {
+        "polygons": severity["name"].value_counts().to_dict(),
+        "perimeters": len(perimeter),
+    }
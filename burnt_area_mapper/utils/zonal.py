@@ -0,0 +1,163 @@
+from math import radians
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.features import rasterize
+from rasterio.windows import Window
+from rasterio.windows import bounds as window_bounds
+from rasterio.windows import transform as window_transform
+from shapely import STRtree, box
+from utils.classification import DNBR_CLASSES, RASTER_CLASSES
+from utils.io import GeospatialRead
+
+# bytes held per pixel of a strip: classes, zone ids, bin index and weights
+ZONAL_BYTES_PER_PIXEL = 32
+# memory budget of the strips when none is given
+ZONAL_BUDGET = 256 * 1024**2
+# mean radius of the earth in metres, for pixel areas of geographic grids
+EARTH_RADIUS = 6371008.8
+# square metres per hectare
+HECTARE = 10000.0
+
+
+def row_areas(src, row, height):
+    """
+    This function returns the area of a pixel on every row of a strip, on
+    a sphere for geographic grids where it shrinks towards the poles
+    Inputs:
+        src: rasterio dataset
+        row: first row of the strip
+        height: number of rows
+    Returns:
+        areas: float64 numpy ndarray of hectares per pixel, one per row
+    """
+    transform = src.transform
+    if not src.crs or not src.crs.is_geographic:
+        area = abs(transform.a * transform.e) / HECTARE
+        return np.full(height, area)
+    top = transform.f + transform.e * np.arange(row, row + height + 1)
+    sines = np.sin(np.radians(top))
+    width = radians(abs(transform.a))
+    return EARTH_RADIUS**2 * width * np.abs(np.diff(sines)) / HECTARE
+
+
+def read_zones(path, crs=None):
+    """
+    This function reads the zones of the statistics
+    Inputs:
+        path: vector file or CSV with a WKT geometry column
+        crs: crs of the class raster the zones are reprojected to
+    Returns:
+        zones: GeoDataFrame of the non-empty zones with a fresh index
+    """
+    zones = GeospatialRead(Path(path))._read_file()
+    zones = zones[zones.geometry.notna() & ~zones.geometry.is_empty]
+    if crs is not None and zones.crs is not None and zones.crs != crs:
+        zones = zones.to_crs(crs)
+    return zones.reset_index(drop=True)
+
+
+def zonal_stats(
+    filename,
+    zones,
+    memory_budget=ZONAL_BUDGET,
+    classes=DNBR_CLASSES,
+):
+    """
+    This function counts the pixels and hectares of every class within
+    every zone. Zone ids are rasterized onto the grid of the class raster
+    strip by strip, with only the zones intersecting the strip, and every
+    strip is reduced by a single np.bincount over zone x class bins, so the
+    memory stays within the budget for any number of zones. Where zones
+    overlap the pixels count towards the last of them.
+    Inputs:
+        filename: path of the class raster, e.g. ./data/output.tiff
+        zones: GeoDataFrame of the zones in the crs of the raster
+        memory_budget: bytes held by a strip
+        classes: class codes counted, other values go to no class
+    Returns:
+        pixels: int64 numpy ndarray of shape (zones, classes)
+        hectares: float64 numpy ndarray of shape (zones, classes)
+    """
+    n = len(classes) + 1
+    # class value to bin, values of no class (nodata) go to the last bin
+    lut = np.full(256, n - 1, dtype=np.intp)
+    lut[list(classes)] = np.arange(len(classes))
+    # bin 0 of the zone ids is outside of every zone
+    bins = (len(zones) + 1) * n
+    pixels = np.zeros(bins, dtype=np.int64)
+    hectares = np.zeros(bins, dtype=np.float64)
+    geoms = zones.geometry.values
+    tree = STRtree(geoms)
+    with rasterio.open(filename) as src:
+        rows = max(1, memory_budget // (src.width * ZONAL_BYTES_PER_PIXEL))
+        for row in range(0, src.height, rows):
+            window = Window(0, row, src.width, min(rows, src.height - row))
+            index = tree.query(box(*window_bounds(window, src.transform)))
+            if not len(index):
+                continue
+            # ascending so overlaps resolve the same in every strip
+            index.sort()
+            zone_ids = rasterize(
+                zip(geoms[index], index + 1),
+                out_shape=(window.height, window.width),
+                transform=window_transform(window, src.transform),
+                fill=0,
+                dtype="uint32",
+            )
+            strip = src.read(1, window=window)
+            flat = zone_ids.ravel().astype(np.intp) * n
+            flat += lut[strip.ravel()]
+            pixels += np.bincount(flat, minlength=bins)
+            areas = np.repeat(row_areas(src, row, window.height), window.width)
+            hectares += np.bincount(flat, weights=areas, minlength=bins)
+    return (
+        pixels.reshape(-1, n)[1:, :-1],
+        hectares.reshape(-1, n)[1:, :-1],
+    )
+
+
+def write_zonal_stats(
+    filename,
+    zones_path,
+    output="./data/zonal_stats.csv",
+    memory_budget=ZONAL_BUDGET,
+):
+    """
+    This function writes the pixels and hectares of every class per zone,
+    as a CSV without or a GeoPackage with the zone geometries
+    Inputs:
+        filename: path of the class raster
+        zones_path: vector file of the zones, read with GeospatialRead
+        output: path of the .csv or .gpkg statistics
+        memory_budget: bytes held by a strip
+    Returns:
+        totals: pixels and hectares of every class over all zones
+    """
+    with rasterio.open(filename) as src:
+        crs = src.crs
+    zones = read_zones(zones_path, crs=crs)
+    pixels, hectares = zonal_stats(filename, zones, memory_budget)
+    columns = {}
+    for i, value in enumerate(DNBR_CLASSES):
+        columns[f"px_{value}"] = pixels[:, i]
+        columns[f"ha_{value}"] = hectares[:, i].round(4)
+    stats = pd.DataFrame(columns, index=zones.index)
+    output = str(output)
+    if output.endswith(".gpkg"):
+        zones.join(stats).to_file(output, driver="GPKG")
+    else:
+        zones.drop(columns=zones.geometry.name).join(stats).to_csv(
+            output, index_label="zone"
+        )
+    names = [RASTER_CLASSES[str(value)] for value in DNBR_CLASSES]
+    return {
+        "zones": len(zones),
+        "output": output,
+        "class_pixels": dict(zip(names, pixels.sum(axis=0).tolist())),
+        "class_area_ha": dict(
+            zip(names, hectares.sum(axis=0).round(4).tolist())
+        ),
+    }